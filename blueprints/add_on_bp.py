@@ -9,7 +9,7 @@ import time
 import asyncio
 from bs4 import BeautifulSoup
 from flask import Blueprint, request, jsonify, send_file
-from database import preferences_collection, users_collection, draft_messages_collection, inbox_conversations_collection
+from database import preferences_collection, users_collection, draft_messages_collection, inbox_conversations_collection, sender_reputation_collection
 # from database_async import get_async_db
 from utils.outlook_utils import (
     load_outlook_credentials, send_outlook_reply_graph,
@@ -17,10 +17,14 @@ from utils.outlook_utils import (
     prepare_conversation_thread as prepare_conversation_thread_outlook
 )
 from utils.common_utils import conduct_analysis
+from utils.analysis_plan import preference_cache
+from utils.lazy_replies import request_replies, ON_DEMAND
 from utils.gmail_utils import (
     load_google_credentials,
     prepare_conversation_thread as prepare_conversation_thread_gmail)
 from utils.gemini_utils import call_gemini_api_structured_output
+from utils.prompt_templates import VALIDATE_OUTGOING
+from utils.sender_reputation import reputation_keys, CLEAN_FOR
 from workers.tasks import (
     generate_attachment_summary, generate_previous_emails_summary, generate_importance_analysis,
     generate_summary_and_replies)
@@ -48,6 +52,8 @@ def get_dashboard_data():
         '/', '-').replace('+', '_')  # For Outlook messages
     conv_id = data.get('conv_id').replace('/', '-').replace('+', '_')
     provider = data.get('provider', '')
+    # With partial=true, fields that are ready are returned before the whole analysis completes.
+    partial = data.get('partial', False)
     # print(message_id[:20], provider)
     if not user_id:
         print("No User id")
@@ -106,6 +112,7 @@ def get_dashboard_data():
 
     # 4. Asynchronous Polling for Analysis Result
     max_retries = 25
+    full_analysis_requested = False
     for _ in range(max_retries):
         current_message_doc = inbox_conversations_collection.find_one(
             {'conv_id': conv_id, 'messages.message_id': message_id},
@@ -124,6 +131,14 @@ def get_dashboard_data():
                     'provider': current_message.get('provider')
                 }
                 conduct_analysis(user_id, conv_id, msg_doc)
+            elif analysis_data.get('history_pass'):
+                # Only summarized as thread history so far; run the full analysis now that it is opened.
+                if not full_analysis_requested:
+                    conduct_analysis(user_id, conv_id, {
+                        'message_id': current_message.get('message_id'),
+                        'provider': current_message.get('provider')
+                    })
+                    full_analysis_requested = True
             else:
                 # print("Else clause")
                 if analysis_data.get('completed'):
@@ -135,6 +150,22 @@ def get_dashboard_data():
                         "preferences": preferences,
                         'summary': analysis_data.get('summary', ''),
                         'category': analysis_data.get('category', ''),
+                        'replies': analysis_data.get('replies', []),
+                        # Replies not generated yet: the add-in asks /replies when they are needed.
+                        'replies_deferred': bool(analysis_data.get('replies_deferred')) and not analysis_data.get('replies')
+                    })
+                ready = analysis_data.get('ready') or {}
+                # Partial results once the mail is known to be clean and another field is ready
+                if partial and ready.get('spam') and len(ready) > 1 and \
+                        not analysis_data.get('is_spam') and not analysis_data.get('is_malicious'):
+                    return jsonify({
+                        "status": "partial",
+                        "ready": ready,
+                        "preferences": preferences,
+                        "importance_score": analysis_data.get('importance_score'),
+                        "importance_description": analysis_data.get('importance_description'),
+                        'summary': analysis_data.get('summary', ''),
+                        'category': analysis_data.get('category', ''),
                         'replies': analysis_data.get('replies', [])
                     })
 
@@ -169,6 +200,16 @@ def not_malicious():
             {"message.message_id": message_id}
         ]
     )
+    # Later authenticated mails from this sender to this mailbox skip the spam check (utils/sender_reputation.py).
+    conv_doc = inbox_conversations_collection.find_one(
+        {'conv_id': conv_id, 'email_address': user_email, 'messages.message_id': message_id},
+        {'_id': 0, 'messages.$': 1})
+    address_key, _ = reputation_keys(conv_doc['messages'][0].get('sender') if conv_doc else None)
+    if address_key:
+        sender_reputation_collection.update_one(
+            {'_id': address_key},
+            {'$addToSet': {CLEAN_FOR: user_email}, '$set': {'updated_at': datetime.now(timezone.utc)}},
+            upsert=True)
     msg_doc = {
         'message_id': message_id,
         'email_provider': data.get('platform')
@@ -207,6 +248,7 @@ def save_preferences():
         {'$set': update_data},
         upsert=True
     )
+    preference_cache.invalidate(user_id)
     print(f"Preferences saved for user {user_id}: {update_data}")
 
     return jsonify({
@@ -359,6 +401,47 @@ def get_emails():
     })
 
 
+@add_on_bp.route('/replies', methods=['POST'])
+def get_replies():
+    """
+    Reply suggestions of an analysed mail, generated on first request (utils/lazy_replies.py).
+    Returns 'pending' while they are generated, and 'failed' with 'retry_after' (seconds)
+    for REPLY_RETRY_BACKOFF after a failed generation; they are also pushed on the
+    'analysis:<user_email>' channel when ANALYSIS_PUSH_REDIS_URL is set.
+    """
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+
+    data = request.get_json()
+    user_id = data.get('user_id')
+    message_id = (data.get('message_id') or '').replace('/', '-').replace('+', '_')
+    conv_id = (data.get('conv_id') or '').replace('/', '-').replace('+', '_')
+    if not user_id or not message_id or not conv_id:
+        return jsonify({"status": "error", "message": "user_id, conv_id and message_id are required"}), 400
+
+    conv_doc = inbox_conversations_collection.find_one(
+        {'conv_id': conv_id, 'email_address': user_id, 'messages.message_id': message_id},
+        {'_id': 0, 'messages.$': 1})
+    if not conv_doc:
+        return jsonify({"status": "error", "message": "Message not found"}), 404
+    analysis_data = conv_doc['messages'][0].get('analysis') or {}
+    if analysis_data.get('replies'):
+        return jsonify({"status": "success", "replies": analysis_data['replies']})
+    if analysis_data.get('is_spam') or analysis_data.get('is_malicious'):
+        return jsonify({"status": "success", "replies": []})
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    failed_at = analysis_data.get('replies_failed_at')
+    if failed_at and failed_at >= now - timedelta(seconds=Config.REPLY_RETRY_BACKOFF):
+        # The last generation failed; the add-in can ask again after the back-off.
+        return jsonify({"status": "failed", "retry_after": int(
+            (failed_at + timedelta(seconds=Config.REPLY_RETRY_BACKOFF) - now).total_seconds()) + 1})
+    started_at = analysis_data.get('replies_started_at')
+    if analysis_data.get('completed') and (
+            started_at is None or started_at < now - timedelta(seconds=Config.REPLY_CLAIM_TIMEOUT)):
+        request_replies(conv_id, message_id, user_id, ON_DEMAND)
+    return jsonify({"status": "pending"})
+
+
 @add_on_bp.route('/trigger_analysis/<string:conv_id>/<string:message_id>/<string:user_id>/<string:analysis_type>', methods=['POST'])
 def trigger_analysis(conv_id, message_id, user_id, analysis_type):
     """
@@ -615,54 +698,6 @@ def get_latest_message_with_aggregation(conversation_id, email_address):
     return {}
 
 
-GEMINI_RESPONSE_SCHEMA = {
-    "type": "OBJECT",
-    "properties": {
-        "sensitive_data": {
-            "type": "OBJECT",
-            "properties": {
-                "has_sensitive_data": {"type": "boolean"},
-                "comment": {"type": "string"}
-            },
-            "required": ["has_sensitive_data", "comment"]
-        },
-        "attachments": {
-            "type": "OBJECT",
-            "properties": {
-                "has_missing_attachments": {"type": "boolean"},
-                "comment": {"type": "string"}
-            },
-            "required": ["has_missing_attachments", "comment"]
-        },
-        "grammatical_errors": {
-            "type": "OBJECT",
-            "properties": {
-                "has_errors": {"type": "boolean"},
-                "comment": {"type": "string"}
-            },
-            "required": ["has_errors", "comment"]
-        },
-        "best_practices": {
-            "type": "OBJECT",
-            "properties": {
-                "is_not_followed": {"type": "boolean"},
-                "comment": {"type": "string"}
-            },
-            "required": ["is_not_followed", "comment"]
-        },
-        "spelling_mistakes": {
-            "type": "OBJECT",
-            "properties": {
-                "has_mistakes": {"type": "boolean"},
-                "comment": {"type": "string"}
-            },
-            "required": ["has_mistakes", "comment"]
-        }
-    },
-    "required": ["sensitive_data", "attachments", "grammatical_errors", "best_practices", "spelling_mistakes"]
-}
-
-
 @add_on_bp.route('/validate_outgoing', methods=['POST'])
 def validate_outgoing():
     # print("********************Validating Outgoing Mail*********************")
@@ -694,16 +729,7 @@ def validate_outgoing():
         # print(email_data['sender'])
 
         prompt = (
-            f"Analyze the following email and return a JSON object based on the schema. "
-            f"The analysis should cover four key areas: sensitive data, missing attachments, grammatical/spelling issues, and general business etiquette.\n\n"
-            f"Provide a True/False result for each condition. If an issue is found (e.g., True), provide a clear and concise description of the error in Japanese within 200 characters. If no issue is found (e.g., False), provide a brief explanatory comment in Japanese.\n\n"
-            f"**Instructions:**\n"
-            f"- **Sensitive Data:** Check the email body and subject for any Personally Identifiable Information (PII) or other sensitive content. **Exclude the email signature from this check, as it is considered personal information that is always present and acceptable.**\n"
-            f"- **Missing Attachments:** Based on the body content (e.g., phrases like 'see attached file'), determine if an attachment is mentioned but not present in the provided list. Assume the provided 'attachments' list contains the names of all files.\n"
-            f"- **Grammar & Spelling:** Identify all grammatical and spelling errors. Be sure to check recipient names against previous email data for consistency.\n"
-            f"- **Japanese Business Etiquette:** Evaluate if the email follows standard Japanese business etiquette, including appropriate use of honorifics (e.g., `様` and `さん`), formal language (`keigo`), and a respectful tone. \n\n"
-            f"**Output Format (JSON)**:\n"
-            f"{json.dumps(GEMINI_RESPONSE_SCHEMA, indent=2)}\n\n"
+            VALIDATE_OUTGOING.prefix +
             f"**Email Data:**\n"
             f"Subject: {subject}\n"
             f"Body:\n{body}\n"
@@ -736,7 +762,7 @@ def validate_outgoing():
                     f"Previous Email BCC: {', '.join(previous_email_bcc)}\n\n"
                 )
         response = call_gemini_api_structured_output(
-            prompt, GEMINI_RESPONSE_SCHEMA)
+            prompt, VALIDATE_OUTGOING.response_schema)
 
         msg_doc = {
             'email_address': email_address,
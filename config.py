@@ -7,6 +7,19 @@ class Config:
     # Flask application settings
     SECRET_KEY = os.getenv('FLASK_SECRET_KEY', 'your-default-flask-secret-key')
     GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', "gemini_api_key")
+    GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', 8))  # Requests in flight per event loop
+    GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', 300))
+    # Point at scripts/fake_gemini_server.py (e.g. http://127.0.0.1:8085/v1beta) to run offline
+    GEMINI_API_BASE_URL = os.getenv('GEMINI_API_BASE_URL', 'https://generativelanguage.googleapis.com/v1beta')
+    # Static prompt prefixes (severity rules) are uploaded once as Gemini cached content
+    GEMINI_CONTEXT_CACHE = os.getenv('GEMINI_CONTEXT_CACHE', 'true').lower() == 'true'
+    GEMINI_CONTEXT_CACHE_TTL = int(os.getenv('GEMINI_CONTEXT_CACHE_TTL', 3600))  # Seconds
+    # Model cascade for spam / importance / category calls (utils/model_router.py)
+    GEMINI_FAST_MODEL = os.getenv('GEMINI_FAST_MODEL', 'gemini-2.0-flash-lite')
+    GEMINI_STRONG_MODEL = os.getenv('GEMINI_STRONG_MODEL', 'gemini-2.5-flash')
+    MODEL_ROUTER_MIN_CONFIDENCE = float(os.getenv('MODEL_ROUTER_MIN_CONFIDENCE', 0.75))  # exp(avgLogprobs) of the fast answer
+    MODEL_ROUTER_ESCALATE_SCORE = 60  # Importance scores from the high band up are confirmed by the strong model
+    MODEL_ROUTER_REPORT_EVERY = 100  # Log the escalation stats every N routed calls
 
     # MongoDB Configuration
     MONGO_URI = os.getenv('MONGO_URI')
@@ -17,6 +30,8 @@ class Config:
     MONGO_DRAFT_MESSAGES_COLLECTION = os.getenv('MONGO_DRAFT_MESSAGES_COLLECTION', 'draft_messages_collection')
     MONGO_SENT_MESSAGES_COLLECTION = os.getenv('MONGO_SENT_MESSAGES_COLLECTION', 'sent_messages_collection')
     MONGO_PREFERENCES_COLLECTION = os.getenv('MONGO_PREFERENCES_COLLECTION', 'user_preferences')
+    MONGO_SENDER_REPUTATION_COLLECTION = os.getenv('MONGO_SENDER_REPUTATION_COLLECTION', 'sender_reputation')
+    MONGO_SHARED_ANALYSES_COLLECTION = os.getenv('MONGO_SHARED_ANALYSES_COLLECTION', 'shared_analyses')
 
     # Google OAuth 2.0 Configuration (for Gmail Add-on & Pub/Sub)
     GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
@@ -43,6 +58,57 @@ class Config:
     MS_GRAPH_WEBHOOK_NOTIFICATION_URL = os.getenv('MS_GRAPH_WEBHOOK_NOTIFICATION_URL') # URL where Graph sends notifications
     MS_GRAPH_WEBHOOK_EXPIRATION_MINUTES = 10070 # Max value for subscription (42300 minutes = 29 days)
     MS_GRAPH_CLIENT_STATE = "jdhfg78e5t34ktjr09erjte"
+
+    # Local first-pass triage (scripts/train_triage_model.py writes the model)
+    TRIAGE_MODEL_PATH = os.getenv('TRIAGE_MODEL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files', 'triage_model.npz'))
+    TRIAGE_SKIP_CONFIDENCE = float(os.getenv('TRIAGE_SKIP_CONFIDENCE', 0.9))  # Below this the mail goes to Gemini as usual
+
+    # Header rules (utils/header_rules.py): sender / Return-Path domains of newsletter senders
+    NEWSLETTER_DOMAINS = [d.strip().lower() for d in os.getenv(
+        'NEWSLETTER_DOMAINS',
+        'mcsv.net,mcdlv.net,rsgsv.net,sendgrid.net,createsend.com,mktomail.com,hubspotemail.net,'
+        'mailjet.com,cuenote.jp,bme.jp,mail.rakuten.co.jp,mag2.com'
+    ).split(',') if d.strip()]
+
+    # Analysis planning (utils/analysis_plan.py): user preferences are cached per process
+    PREFERENCES_CACHE_TTL = int(os.getenv('PREFERENCES_CACHE_TTL', 300))
+
+    # Reply suggestions on demand (utils/lazy_replies.py)
+    LAZY_REPLIES = os.getenv('LAZY_REPLIES', 'true').lower() == 'true'
+    REPLY_PREFETCH_MIN_SCORE = int(os.getenv('REPLY_PREFETCH_MIN_SCORE', 70))  # Importance from which replies are prefetched
+    REPLY_PREFETCH_MIN_ANSWERED = 3  # Mails sent to a sender before their mails get prefetched replies
+    REPLY_PREFETCH_WINDOW_DAYS = 90
+    REPLY_CLAIM_TIMEOUT = 300  # Seconds before a stuck reply generation can be started again
+    REPLY_RETRY_BACKOFF = 600  # Seconds before a failed reply generation is tried again
+
+    # Sender reputation (utils/sender_reputation.py)
+    REPUTATION_MIN_VERDICTS = int(os.getenv('REPUTATION_MIN_VERDICTS', 20))  # Unanimous verdicts needed to skip the spam LLM call
+    REPUTATION_SAMPLE_RATE = float(os.getenv('REPUTATION_SAMPLE_RATE', 0.05))  # Share still checked by the LLM to catch drift
+    REPUTATION_CACHE_TTL = int(os.getenv('REPUTATION_CACHE_TTL', 300))
+
+    # Near-duplicate mails (utils/near_duplicate.py) reuse the analysis of a recent original
+    NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv('NEAR_DUPLICATE_MAX_DISTANCE', 3))  # SimHash bits; must stay below the 4 LSH bands
+    NEAR_DUPLICATE_WINDOW_HOURS = int(os.getenv('NEAR_DUPLICATE_WINDOW_HOURS', 72))
+    NEAR_DUPLICATE_MAX_CANDIDATES = 20
+
+    # Cross-mailbox deduplication (utils/shared_analysis.py)
+    SHARED_ANALYSIS_CLAIM_TIMEOUT = int(os.getenv('SHARED_ANALYSIS_CLAIM_TIMEOUT', 900))  # Seconds before another mailbox takes over a claim
+
+    # Rolling conversation summary (utils/conversation_summary.py)
+    ROLLING_SUMMARY_SEGMENT_MESSAGES = 8  # Messages folded into the running text before it is frozen as a segment
+    ROLLING_SUMMARY_MAX_SEGMENTS = 4  # More frozen segments than this are merged into one
+
+    # Start the chosen analyses together with the spam check (utils/speculation.py)
+    SPECULATIVE_ANALYSIS = os.getenv('SPECULATIVE_ANALYSIS', 'false').lower() == 'true'
+
+    # Partial analysis results are pushed on 'analysis:<user_email>' when set (utils/progress.py)
+    ANALYSIS_PUSH_REDIS_URL = os.getenv('ANALYSIS_PUSH_REDIS_URL')
+
+    # Helpdesk critical-mail alerts (Teams workflow webhook)
+    HELPDESK_ADDRESS = os.getenv('HELPDESK_ADDRESS', 'helpdesk@ffp.co.jp')
+    TEAMS_ALERT_WEBHOOK_URL = os.getenv('TEAMS_ALERT_WEBHOOK_URL', "https://prod-07.japaneast.logic.azure.com:443/workflows/7846e0ca56c44bd7a1b2aeb34ac6a4da/triggers/manual/paths/invoke?api-version=2016-06-01&sp=%2Ftriggers%2Fmanual%2Frun&sv=1.0&sig=-TVc0SuSMCleLgFr2QrR2us-Jbe81poMuU3QhWHbnFo")
+    TEAMS_ALERT_MIN_SCORE = 70
+
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
     CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
     # CELERY_ACCEPT_CONTENT = ['json']
@@ -52,6 +118,34 @@ class Config:
     CELERY_INCLUDE = ['workers.tasks']
     # CELERY_WORKER_POOL = os.getenv('CELERY_WORKER_POOL', 'fork')
 
+    # Attachment OCR (scanned PDFs)
+    OCR_MAX_PAGES = int(os.getenv('OCR_MAX_PAGES', 20))  # Image pages OCR'd per document
+    OCR_CONCURRENCY = int(os.getenv('OCR_CONCURRENCY', 4))  # Concurrent Gemini OCR calls per document
+    OCR_RENDER_WORKERS = int(os.getenv('OCR_RENDER_WORKERS', 4))  # 1 renders in-thread
+    OCR_TARGET_PIXELS = 2000  # Long edge of a rendered page in pixels
+    OCR_MIN_DPI = 100
+    OCR_MAX_DPI = 300
+    OCR_BLANK_INK_RATIO = 0.002  # Pages with less ink than this are treated as blank
+
+    # Spreadsheet extraction (xlsx/csv are streamed row by row up to these caps)
+    SPREADSHEET_MAX_ROWS = int(os.getenv('SPREADSHEET_MAX_ROWS', 5000))
+    SPREADSHEET_MAX_TOKENS = int(os.getenv('SPREADSHEET_MAX_TOKENS', 60000))
+
+    # Attachment summarization (map-reduce over token-budgeted chunks)
+    ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', 25 * 1024 * 1024))
+    ATTACHMENT_SPILL_BYTES = int(os.getenv('ATTACHMENT_SPILL_BYTES', 4 * 1024 * 1024))  # Larger attachments are decoded to a temp file
+    SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', 6000))  # Input budget per map call
+    SUMMARY_MAX_CHUNKS = int(os.getenv('SUMMARY_MAX_CHUNKS', 12))  # Map calls per attachment
+    SUMMARY_REDUCE_FAN_IN = 6  # Partial summaries merged per reduce call
+
+    # Prompt token budgets (estimated locally, see utils/token_utils.py)
+    PROMPT_MAX_TOKENS = int(os.getenv('PROMPT_MAX_TOKENS', 12000))  # Whole prompt
+    PROMPT_HEADER_TOKENS = 200  # Sender / subject
+    PROMPT_BODY_TOKENS = int(os.getenv('PROMPT_BODY_TOKENS', 6000))
+    PROMPT_ATTACHMENT_TOKENS = 2000  # All attachment summaries together
+    PROMPT_HISTORY_TOKENS = 1500  # Previous conversation summary
+    PROMPT_PREVIOUS_MESSAGES_TOKENS = 8000  # Raw history text sent for summarization
+
     # Validate essential environment variables
     REQUIRED_VARS = [
         'SECRET_KEY', 'GEMINI_API_KEY', 'MONGO_URI', 'MONGO_DB_NAME',
@@ -11,10 +11,11 @@ inbox_conversations_collection = None
 draft_messages_collection = None
 preferences_collection = None
 sent_messages_collection = None
+sender_reputation_collection = None
 
 def init_db():
     """Initializes the MongoDB connection and global collection objects."""
-    global client, db, users_collection, inbox_messages_collection, draft_messages_collection, sent_messages_collection, preferences_collection, inbox_conversations_collection
+    global client, db, users_collection, inbox_messages_collection, draft_messages_collection, sent_messages_collection, preferences_collection, inbox_conversations_collection, sender_reputation_collection
     try:
         client = MongoClient(Config.MONGO_URI)
         db = client[Config.MONGO_DB_NAME]
@@ -24,7 +25,12 @@ def init_db():
         draft_messages_collection = db[Config.MONGO_DRAFT_MESSAGES_COLLECTION]
         sent_messages_collection = db[Config.MONGO_SENT_MESSAGES_COLLECTION]
         preferences_collection = db[Config.MONGO_PREFERENCES_COLLECTION]
+        sender_reputation_collection = db[Config.MONGO_SENDER_REPUTATION_COLLECTION]
         inbox_conversations_collection.create_index([("conv_id", ASCENDING)], unique=True)
+        # LSH band lookup for near-duplicate mails (utils/near_duplicate.py)
+        inbox_conversations_collection.create_index([("email_address", ASCENDING), ("messages.fingerprint.bands", ASCENDING)])
+        # Recent outgoing mails of a user (utils/lazy_replies.py)
+        draft_messages_collection.create_index([("email_address", ASCENDING), ("_id", ASCENDING)])
         # print(preferences_collection)
         print("Connected to MongoDB successfully!")
     except Exception as e:
@@ -7,6 +7,8 @@ db = client[Config.MONGO_DB_NAME]
 users_collection_async = db[Config.MONGO_USERS_COLLECTION]
 inbox_conversations_collection_async = db[Config.MONGO_INBOX_CONVERSATIONS_COLLECTION]
 preferences_collection_async = db[Config.MONGO_PREFERENCES_COLLECTION]
+sender_reputation_collection_async = db[Config.MONGO_SENDER_REPUTATION_COLLECTION]
+shared_analyses_collection_async = db[Config.MONGO_SHARED_ANALYSES_COLLECTION]
 
 
 # def get_db_client():
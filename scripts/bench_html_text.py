@@ -0,0 +1,135 @@
+"""
+Benchmarks mail HTML-to-text conversion: the previous BeautifulSoup (html.parser)
+paths against the single-pass lxml engine in utils/html_text.py.
+
+Usage:
+    python scripts/bench_html_text.py CORPUS_DIR [--repeat N]
+
+CORPUS_DIR holds mail bodies as .html/.htm files or raw .eml files (the text/html
+part is used). Without a corpus a small set of generated Japanese business mails is used.
+"""
+import argparse
+import email
+import os
+import re
+import sys
+import time
+from email import policy
+
+from bs4 import BeautifulSoup, NavigableString
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.html_text import parse_mail_html  # noqa: E402
+
+
+def load_corpus(corpus_dir):
+    bodies = []
+    for root, _, files in os.walk(corpus_dir):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.lower().endswith(('.html', '.htm')):
+                with open(path, 'rb') as f:
+                    bodies.append(f.read().decode('utf-8', errors='ignore'))
+            elif name.lower().endswith('.eml'):
+                with open(path, 'rb') as f:
+                    msg = email.message_from_binary_file(f, policy=policy.default)
+                part = msg.get_body(preferencelist=('html',))
+                if part is not None:
+                    bodies.append(part.get_content())
+    return bodies
+
+
+def generated_corpus():
+    paragraph = (
+        '<p>いつも大変お世話になっております。株式会社サンプル営業部の山田でございます。</p>'
+        '<p>先日ご依頼いただきました見積書につきまして、添付のとおりお送りいたします。'
+        'ご不明な点がございましたら、お気軽にお問い合わせください。</p>'
+        '<table><tr><td>品名</td><td>数量</td><td>単価</td></tr>'
+        '<tr><td>部品A</td><td>100</td><td>1,200円</td></tr></table>'
+    )
+    signature = (
+        '<div>━━━━━━━━━━━━━━━━━━━━<br>株式会社サンプル 営業部<br>山田 太郎<br>'
+        'TEL: 03-1234-5678<br><img src="cid:image001.png@01DA0000" alt="会社ロゴ"></div>'
+    )
+    quote = (
+        '<div class="gmail_quote gmail_quote_container"><div class="gmail_attr">'
+        '2024年5月1日(水) 9:00 佐藤 花子 &lt;sato@example.co.jp&gt;:<br></div>'
+        '<blockquote class="gmail_quote">' + paragraph * 3 + '</blockquote></div>'
+    )
+    outlook_quote = (
+        '<hr><div id="divRplyFwdMsg" dir="ltr"><b>差出人:</b> 佐藤 花子<br>'
+        '<b>送信日時:</b> 2024年5月1日 9:00<br><b>件名:</b> 見積のご依頼</div>' + paragraph * 3
+    )
+    head = '<html><head><meta charset="utf-8"><style>p{margin:0}</style></head><body>'
+    return [
+        head + paragraph * n + signature + q + '</body></html>'
+        for n in (1, 3, 10) for q in ('', quote, outlook_quote)
+    ]
+
+
+def bs4_outlook(html_content):
+    """Previous Outlook path: uniqueBody parsed twice (text, then CID regex over str(soup))."""
+    soup = BeautifulSoup(html_content, 'html.parser')
+    lines = [line for line in soup.get_text().splitlines() if line.strip()]
+    soup = BeautifulSoup(html_content, 'html.parser')
+    cids = set(re.findall(r'src="cid:(.*?)"', str(soup)))
+    return "\n".join(lines), cids
+
+
+def bs4_gmail(html_content):
+    """Previous Gmail path: alt/br find_all passes, then the quote split."""
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for img_tag in soup.find_all('img', alt=True):
+        img_tag.replace_with('[image: ' + img_tag['alt'] + ']')
+    for br_tag in soup.find_all('br'):
+        br_tag.replace_with('\n')
+    first_quote_div = soup.find('div', class_='gmail_quote gmail_quote_container')
+    if first_quote_div:
+        new_content = ""
+        for element in first_quote_div.previous_siblings:
+            if isinstance(element, NavigableString):
+                new_content = str(element) + new_content
+            else:
+                new_content = element.get_text().strip() + new_content
+        return new_content, first_quote_div.get_text().strip()
+    return re.sub(r'\s+', ' ', soup.get_text(separator=' ')).strip(), ""
+
+
+def lxml_single_pass(html_content):
+    parsed = parse_mail_html(html_content)
+    return parsed.text, parsed.quoted_text, parsed.cids
+
+
+def bench(label, func, bodies, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for body in bodies:
+            func(body)
+    elapsed = time.perf_counter() - start
+    mails = len(bodies) * repeat
+    print(f"{label:<28} {mails / elapsed:10.1f} mails/s  {elapsed * 1000 / mails:8.3f} ms/mail")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus_dir', nargs='?', help='Directory of .html/.htm/.eml mail bodies')
+    parser.add_argument('--repeat', type=int, default=20, help='Passes over the corpus')
+    args = parser.parse_args()
+
+    bodies = load_corpus(args.corpus_dir) if args.corpus_dir else generated_corpus()
+    if not bodies:
+        print(f"No .html/.htm/.eml files found in {args.corpus_dir}")
+        return
+    total_bytes = sum(len(b.encode('utf-8')) for b in bodies)
+    print(f"{len(bodies)} mails, {total_bytes / 1024:.1f} KiB, {args.repeat} passes\n")
+
+    outlook = bench('bs4 Outlook (2 parses)', bs4_outlook, bodies, args.repeat)
+    gmail = bench('bs4 Gmail (find_all)', bs4_gmail, bodies, args.repeat)
+    single = bench('lxml single pass', lxml_single_pass, bodies, args.repeat)
+    print(f"\nSpeed-up vs Outlook path: {outlook / single:.1f}x, vs Gmail path: {gmail / single:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
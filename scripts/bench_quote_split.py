@@ -0,0 +1,97 @@
+"""
+Measures the quoted-reply splitter in utils/message_parsing.py: accuracy on a labelled
+corpus, prompt tokens saved per message and throughput, compared with the previous
+Gmail-only English "On Mon, Jan 1, 2024" regex.
+
+Usage:
+    python scripts/bench_quote_split.py [CORPUS] [--repeat N]
+
+CORPUS is a JSON file of {"name", "body", "expected_new"} cases (default:
+scripts/corpus/quote_split.json) or a directory of plain-text .txt mail bodies.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.message_parsing import extract_email_thread, find_quote_start  # noqa: E402
+from utils.token_utils import estimate_tokens  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus', 'quote_split.json')
+LEGACY_PATTERN = re.compile(r"\n+On\s+[A-Za-z]{3},\s+[A-Za-z]{3}\s+\d{1,2},\s+\d{4}.*$", re.MULTILINE)
+
+
+def legacy_split(body):
+    match = LEGACY_PATTERN.search(body)
+    if not match:
+        return body.strip(), ""
+    return body[:match.start()].strip(), body[match.start():].strip()
+
+
+def load_corpus(path):
+    if os.path.isdir(path):
+        cases = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.txt'):
+                with open(os.path.join(path, name), encoding='utf-8', errors='ignore') as f:
+                    cases.append({'name': name, 'body': f.read()})
+        return cases
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='?', default=DEFAULT_CORPUS)
+    parser.add_argument('--repeat', type=int, default=2000, help='Passes over the corpus for the timing')
+    args = parser.parse_args()
+
+    cases = load_corpus(args.corpus)
+    if not cases:
+        print(f"No cases found in {args.corpus}")
+        return
+
+    print(f"{'case':<32} {'marker':<17} {'tokens':>6} {'new':>6} {'saved':>6}  ok")
+    total_before = total_after = total_legacy = 0
+    correct = labelled = 0
+    for case in cases:
+        body = case['body']
+        new, _ = extract_email_thread(body)
+        legacy_new, _ = legacy_split(body)
+        _, marker = find_quote_start(body)
+        before, after = estimate_tokens(body), estimate_tokens(new)
+        total_before += before
+        total_after += after
+        total_legacy += estimate_tokens(legacy_new)
+        status = ''
+        if 'expected_new' in case:
+            labelled += 1
+            ok = new == case['expected_new'].strip()
+            correct += ok
+            status = 'yes' if ok else 'NO'
+        saved = 100 * (before - after) / before if before else 0
+        print(f"{case['name'][:32]:<32} {marker or '-':<17} {before:>6} {after:>6} {saved:>5.0f}%  {status}")
+
+    print()
+    if labelled:
+        print(f"Accuracy: {correct}/{labelled}")
+    print(f"Body tokens: {total_before} -> {total_after} "
+          f"({100 * (total_before - total_after) / total_before:.1f}% saved; "
+          f"previous English-only regex: {100 * (total_before - total_legacy) / total_before:.1f}%)")
+
+    bodies = [case['body'] for case in cases]
+    for label, func in (('previous regex', legacy_split), ('table-driven splitter', extract_email_thread)):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for body in bodies:
+                func(body)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<22} {len(bodies) * args.repeat / elapsed:12.0f} messages/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Checks the Gemini context cache (utils/gemini_cache.py) offline against
+scripts/fake_gemini_server.py: the rules prefix is uploaded once and then referenced,
+a changed template gets its own cache, and an expired or deleted cache is replaced
+with the prompt sent inline in the meantime.
+
+Usage:
+    python scripts/check_context_cache.py
+"""
+import asyncio
+import os
+import sys
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+from fake_gemini_server import make_app  # noqa: E402
+from utils.gemini_cache import gemini_context_cache, call_gemini_template_structured  # noqa: E402
+from utils.prompt_templates import IMPORTANCE_ANALYSIS, PromptTemplate  # noqa: E402
+
+MODEL = "gemini-2.0-flash"
+MAIL = {'sender': 'buyer@example.co.jp', 'subject': 'EDI停止のご連絡', 'body': '本日朝よりEDI通信が全取引先で停止しています。'}
+
+
+def calls(app, kind):
+    return [r for r in app['requests'] if r[0] == kind]
+
+
+async def analyse(template=IMPORTANCE_ANALYSIS):
+    return await call_gemini_template_structured(template, template.builder().add_mail(MAIL), model=MODEL)
+
+
+async def main():
+    app = make_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    Config.GEMINI_API_BASE_URL = f"http://127.0.0.1:{port}/v1beta"
+    Config.GEMINI_CONTEXT_CACHE = True
+
+    try:
+        for _ in range(3):
+            assert await analyse() is not None
+        generated = calls(app, 'generateContent')
+        assert len(calls(app, 'createCachedContent')) == 1, "prefix should be uploaded once"
+        assert all(r[2].get('cachedContent') for r in generated), "every call should reference the cache"
+        assert all(IMPORTANCE_ANALYSIS.prefix not in r[2]['contents'][0]['parts'][0]['text'] for r in generated)
+        print("3 calls, 1 upload, rules prefix never sent inline: ok")
+
+        changed = PromptTemplate(IMPORTANCE_ANALYSIS.name, IMPORTANCE_ANALYSIS.version + 1,
+                                 IMPORTANCE_ANALYSIS.prefix + "追加ルール\n", IMPORTANCE_ANALYSIS.response_schema)
+        await analyse(changed)
+        assert len(calls(app, 'createCachedContent')) == 2
+        assert len(set(app['caches'])) == 2
+        print("changed rules get a new cache: ok")
+
+        app['caches'].clear()  # Expired or deleted on the server side
+        before = len(calls(app, 'generateContent'))
+        assert await analyse() is not None
+        retried = calls(app, 'generateContent')[before:]
+        assert len(retried) == 2 and 'cachedContent' not in retried[1][2]
+        await analyse()
+        assert len(calls(app, 'createCachedContent')) == 3
+        print("lost cache: falls back inline, then re-uploads: ok")
+
+        gemini_context_cache._entries.clear()
+        Config.GEMINI_CONTEXT_CACHE = False
+        await analyse()
+        assert 'cachedContent' not in calls(app, 'generateContent')[-1][2]
+        print("GEMINI_CONTEXT_CACHE=false sends the prompt inline: ok")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
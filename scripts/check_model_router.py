@@ -0,0 +1,79 @@
+"""
+Checks the model cascade (utils/model_router.py) offline against
+scripts/fake_gemini_server.py: confident valid answers stay on the fast model, and
+schema failures, low confidence, node policies and strong_first go to the strong model.
+
+Usage:
+    python scripts/check_model_router.py
+"""
+import asyncio
+import os
+import sys
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+from fake_gemini_server import make_app  # noqa: E402
+from utils.model_router import ModelRouter  # noqa: E402
+from utils.prompt_templates import SPAM_CHECK, SUMMARIZE_AND_CATEGORIZE  # noqa: E402
+
+FAST, STRONG = Config.GEMINI_FAST_MODEL, Config.GEMINI_STRONG_MODEL
+MAIL = {'sender': 'shop@example.com', 'subject': 'セールのお知らせ', 'body': '今週末限定のセールを開催します。'}
+
+
+def models_called(app, since):
+    return [r[1] for r in app['requests'][since:] if r[0] == 'generateContent']
+
+
+async def route(app, router, node, template, **kwargs):
+    since = len(app['requests'])
+    result = await router.call(node, template, template.builder().add_mail(MAIL), **kwargs)
+    return result, models_called(app, since)
+
+
+async def main():
+    app = make_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    Config.GEMINI_API_BASE_URL = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/v1beta"
+    Config.GEMINI_CONTEXT_CACHE = False
+    router = ModelRouter(FAST, STRONG, min_confidence=0.75, report_every=0)
+
+    try:
+        _, models = await route(app, router, 'summarize_and_categorize', SUMMARIZE_AND_CATEGORIZE)
+        assert models == [FAST], models
+        print("confident valid answer stays on the fast model: ok")
+
+        app['answers'][FAST] = {'summary': 'x', 'category': 'セール'}  # Not in the enum
+        result, models = await route(app, router, 'summarize_and_categorize', SUMMARIZE_AND_CATEGORIZE)
+        assert models == [FAST, STRONG] and result['category'] == 'エラー', (models, result)
+        print("schema failure escalates: ok")
+
+        del app['answers'][FAST]
+        app['avg_logprobs'][FAST] = -1.0
+        _, models = await route(app, router, 'summarize_and_categorize', SUMMARIZE_AND_CATEGORIZE)
+        assert models == [FAST, STRONG], models
+        print("low confidence escalates: ok")
+
+        app['avg_logprobs'].clear()
+        app['answers'][FAST] = {'is_spam': True, 'is_malicious': False}
+        _, models = await route(app, router, 'spam_check', SPAM_CHECK,
+                                escalate_if=lambda r: r['is_spam'] or r['is_malicious'])
+        assert models == [FAST, STRONG], models
+        print("policy (spam positive) escalates: ok")
+
+        _, models = await route(app, router, 'spam_check', SPAM_CHECK, strong_first=True)
+        assert models == [STRONG], models
+        print("strong_first skips the fast model: ok")
+
+        print("\n" + "\n".join(router.report()))
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
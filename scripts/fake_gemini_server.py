@@ -0,0 +1,133 @@
+"""
+A local stand-in for the Gemini REST API, for running the analysis code offline.
+
+Implements generateContent (answers with a dummy object matching responseSchema, or
+plain text) and cachedContents create/get/delete with TTL expiry. Token counts are
+estimated locally. Requests are recorded in `app['requests']` for checks; canned
+answers and avgLogprobs can be set per model in `app['answers']` / `app['avg_logprobs']`.
+
+Usage:
+    python scripts/fake_gemini_server.py [--port 8085]
+    GEMINI_API_BASE_URL=http://127.0.0.1:8085/v1beta python ...
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.token_utils import estimate_tokens  # noqa: E402
+
+MIN_CACHE_TOKENS = 0  # Gemini refuses caches below a model-specific size; set to emulate that
+
+
+def dummy_for_schema(schema):
+    kind = (schema.get('type') or 'STRING').upper()
+    if kind == 'OBJECT':
+        return {name: dummy_for_schema(prop) for name, prop in schema.get('properties', {}).items()}
+    if kind == 'ARRAY':
+        return [dummy_for_schema(schema.get('items', {}))]
+    if kind in ('NUMBER', 'INTEGER'):
+        return 0
+    if kind == 'BOOLEAN':
+        return False
+    return schema['enum'][0] if schema.get('enum') else 'fake'
+
+
+def _text_of(contents):
+    return ''.join(part.get('text', '') for content in contents for part in content.get('parts', []))
+
+
+def _live_cache(app, name):
+    entry = app['caches'].get(name)
+    if entry and entry['expires_at'] > time.time():
+        return entry
+    app['caches'].pop(name, None)
+    return None
+
+
+async def generate_content(request):
+    model = request.match_info['model']
+    payload = await request.json()
+    request.app['requests'].append(('generateContent', model, payload))
+    cached_tokens = 0
+    if payload.get('cachedContent'):
+        entry = _live_cache(request.app, payload['cachedContent'])
+        if entry is None:
+            return web.json_response({'error': {'code': 403, 'status': 'PERMISSION_DENIED',
+                                                'message': 'CachedContent not found (or permission denied)'}}, status=403)
+        if entry['model'] != f"models/{model}":
+            return web.json_response({'error': {'code': 400, 'message': 'Model mismatch with cached content'}}, status=400)
+        cached_tokens = entry['tokens']
+    prompt_tokens = estimate_tokens(_text_of(payload.get('contents', []))) + cached_tokens
+    config = payload.get('generationConfig', {})
+    if model in request.app['answers']:
+        answer = request.app['answers'][model]
+        text = answer if isinstance(answer, str) else json.dumps(answer, ensure_ascii=False)
+    elif config.get('responseSchema'):
+        text = json.dumps(dummy_for_schema(config['responseSchema']), ensure_ascii=False)
+    else:
+        text = 'fake response'
+    avg_logprobs = request.app['avg_logprobs'].get(model, -0.05)
+    return web.json_response({
+        'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]},
+                        'finishReason': 'STOP', 'avgLogprobs': avg_logprobs}],
+        'usageMetadata': {'promptTokenCount': prompt_tokens, 'cachedContentTokenCount': cached_tokens},
+    })
+
+
+async def create_cache(request):
+    payload = await request.json()
+    request.app['requests'].append(('createCachedContent', payload.get('model'), payload))
+    tokens = estimate_tokens(_text_of(payload.get('contents', [])))
+    if tokens < MIN_CACHE_TOKENS:
+        return web.json_response({'error': {'code': 400, 'message': f'Cached content is too small: {tokens} tokens'}}, status=400)
+    ttl = float(payload.get('ttl', '3600s').rstrip('s'))
+    name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+    request.app['caches'][name] = {'model': payload.get('model'), 'tokens': tokens, 'expires_at': time.time() + ttl}
+    return web.json_response({'name': name, 'model': payload.get('model'), 'displayName': payload.get('displayName'),
+                              'usageMetadata': {'totalTokenCount': tokens}})
+
+
+async def get_cache(request):
+    name = f"cachedContents/{request.match_info['cache_id']}"
+    entry = _live_cache(request.app, name)
+    if entry is None:
+        return web.json_response({'error': {'code': 404, 'message': 'Not found'}}, status=404)
+    return web.json_response({'name': name, 'model': entry['model'], 'usageMetadata': {'totalTokenCount': entry['tokens']}})
+
+
+async def delete_cache(request):
+    name = f"cachedContents/{request.match_info['cache_id']}"
+    request.app['caches'].pop(name, None)
+    return web.json_response({})
+
+
+def make_app():
+    app = web.Application()
+    app['caches'] = {}
+    app['requests'] = []
+    app['answers'] = {}
+    app['avg_logprobs'] = {}
+    app.router.add_post('/v1beta/models/{model}:generateContent', generate_content)
+    app.router.add_post('/v1beta/cachedContents', create_cache)
+    app.router.add_get('/v1beta/cachedContents/{cache_id}', get_cache)
+    app.router.add_delete('/v1beta/cachedContents/{cache_id}', delete_cache)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8085)
+    args = parser.parse_args()
+    web.run_app(make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
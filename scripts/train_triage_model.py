@@ -0,0 +1,102 @@
+"""
+Trains the local triage model (utils/triage_model.py) from the categories Gemini
+assigned to past mails, reports hold-out accuracy and how many mails would skip the
+reply/summary calls at the configured confidence, and writes a versioned .npz model.
+
+Usage:
+    python scripts/train_triage_model.py [--output files/triage_model.npz] [--limit N]
+    python scripts/train_triage_model.py --input labelled.jsonl
+
+Labels come from inbox_conversations_collection (messages.analysis.category; mails
+flagged as spam or malicious are labelled スパム). Mails whose category was set by the
+triage model itself are left out. --input reads {"sender", "subject", "body",
+"category"} JSON lines instead.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+from utils.triage_model import TriageModel, SKIP_CATEGORIES, DEFAULT_DIM, mail_text  # noqa: E402
+
+
+def load_from_mongo(limit):
+    from database import inbox_conversations_collection
+    pipeline = [
+        {'$unwind': '$messages'},
+        {'$match': {'messages.analysis.category': {'$exists': True, '$ne': None},
+                    'messages.analysis.triage.skip': {'$ne': True}}},
+        {'$project': {'_id': 0, 'sender': '$messages.sender', 'subject': '$messages.subject',
+                      'body': '$messages.body', 'analysis': '$messages.analysis'}},
+    ]
+    if limit:
+        pipeline.append({'$limit': limit})
+    mails = []
+    for doc in inbox_conversations_collection.aggregate(pipeline):
+        analysis = doc.pop('analysis')
+        doc['category'] = 'スパム' if analysis.get('is_spam') or analysis.get('is_malicious') else analysis['category']
+        mails.append(doc)
+    return mails
+
+
+def load_from_jsonl(path, limit):
+    with open(path, encoding='utf-8') as f:
+        mails = [json.loads(line) for line in f if line.strip()]
+    return mails[:limit] if limit else mails
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', help='JSON lines of labelled mails instead of MongoDB')
+    parser.add_argument('--output', default=Config.TRIAGE_MODEL_PATH)
+    parser.add_argument('--limit', type=int, default=0)
+    parser.add_argument('--dim', type=int, default=DEFAULT_DIM)
+    parser.add_argument('--epochs', type=int, default=8)
+    parser.add_argument('--holdout', type=float, default=0.2, help='Share of mails kept for evaluation')
+    parser.add_argument('--min-count', type=int, default=5, help='Categories with fewer mails are dropped')
+    args = parser.parse_args()
+
+    mails = load_from_jsonl(args.input, args.limit) if args.input else load_from_mongo(args.limit)
+    labels = [m['category'] for m in mails]
+    kept = {c for c in set(labels) if labels.count(c) >= args.min_count}
+    mails = [m for m in mails if m['category'] in kept]
+    if len(kept) < 2:
+        print(f"Not enough labelled mails to train ({len(mails)} mails, categories: {sorted(kept)})")
+        return
+    print(f"{len(mails)} labelled mails, {len(kept)} categories")
+
+    order = np.random.default_rng(0).permutation(len(mails))
+    split = int(len(mails) * (1 - args.holdout))
+    train = [mails[i] for i in order[:split]]
+    test = [mails[i] for i in order[split:]]
+
+    start = time.perf_counter()
+    model = TriageModel.fit([mail_text(m) for m in train], [m['category'] for m in train],
+                            dim=args.dim, epochs=args.epochs)
+    print(f"Trained on {len(train)} mails in {time.perf_counter() - start:.1f}s")
+
+    if test:
+        start = time.perf_counter()
+        predictions = [model.predict(m) for m in test]
+        per_mail = (time.perf_counter() - start) / len(test)
+        correct = sum(p[0] == m['category'] for p, m in zip(predictions, test))
+        skipped = [(p, m) for p, m in zip(predictions, test)
+                   if p[0] in SKIP_CATEGORIES and p[1] >= Config.TRIAGE_SKIP_CONFIDENCE]
+        skip_correct = sum(m['category'] in SKIP_CATEGORIES for _, m in skipped)
+        print(f"Hold-out accuracy: {correct}/{len(test)} ({100 * correct / len(test):.1f}%)")
+        print(f"Skipped at confidence {Config.TRIAGE_SKIP_CONFIDENCE}: {len(skipped)}/{len(test)} mails, "
+              f"{skip_correct}/{len(skipped) or 1} really promotion/no-reply")
+        print(f"Scoring: {per_mail * 1e6:.0f} us per mail")
+
+    model.save(args.output)
+    print(f"Saved triage model {model.version} to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
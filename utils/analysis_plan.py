@@ -0,0 +1,95 @@
+"""
+Plans which analyses a new mail gets before its Celery task is queued.
+
+The pipeline used to run every analysis for every mail, whatever the user had enabled
+in /save_preferences. plan_choices() starts from the full set and applies each filter
+in PLAN_FILTERS; a filter gets (email_address, msg_doc, choices) and returns the
+choices it keeps, so per-mailbox rules or triage hints are added as further filters.
+Every analysis left out saves one LLM call, counted in AnalysisPlanner.
+"""
+import time
+
+import database
+from config import Config
+
+# Analysis choice -> preference flag (preferences_collection, see /save_preferences)
+PREFERENCE_FLAGS = {
+    'importance_score': 'enable_importance_generation',
+    'replies': 'enable_reply_generation',
+    'summary_and_category': 'enable_summarization_and_categorization',
+}
+
+
+class PreferenceCache:
+    """Per-user preference documents with a small in-process TTL cache."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # user_id -> (doc or None, valid until)
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        doc = database.preferences_collection.find_one({'user_id': user_id}, {'_id': 0})
+        self._entries[user_id] = (doc, time.time() + self.ttl)
+        return doc
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+
+preference_cache = PreferenceCache(Config.PREFERENCES_CACHE_TTL)
+
+
+def by_preferences(email_address, msg_doc, choices):
+    """Drops the analyses the user disabled; users without preferences get everything."""
+    prefs = preference_cache.get(email_address)
+    if prefs is None:
+        return choices
+    # Same reading as /dashboard_data: a flag missing from a stored document is off.
+    return [c for c in choices if c not in PREFERENCE_FLAGS or prefs.get(PREFERENCE_FLAGS[c], False)]
+
+
+PLAN_FILTERS = [by_preferences]
+
+
+class AnalysisPlanner:
+    """Applies PLAN_FILTERS and counts the LLM calls they avoid (one per analysis left out)."""
+
+    def __init__(self, report_every):
+        self.report_every = report_every
+        self.plans = 0
+        self.avoided_calls = 0
+        self.avoided = {}  # choice -> times left out
+
+    def plan(self, email_address, msg_doc, requested):
+        choices = list(requested)
+        for plan_filter in PLAN_FILTERS:
+            try:
+                choices = plan_filter(email_address, msg_doc, choices)
+            except Exception as e:
+                # A broken filter must not cost the user their analysis.
+                print(f"Analysis plan filter {plan_filter.__name__} failed, ignoring it: {e}")
+        skipped = [c for c in requested if c not in choices]
+        self.plans += 1
+        self.avoided_calls += len(skipped)
+        for choice in skipped:
+            self.avoided[choice] = self.avoided.get(choice, 0) + 1
+        if self.report_every and self.plans % self.report_every == 0:
+            print(f"Analysis planning stats: {self.report()}")
+        return choices
+
+    def report(self):
+        if not self.plans:
+            return "no plans"
+        per_choice = ', '.join(f"{c}: {n}" for c, n in sorted(self.avoided.items())) or 'none'
+        return f"{self.plans} plans, {self.avoided_calls} LLM calls avoided ({per_choice})"
+
+
+analysis_planner = AnalysisPlanner(Config.MODEL_ROUTER_REPORT_EVERY)
+
+
+def plan_choices(email_address, msg_doc, requested):
+    """The analyses to run for a mail, out of `requested`."""
+    return analysis_planner.plan(email_address, msg_doc, requested)
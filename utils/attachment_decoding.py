@@ -0,0 +1,142 @@
+import base64
+import io
+import mmap
+import os
+import tempfile
+
+from config import Config
+
+# Base64 characters decoded per step when spilling to disk (a multiple of 4).
+_DECODE_CHUNK_CHARS = 4 * 1024 * 1024
+_URLSAFE_TO_STANDARD = str.maketrans('-_', '+/')
+
+
+class AttachmentContent:
+    """
+    Lazily decoded attachment content.
+
+    The base64 string from the Mongo document is only decoded when a parser needs the
+    bytes. Payloads up to ATTACHMENT_SPILL_BYTES are decoded once into memory; larger
+    ones are decoded in chunks into a temporary file that is memory-mapped, so the
+    worker never holds more than one chunk of decoded data on the heap.
+    Use it as a context manager so the temporary file is removed.
+    """
+
+    def __init__(self, encoded=None, urlsafe=False, raw=None):
+        self._encoded = encoded
+        self._urlsafe = urlsafe
+        self._data = raw
+        self._path = None
+        self._file = None
+        self._mmap = None
+
+    @classmethod
+    def for_provider(cls, encoded, email_provider):
+        """Gmail returns base64url, Outlook standard base64."""
+        return cls(encoded, urlsafe='gmail' in email_provider)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    @property
+    def estimated_size(self):
+        """Decoded size, computed from the encoded length without decoding."""
+        if self._data is not None:
+            return len(self._data)
+        if self._mmap is not None:
+            return len(self._mmap)
+        return len(self._encoded or '') * 3 // 4
+
+    def _decode(self, encoded):
+        padded = encoded + '=' * (-len(encoded) % 4)
+        if self._urlsafe:
+            return base64.urlsafe_b64decode(padded)
+        return base64.b64decode(padded)
+
+    def _materialize(self):
+        if self._data is not None or self._mmap is not None:
+            return
+        encoded = self._encoded or ''
+        if self.estimated_size <= Config.ATTACHMENT_SPILL_BYTES:
+            self._data = self._decode(encoded)
+            return
+        fd, self._path = tempfile.mkstemp(prefix='mailai-attachment-')
+        self._file = os.fdopen(fd, 'w+b')
+        for start in range(0, len(encoded), _DECODE_CHUNK_CHARS):
+            self._file.write(self._decode(encoded[start:start + _DECODE_CHUNK_CHARS]))
+        self._file.flush()
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def head(self, size=8192):
+        """Returns the first `size` decoded bytes, decoding only that prefix."""
+        if self._data is not None:
+            return self._data[:size]
+        if self._mmap is not None:
+            return self._mmap[:size]
+        encoded = self._encoded or ''
+        return self._decode(encoded[:-(-size // 3) * 4])[:size]
+
+    @property
+    def data(self):
+        """In-memory bytes, or None when the content was spilled to disk."""
+        self._materialize()
+        return self._data
+
+    @property
+    def path(self):
+        """Path of the spilled temporary file, or None for in-memory content."""
+        self._materialize()
+        return self._path
+
+    @property
+    def buffer(self):
+        """Zero-copy view of the decoded bytes (over the mmap for spilled content)."""
+        self._materialize()
+        return memoryview(self._mmap if self._mmap is not None else self._data)
+
+    def open(self):
+        """
+        Returns a new seekable binary stream the caller may close. io.BytesIO shares
+        the bytes object without copying; spilled content is read from the temp file.
+        """
+        self._materialize()
+        if self._path is not None:
+            return open(self._path, 'rb')
+        return io.BytesIO(self._data)
+
+    def standard_base64(self):
+        """
+        Standard base64 for Gemini inlineData. The stored string is forwarded as is
+        (base64url only has its alphabet swapped), so there is no decode/encode round-trip.
+        """
+        if self._encoded is None:
+            return base64.b64encode(self._data).decode('ascii')
+        if not self._urlsafe:
+            return self._encoded
+        encoded = self._encoded.translate(_URLSAFE_TO_STANDARD)
+        return encoded + '=' * (-len(encoded) % 4)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._path:
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+            self._path = None
+
+
+def as_attachment_content(content):
+    """Wraps raw bytes so the extractors can treat every input as AttachmentContent."""
+    if isinstance(content, AttachmentContent):
+        return content
+    return AttachmentContent(raw=bytes(content))
@@ -1,5 +1,7 @@
 import io
-import pandas as pd
+import csv
+import codecs
+from openpyxl import load_workbook
 from PyPDF2 import PdfReader # pip install pypdf2
 import fitz
 from docx import Document
@@ -10,8 +12,13 @@ import json
 import asyncio
 import requests
 from config import Config
+from utils.token_utils import estimate_tokens
+from utils.attachment_decoding import as_attachment_content
 from pprint import pprint
 import threading
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 # async def extract_text_from_attachment(file_bytes, filename):
 #     """
 #     Extracts plain text from various attachment file types.
@@ -96,27 +103,29 @@ import threading
 #         return None
     
 
-async def extract_text_from_attachment(file_bytes, filename):
+async def extract_text_from_attachment(file_bytes, filename, file_extension=None):
     """
     Extracts plain text from various attachment file types using asyncio.to_thread for blocking calls.
+    `file_bytes` may be raw bytes or an AttachmentContent that is decoded lazily.
+    `file_extension` overrides the filename extension (e.g. the kind found by triage).
     """
-    file_extension = filename.split('.')[-1].lower()
+    file_extension = (file_extension or filename.split('.')[-1]).lower()
     print("File Extensions", file_extension)
+    content = as_attachment_content(file_bytes)
 
     # Use a helper function for the synchronous work
     def _run_in_thread():
         # --- This is where all the synchronous, blocking code goes ---
         if file_extension == 'txt':
-            return file_bytes.decode('utf-8', errors='ignore')
+            return str(content.buffer, 'utf-8', errors='ignore')
         elif file_extension == 'docx':
-            document = Document(io.BytesIO(file_bytes))
+            with content.open() as stream:
+                document = Document(stream)
             return "\n".join(p.text for p in document.paragraphs)
         elif file_extension == 'xlsx':
-            excel_data = pd.read_excel(io.BytesIO(file_bytes))
-            return excel_data.to_string(index=False, header=True)
+            return _extract_text_from_xlsx(content)
         elif file_extension == 'csv':
-            csv_data = pd.read_csv(io.StringIO(file_bytes.decode('utf-8')))
-            return csv_data.to_string(index=False, header=True)
+            return _extract_text_from_csv(content)
         else:
             return None
 
@@ -130,35 +139,18 @@ async def extract_text_from_attachment(file_bytes, filename):
             return None
     elif file_extension in ['pdf']:
         print("File Type: PDF")
-        text_parts = []
         try:
-            reader = await asyncio.to_thread(PdfReader(io.BytesIO(file_bytes)))
-            text = "".join(page.extract_text() or "" for page in reader.pages)
-            if text.strip():
-                print("Extracted Text", text)
-                return text
-        except Exception:
-            pass
-        print("File Type: PDF(File contains Image)")
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        for page in doc:
-            pg_text = page.get_text("text")
-            if pg_text.strip():
-                text_parts.append(pg_text)
-            else:
-                pix = page.get_pixmap(dpi=300)
-                img_bytes = pix.tobytes(output="png")
-                ocr_text = await _extract_text_from_image_with_gemini(img_bytes, "png")
-                if ocr_text:
-                    text_parts.append(ocr_text)
-            # print(text_parts)
-            return "\n".join(text_parts)
+            return await _extract_text_from_pdf(content, filename)
+        except Exception as e:
+            print(f"Error extracting text from PDF {filename}: {e}")
+            return None
 
     elif file_extension in ['jpg', 'jpeg', 'png']:
         print("File Type: Image")
         # This part of the code is already async and can be awaited directly
         try:
-            return await _extract_text_from_image_with_gemini(file_bytes, file_extension)
+            return await _extract_text_from_image_with_gemini(
+                content.head(), file_extension, base64_data=content.standard_base64())
         except Exception as e:
             print(f"Error extracting text from image {filename}: {e}")
             return None
@@ -166,6 +158,261 @@ async def extract_text_from_attachment(file_bytes, filename):
         print(f"Unsupported file type for text extraction: {filename}")
         return None
 
+class _RowBudget:
+    """
+    Collects spreadsheet rows as tab-separated lines until the row or token cap is hit.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.rows = 0
+        self.tokens = 0
+        self.truncated = False
+
+    def add(self, line, is_data_row=True):
+        line_tokens = estimate_tokens(line)
+        if (is_data_row and self.rows >= Config.SPREADSHEET_MAX_ROWS) or \
+                self.tokens + line_tokens > Config.SPREADSHEET_MAX_TOKENS:
+            self.truncated = True
+            return False
+        self.lines.append(line)
+        self.tokens += line_tokens
+        if is_data_row:
+            self.rows += 1
+        return True
+
+    def text(self):
+        if self.truncated:
+            self.lines.append(f"[truncated after {self.rows} rows]")
+        return "\n".join(self.lines)
+
+
+def _row_to_line(values):
+    """
+    Formats one row as compact tab-separated text. Empty trailing cells are dropped
+    and tabs/newlines inside cells are flattened. Returns '' for an empty row.
+    """
+    cells = ["" if value is None else " ".join(str(value).split()) for value in values]
+    while cells and not cells[-1]:
+        cells.pop()
+    return "\t".join(cells)
+
+
+def _extract_text_from_xlsx(content):
+    """
+    Streams every sheet of a workbook row by row (openpyxl read-only mode), so memory
+    stays around one row regardless of the workbook size.
+    """
+    stream = content.open()
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    budget = _RowBudget()
+    try:
+        for sheet in workbook.worksheets:
+            if not budget.add(f"## {sheet.title}", is_data_row=False):
+                break
+            for values in sheet.iter_rows(values_only=True):
+                line = _row_to_line(values)
+                if line and not budget.add(line):
+                    break
+            if budget.truncated:
+                break
+    finally:
+        workbook.close()
+        stream.close()
+    return budget.text()
+
+
+def _detect_csv_encoding(head):
+    """Japanese CSV exports are often Shift_JIS (cp932); anything that isn't valid UTF-8 is read as cp932."""
+    try:
+        # An incremental decoder tolerates a multi-byte character cut off at the end of the sample.
+        codecs.getincrementaldecoder('utf-8-sig')().decode(head, final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'cp932'
+
+
+def _extract_text_from_csv(content):
+    """
+    Streams a CSV file row by row with the csv module and emits tab-separated text.
+    """
+    encoding = _detect_csv_encoding(content.head(65536))
+    budget = _RowBudget()
+    with io.TextIOWrapper(content.open(), encoding=encoding, errors='replace', newline='') as stream:
+        for values in csv.reader(stream):
+            line = _row_to_line(values)
+            if line and not budget.add(line):
+                break
+    return budget.text()
+
+
+# Pages darker than this grey level count as "ink" when checking for blank pages.
+_INK_TABLE = bytes(1 if value < 200 else 0 for value in range(256))
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def _adaptive_dpi(page_rect):
+    """
+    Picks a render DPI so the long edge of the page lands near OCR_TARGET_PIXELS.
+    Small slips and receipts get a higher DPI, large drawings a lower one.
+    """
+    long_edge_inches = max(page_rect.width, page_rect.height) / 72
+    if long_edge_inches <= 0:
+        return Config.OCR_MAX_DPI
+    dpi = int(Config.OCR_TARGET_PIXELS / long_edge_inches)
+    return max(Config.OCR_MIN_DPI, min(Config.OCR_MAX_DPI, dpi))
+
+
+def _is_blank_page(page):
+    """
+    Renders a small greyscale thumbnail and treats the page as blank when almost
+    no pixels carry ink.
+    """
+    thumb = page.get_pixmap(dpi=24, colorspace=fitz.csGRAY)
+    samples = thumb.samples
+    if not samples:
+        return True
+    ink_ratio = samples.translate(_INK_TABLE).count(1) / len(samples)
+    return ink_ratio < Config.OCR_BLANK_INK_RATIO
+
+
+def _open_pdf(pdf_source):
+    """Opens a PDF from a file path (spilled attachments) or from in-memory bytes."""
+    if isinstance(pdf_source, str):
+        return fitz.open(pdf_source, filetype="pdf")
+    return fitz.open(stream=pdf_source, filetype="pdf")
+
+
+def _render_pdf_pages(pdf_source, page_numbers):
+    """
+    Worker-side renderer. Opens its own copy of the document and returns
+    (page_number, png_bytes or None) for every requested page; None marks a blank page.
+    Spilled attachments are passed as a path, so workers don't receive a copy of the bytes.
+    """
+    rendered = []
+    with _open_pdf(pdf_source) as doc:
+        for page_number in page_numbers:
+            page = doc[page_number]
+            if _is_blank_page(page):
+                rendered.append((page_number, None))
+                continue
+            pix = page.get_pixmap(dpi=_adaptive_dpi(page.rect))
+            rendered.append((page_number, pix.tobytes(output="png")))
+    return rendered
+
+
+def _get_render_pool():
+    """
+    Lazily creates the process pool used for page rendering. MuPDF is not thread-safe,
+    so rendering is spread over processes. Returns None when a pool can't be started
+    (e.g. inside a daemonic worker), in which case pages are rendered in a thread.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None and Config.OCR_RENDER_WORKERS > 1:
+            try:
+                _render_pool = ProcessPoolExecutor(
+                    max_workers=Config.OCR_RENDER_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"))
+            except Exception as e:
+                print(f"Could not start the PDF render pool, rendering in-thread: {e}")
+                _render_pool = False
+        return _render_pool or None
+
+
+async def _render_pages_in_pool(pdf_source, page_numbers):
+    """
+    Splits the pages into one batch per worker and renders them in parallel.
+    """
+    pool = _get_render_pool()
+    if pool is None:
+        return await asyncio.to_thread(_render_pdf_pages, pdf_source, page_numbers)
+
+    worker_count = min(Config.OCR_RENDER_WORKERS, len(page_numbers))
+    batches = [page_numbers[i::worker_count] for i in range(worker_count)]
+    loop = asyncio.get_running_loop()
+    try:
+        results = await asyncio.gather(*[
+            loop.run_in_executor(pool, _render_pdf_pages, pdf_source, batch)
+            for batch in batches
+        ])
+    except Exception as e:
+        print(f"PDF render pool failed, rendering in-thread: {e}")
+        return await asyncio.to_thread(_render_pdf_pages, pdf_source, page_numbers)
+    return [item for batch in results for item in batch]
+
+
+def _pdf_source(content):
+    """Path for spilled content (MuPDF reads pages from the file on demand), bytes otherwise."""
+    return content.path or content.data
+
+
+def _read_pdf_text_layers(content):
+    """
+    Returns the text layer of every page ('' for pages that only contain images).
+    Falls back to PyPDF2 when MuPDF can't open the file.
+    """
+    try:
+        with _open_pdf(_pdf_source(content)) as doc:
+            return [page.get_text("text") for page in doc]
+    except Exception as e:
+        print(f"MuPDF could not open the PDF, falling back to PyPDF2: {e}")
+        with content.open() as stream:
+            reader = PdfReader(stream)
+            return [page.extract_text() or "" for page in reader.pages]
+
+
+async def _extract_text_from_pdf(content, filename):
+    """
+    Extracts text page by page. Pages with a text layer are read directly; the
+    remaining pages are rendered in a worker pool, blank and duplicate pages are
+    dropped, and up to OCR_MAX_PAGES pages are OCR'd concurrently with Gemini.
+    The result keeps the original page order.
+    """
+    page_texts = await asyncio.to_thread(_read_pdf_text_layers, content)
+    image_pages = [i for i, text in enumerate(page_texts) if not text.strip()]
+    if not image_pages:
+        return "\n".join(page_texts)
+
+    print(f"PDF {filename}: {len(image_pages)} of {len(page_texts)} pages have no text layer")
+    if len(image_pages) > Config.OCR_MAX_PAGES:
+        print(f"PDF {filename}: OCR limited to the first {Config.OCR_MAX_PAGES} image pages")
+        image_pages = image_pages[:Config.OCR_MAX_PAGES]
+
+    rendered = await _render_pages_in_pool(_pdf_source(content), image_pages)
+
+    # Identical pages (cover sheets, repeated forms) are OCR'd once.
+    pages_by_hash = {}
+    for page_number, png_bytes in rendered:
+        if png_bytes is None:
+            continue
+        digest = hashlib.blake2b(png_bytes, digest_size=16).digest()
+        pages_by_hash.setdefault(digest, (png_bytes, []))[1].append(page_number)
+
+    semaphore = asyncio.Semaphore(Config.OCR_CONCURRENCY)
+
+    async def _ocr_page(png_bytes):
+        async with semaphore:
+            return await _extract_text_from_image_with_gemini(png_bytes, "png")
+
+    unique_pages = list(pages_by_hash.values())
+    ocr_results = await asyncio.gather(
+        *[_ocr_page(png_bytes) for png_bytes, _ in unique_pages],
+        return_exceptions=True
+    )
+    for (_, page_numbers), ocr_text in zip(unique_pages, ocr_results):
+        if isinstance(ocr_text, Exception):
+            print(f"OCR failed for pages {page_numbers} of {filename}: {ocr_text}")
+            continue
+        for page_number in page_numbers:
+            page_texts[page_number] = ocr_text or ""
+
+    print(f"PDF {filename}: OCR'd {len(unique_pages)} unique pages "
+          f"({len(rendered) - sum(len(p) for _, p in unique_pages)} blank)")
+    return "\n".join(text for text in page_texts if text.strip())
+
+
 def _get_mime_type(file_extension):
     """
     Helper to get the correct MIME type for an image file extension.
@@ -178,17 +425,22 @@ def _get_mime_type(file_extension):
         return 'application/octet-stream' 
 
 
-async def _extract_text_from_image_with_gemini(image_bytes, file_extension):
+async def _extract_text_from_image_with_gemini(image_bytes, file_extension, base64_data=None):
     """
     Uses the Gemini API to perform OCR on an image and extract text.
+    When the caller already holds the image as standard base64 (`base64_data`),
+    `image_bytes` only needs to be the head of the file for MIME sniffing and the
+    encoded data is forwarded without re-encoding.
     """
     try:
         # print(type(image_bytes))
         
-        inferred_mime_type = magic.from_buffer(image_bytes, mime=True)
+        inferred_mime_type = magic.from_buffer(bytes(image_bytes[:8192]), mime=True)
         # print(inferred_mime_type)
-        base64_encoded_bytes = base64.b64encode(image_bytes)
-        base64_encoded_string = base64_encoded_bytes.decode('utf-8')
+        if base64_data is not None:
+            base64_encoded_string = base64_data
+        else:
+            base64_encoded_string = base64.b64encode(image_bytes).decode('utf-8')
         
         prompt = "Extract all text from the image. Do not add any extra commentary or formatting. Provide the raw text content."
         
@@ -217,7 +469,7 @@ async def _extract_text_from_image_with_gemini(image_bytes, file_extension):
         }
         model = "gemini-2.0-flash-lite"
         
-        apiUrl = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={Config.GEMINI_API_KEY}"
+        apiUrl = f"{Config.GEMINI_API_BASE_URL}/models/{model}:generateContent?key={Config.GEMINI_API_KEY}"
         
 
         headers = {'Content-Type': 'application/json'}
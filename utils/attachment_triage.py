@@ -0,0 +1,139 @@
+from config import Config
+
+# Triage actions, decided before an attachment body is downloaded.
+SKIP = 'skip'
+EXTRACT = 'extract'
+OCR = 'ocr'
+
+# Kinds understood by extract_text_from_attachment.
+EXTRACT_KINDS = {'txt', 'docx', 'xlsx', 'csv', 'pdf'}
+OCR_KINDS = {'jpg', 'jpeg', 'png'}
+
+# Kinds we know we can't read; these are never downloaded.
+SKIP_KINDS = {
+    'zip', '7z', 'rar', 'lzh', 'gz', 'tar', 'exe', 'dll', 'msi', 'bin',
+    'doc', 'xls', 'ppt', 'pptx', 'gif', 'bmp', 'tif', 'tiff', 'svg', 'webp', 'heic',
+    'ics', 'vcf', 'eml', 'msg', 'p7s', 'p7m', 'mp3', 'mp4', 'mov', 'wav', 'm4a',
+}
+
+CONTENT_TYPE_KINDS = {
+    'application/pdf': 'pdf',
+    'text/plain': 'txt',
+    'text/csv': 'csv',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
+    'image/png': 'png',
+    'image/jpeg': 'jpeg',
+    'image/jpg': 'jpeg',
+    'image/gif': 'gif',
+    'application/zip': 'zip',
+    'application/x-zip-compressed': 'zip',
+    'application/msword': 'doc',
+    'application/vnd.ms-excel': 'xls',
+    'text/calendar': 'ics',
+    'application/pkcs7-signature': 'p7s',
+    'application/x-pkcs7-signature': 'p7s',
+}
+
+# (signature, kind) checked against the first bytes of the file.
+MAGIC_SIGNATURES = [
+    (b'%PDF-', 'pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'doc'),  # Legacy OLE2 Office files
+    (b'Rar!', 'rar'),
+    (b'7z\xbc\xaf\x27\x1c', '7z'),
+    (b'\x1f\x8b', 'gz'),
+    (b'MZ', 'exe'),
+]
+
+# Bytes needed to sniff a file with sniff_kind.
+SNIFF_BYTES = 8192
+
+
+def _action_for_kind(kind):
+    if kind in EXTRACT_KINDS:
+        return EXTRACT
+    if kind in OCR_KINDS:
+        return OCR
+    return SKIP
+
+
+def _extension(name):
+    if not name or '.' not in name:
+        return None
+    return name.rsplit('.', 1)[-1].lower()
+
+
+def sniff_kind(head):
+    """
+    Identifies a file from its first bytes. Zip containers are told apart by the
+    part names stored in the local file headers ([Content_Types].xml, word/, xl/).
+    Returns None when the head doesn't match anything we know.
+    """
+    head = bytes(head[:SNIFF_BYTES])
+    for signature, kind in MAGIC_SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    if head.startswith(b'PK\x03\x04'):
+        if b'word/' in head:
+            return 'docx'
+        if b'xl/' in head:
+            return 'xlsx'
+        if b'ppt/' in head:
+            return 'pptx'
+        return 'zip'
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    return 'txt'
+
+
+def is_signature_image(attachment, body_cids=None):
+    """
+    Inline images embedded in the body (signature logos, banners) carry no content
+    for the analysis, so they are never fetched or OCR'd. Only an image whose
+    Content-ID is referenced by a cid: in the body HTML counts: providers give plain
+    attachments a Content-ID and isInline too, and those may be scans.
+    """
+    content_type = (attachment.get('contentType') or '').lower()
+    is_image = content_type.startswith('image/') or _extension(attachment.get('name')) in OCR_KINDS | {'gif', 'bmp'}
+    if not is_image:
+        return False
+    content_id = (attachment.get('contentId') or '').strip().strip('<>')
+    return bool(body_cids and content_id and content_id in body_cids)
+
+
+def triage_attachment(attachment, body_cids=None, head=None):
+    """
+    Decides from the attachment metadata whether it should be skipped, extracted or
+    OCR'd, without its content. `attachment` uses the stored attachment fields
+    (name, contentType, size, isInline, contentId).
+
+    Returns (action, kind). When the metadata is ambiguous and no `head` is given,
+    action is None: the caller should read the first SNIFF_BYTES bytes and call again.
+    """
+    size = attachment.get('size') or 0
+    if size > Config.ATTACHMENT_MAX_BYTES:
+        return SKIP, None
+    if is_signature_image(attachment, body_cids):
+        return SKIP, 'inline_image'
+
+    kind = _extension(attachment.get('name'))
+    if kind not in EXTRACT_KINDS | OCR_KINDS | SKIP_KINDS:
+        content_type = (attachment.get('contentType') or '').split(';')[0].strip().lower()
+        kind = CONTENT_TYPE_KINDS.get(content_type)
+
+    if head is not None:
+        sniffed = sniff_kind(head)
+        if sniffed and sniffed != 'txt':
+            # Magic bytes win over a misleading name or content type.
+            kind = sniffed
+        elif kind is None:
+            kind = sniffed
+    if kind is None:
+        return None, None
+    return _action_for_kind(kind), kind
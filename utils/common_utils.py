@@ -1,16 +1,56 @@
-from datetime import datetime
+from celery import chain
+from database import inbox_conversations_collection
 from workers.tasks import (
     run_analysis_agent_stateful
 )
+from utils.analysis_plan import plan_choices
+from utils.lazy_replies import defer_replies
 
-def conduct_analysis(email_address, thread_id, msg_doc):
-    print(f"Conducting analysis for {msg_doc.get('message_id')}")
+FULL_CHOICES = ['importance_score', 'replies', 'summary_and_category']
+
+
+def _analysis_signature(email_address, thread_id, msg_doc, history=False):
     email_data = {
         'user_email':email_address,
         'conv_id':thread_id,
         'msg_id':msg_doc.get('message_id'),
         'email_provider':msg_doc.get('provider')
     }
-    choices = ['importance_score', 'replies', 'summary_and_category']
-    thread_id = thread_id+"---"+msg_doc.get('message_id', '')
-    run_analysis_agent_stateful.delay(thread_id, email_data, choices)
\ No newline at end of file
+    if history:
+        email_data['history_pass'] = True
+    choices = ['summary_and_category'] if history else plan_choices(email_address, msg_doc, FULL_CHOICES)
+    if 'replies' in choices and defer_replies(email_address, msg_doc):
+        # Generated when the add-in asks for them (utils/lazy_replies.py).
+        choices = [c for c in choices if c != 'replies']
+        email_data['replies_deferred'] = True
+    return run_analysis_agent_stateful.si(thread_id+"---"+msg_doc.get('message_id', ''), email_data, choices)
+
+
+def conduct_analysis(email_address, thread_id, msg_doc):
+    print(f"Conducting analysis for {msg_doc.get('message_id')}")
+    _analysis_signature(email_address, thread_id, msg_doc).delay()
+
+
+def conduct_thread_analysis(email_address, thread_id, msg_docs, current_message_id):
+    """
+    Analyses a thread imported at once as one Celery chain, oldest message first, so
+    every message finds the summaries of its predecessors. Earlier messages without an
+    analysis only get a summary pass; the current message gets the full analysis.
+    Chains of different threads run in parallel.
+    """
+    current = next((m for m in msg_docs if m.get('message_id') == current_message_id), None)
+    if current is None:
+        return
+    conv = inbox_conversations_collection.find_one(
+        {'conv_id': thread_id, 'email_address': email_address},
+        {'_id': 0, 'messages.message_id': 1, 'messages.analysis.completed': 1}) or {}
+    analysed = {m.get('message_id') for m in conv.get('messages', []) if (m.get('analysis') or {}).get('completed')}
+    received = current.get('received_datetime')
+    history = sorted(
+        (m for m in msg_docs
+         if m.get('message_id') not in analysed and m.get('message_id') != current_message_id
+         and received and m.get('received_datetime') and m['received_datetime'] < received),
+        key=lambda m: m['received_datetime'])
+    print(f"Conducting analysis for {current_message_id} after {len(history)} earlier message(s) of its thread")
+    chain(*[_analysis_signature(email_address, thread_id, m, history=True) for m in history],
+          _analysis_signature(email_address, thread_id, current)).delay()
@@ -0,0 +1,172 @@
+"""
+Conversation-level rolling summary, kept on the conversation document:
+
+    rolling_summary: {
+        'segments': [{'text', 'count', 'through'}],  # Frozen summaries of older parts, oldest first
+        'text': str, 'count': int,                   # Running summary of the messages since the last segment
+        'through': datetime, 'last_message_id': str, # Newest message folded in
+        'message_ids': [str], 'folded': int,         # Every message folded in, and how many
+    }
+
+Each analysed message is folded in with one LLM call (running summary + the message's
+own summary). Every ROLLING_SUMMARY_SEGMENT_MESSAGES messages the running text is frozen
+as a segment, and more than ROLLING_SUMMARY_MAX_SEGMENTS segments are merged into one,
+so the stored summary stays bounded however long the thread gets. The summary is only
+read for a mail when every earlier analysed message of the thread has been folded in.
+"""
+from config import Config
+from database_async import inbox_conversations_collection_async
+from utils.gemini_utils import call_gemini_api
+from utils.prompt_builder import PRIORITY_BODY, PRIORITY_HISTORY
+from utils.prompt_templates import ROLLING_SUMMARY_UPDATE, ROLLING_SUMMARY_COMPACT
+from utils.transform_utils import convert_to_local_time
+
+
+FOLD_ATTEMPTS = 3  # Re-reads after losing the update to a concurrent fold
+
+
+def render(rolling):
+    """The summary of everything folded in so far, as read by the agent."""
+    if not rolling:
+        return ''
+    return '\n'.join(t for t in [s['text'] for s in rolling.get('segments', [])] + [rolling.get('text')] if t)
+
+
+def _naive(value):
+    return value.replace(tzinfo=None) if value is not None else None
+
+
+def _summarized_before(messages, received_datetime):
+    """Ids of the analysed messages (with a summary) received before `received_datetime`."""
+    before = _naive(received_datetime)
+    return {m['message_id'] for m in messages
+            if (m.get('analysis') or {}).get('summary') and m.get('received_datetime') is not None
+            and _naive(m['received_datetime']) < before}
+
+
+def _folded_ids(rolling, messages):
+    """The messages folded into `rolling`; summaries written before message_ids existed go by 'through'."""
+    if rolling.get('message_ids') is not None:
+        return set(rolling['message_ids'])
+    through = rolling.get('through')
+    if through is None:
+        return set()
+    return {m['message_id'] for m in messages if (m.get('analysis') or {}).get('summary')
+            and m.get('received_datetime') is not None and _naive(m['received_datetime']) <= through}
+
+
+def covers(rolling, messages, received_datetime):
+    """
+    Whether `rolling` summarizes exactly the thread before `received_datetime`: nothing
+    newer was folded in and no earlier analysed message is missing.
+    """
+    if not rolling or received_datetime is None or rolling.get('through') is None:
+        return False
+    if rolling['through'] >= _naive(received_datetime):
+        return False
+    return _summarized_before(messages, received_datetime) <= _folded_ids(rolling, messages)
+
+
+# Enough of every message to check what a rolling summary covers
+COVERAGE_PROJECTION = {'messages.message_id': 1, 'messages.received_datetime': 1, 'messages.analysis.summary': 1}
+
+
+async def previous_summary(conv_id, user_email, received_datetime):
+    """
+    The rolling summary when it covers exactly the messages before `received_datetime`
+    (i.e. the mail is the newest of its thread and no fold is missing), else None.
+    """
+    conv = await inbox_conversations_collection_async.find_one(
+        {'conv_id': conv_id, 'email_address': user_email},
+        {'_id': 0, 'rolling_summary': 1, **COVERAGE_PROJECTION})
+    rolling = (conv or {}).get('rolling_summary')
+    if not covers(rolling, (conv or {}).get('messages', []), received_datetime):
+        return None
+    return render(rolling)
+
+
+async def _update_text(text, received_datetime, summary):
+    newest = f"{convert_to_local_time(received_datetime).strftime('%Y-%m-%d %H:%M')}: {summary}"
+    if not text:
+        return summary
+    prompt = (
+        ROLLING_SUMMARY_UPDATE.builder()
+        .add(text, 'Running Summary', PRIORITY_HISTORY, Config.PROMPT_HISTORY_TOKENS)
+        .add(newest, 'Newest Mail Summary', PRIORITY_BODY, Config.PROMPT_HISTORY_TOKENS)
+        .build()
+    )
+    return await call_gemini_api(prompt)
+
+
+async def _compact(segments):
+    texts = '\n\n'.join(f"Part {i + 1}: {s['text']}" for i, s in enumerate(segments))
+    prompt = ROLLING_SUMMARY_COMPACT.builder().add(texts, 'Summaries', PRIORITY_HISTORY).build()
+    merged = await call_gemini_api(prompt)
+    return {'text': merged, 'count': sum(s['count'] for s in segments), 'through': segments[-1]['through']}
+
+
+async def fold_message(conv_id, user_email, msg_id, summary):
+    """
+    Folds an analysed message's summary into its conversation's rolling summary, once per
+    message. Messages that arrive out of order are folded too. The update is conditioned
+    on the fold count read, and a fold that loses to a concurrent one is recomputed from
+    the new summary, up to FOLD_ATTEMPTS times.
+    """
+    if not summary:
+        return
+    for _ in range(FOLD_ATTEMPTS):
+        try:
+            folded = await _fold_once(conv_id, user_email, msg_id, summary)
+        except Exception as e:
+            print(f"Error updating the rolling summary of {conv_id}: {e}")
+            return
+        if folded is not None:
+            return
+        print(f"Rolling summary of {conv_id} changed concurrently, folding message '{msg_id}' again")
+    print(f"Rolling summary of {conv_id} kept changing, message '{msg_id}' not folded in")
+
+
+async def _fold_once(conv_id, user_email, msg_id, summary):
+    """One read-update round; True when done (folded or nothing to do), None when the update lost."""
+    doc = await inbox_conversations_collection_async.find_one(
+        {'conv_id': conv_id, 'email_address': user_email, 'messages.message_id': msg_id},
+        {'_id': 0, 'rolling_summary': 1, **COVERAGE_PROJECTION,
+         'messages.previous_messages_summary': 1})
+    if not doc:
+        return True
+    messages = doc.get('messages', [])
+    message = next((m for m in messages if m.get('message_id') == msg_id), None)
+    received = message.get('received_datetime') if message else None
+    if received is None:
+        return True
+    received = _naive(received)
+    rolling = doc.get('rolling_summary')
+    if rolling:
+        message_ids = _folded_ids(rolling, messages)
+    else:
+        # A thread analysed before rolling summaries existed starts from the message's own history summary.
+        rolling = {'text': message.get('previous_messages_summary') or ''}
+        message_ids = _summarized_before(messages, received) if rolling['text'] else set()
+    if msg_id in message_ids:
+        return True
+    previous_folded = rolling.get('folded')
+    through = rolling.get('through')
+    text = await _update_text(rolling.get('text'), received, summary)
+    count = rolling.get('count', 0) + 1
+    segments = list(rolling.get('segments', []))
+    newest = received if through is None else max(through, received)
+    if count >= Config.ROLLING_SUMMARY_SEGMENT_MESSAGES:
+        segments.append({'text': text, 'count': count, 'through': newest})
+        text, count = '', 0
+    if len(segments) > Config.ROLLING_SUMMARY_MAX_SEGMENTS:
+        segments = [await _compact(segments)]
+    message_ids.add(msg_id)
+    # 'folded' is None both for a missing summary and for one written before the counter existed.
+    result = await inbox_conversations_collection_async.update_one(
+        {'conv_id': conv_id, 'email_address': user_email, 'rolling_summary.folded': previous_folded,
+         'rolling_summary.through': through},
+        {'$set': {'rolling_summary': {
+            'segments': segments, 'text': text, 'count': count, 'through': newest,
+            'last_message_id': msg_id if newest == received else rolling.get('last_message_id'),
+            'message_ids': sorted(message_ids), 'folded': (previous_folded or 0) + 1}}})
+    return True if result.modified_count else None
@@ -0,0 +1,102 @@
+import asyncio
+import time
+import weakref
+
+import aiohttp
+
+from config import Config
+from utils.gemini_utils import call_gemini_api_structured, GeminiCachedContentError, gemini_rate_limiter
+
+
+class GeminiContextCache:
+    """
+    Keeps the static prefix of a PromptTemplate (the severity rules) in Gemini's
+    cachedContents, so calls only send the mail-specific part of the prompt.
+
+    A cache is created per (template hash, model) and reused until shortly before its
+    TTL runs out; since the hash covers the prefix, a change to the rules gets a new
+    cache on first use and the old one simply expires. When Gemini refuses to cache a
+    prefix (e.g. below the model's minimum size) the template is sent inline and
+    caching is retried after FAILURE_BACKOFF seconds.
+    """
+
+    REFRESH_MARGIN = 60  # Seconds before expiry at which a cache is replaced
+    FAILURE_BACKOFF = 600
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # (hash, model) -> (cache name or None, valid until)
+        self._locks = weakref.WeakKeyDictionary()
+
+    def _lock(self):
+        loop = asyncio.get_running_loop()
+        lock = self._locks.get(loop)
+        if lock is None:
+            lock = self._locks[loop] = asyncio.Lock()
+        return lock
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.time():
+            return entry
+        return None
+
+    async def get(self, template, model):
+        """Returns the cachedContents name holding the template prefix, or None."""
+        if not Config.GEMINI_CONTEXT_CACHE or not template.prefix:
+            return None
+        key = (template.hash, model)
+        entry = self._lookup(key)
+        if entry is None:
+            async with self._lock():
+                entry = self._lookup(key)
+                if entry is None:
+                    entry = await self._create(template, model)
+                    self._entries[key] = entry
+        return entry[0]
+
+    def invalidate(self, template, model):
+        self._entries.pop((template.hash, model), None)
+
+    async def _create(self, template, model):
+        url = f"{Config.GEMINI_API_BASE_URL}/cachedContents?key={Config.GEMINI_API_KEY}"
+        payload = {
+            "model": f"models/{model}",
+            "displayName": f"{template.key} {template.hash}",
+            "contents": [{"role": "user", "parts": [{"text": template.prefix}]}],
+            "ttl": f"{self.ttl}s",
+        }
+        try:
+            async with gemini_rate_limiter, aiohttp.ClientSession() as session:
+                async with session.post(url, json=payload) as response:
+                    if response.status >= 400:
+                        print(f"Gemini context cache for '{template.key}' refused ({response.status}): {await response.text()}")
+                        return None, time.time() + self.FAILURE_BACKOFF
+                    data = await response.json()
+        except aiohttp.ClientError as e:
+            print(f"Error creating Gemini context cache for '{template.key}': {e}")
+            return None, time.time() + self.FAILURE_BACKOFF
+        tokens = data.get('usageMetadata', {}).get('totalTokenCount', 0)
+        print(f"Created Gemini context cache {data['name']} for '{template.key}' ({tokens} tokens, {model})")
+        return data['name'], time.time() + self.ttl - self.REFRESH_MARGIN
+
+
+gemini_context_cache = GeminiContextCache(Config.GEMINI_CONTEXT_CACHE_TTL)
+
+
+async def call_gemini_template_structured(template, builder, temp=0.3, model="gemini-2.5-flash", metadata=None):
+    """
+    Calls Gemini with a prompt built from template.builder(), using the template's
+    response schema. The static prefix is taken from the context cache when possible
+    and sent inline otherwise (including when the cache turns out to have expired).
+    """
+    cached_content = await gemini_context_cache.get(template, model)
+    if cached_content:
+        try:
+            return await call_gemini_api_structured(
+                builder.build(include_prefix=False), template.response_schema, temp, model,
+                cached_content=cached_content, metadata=metadata)
+        except GeminiCachedContentError as e:
+            print(f"Gemini context cache unusable, sending the prompt inline: {e}")
+            gemini_context_cache.invalidate(template, model)
+    return await call_gemini_api_structured(builder.build(), template.response_schema, temp, model, metadata=metadata)
@@ -1,11 +1,90 @@
 import requests
 import aiohttp
+import asyncio
 import json
+import weakref
+from contextvars import ContextVar
 from config import Config
+from utils.token_utils import estimate_tokens
 
 # Assuming you've installed aiohttp: pip install aiohttp
 
 
+class GeminiRateLimiter:
+    """
+    Shared async limiter for Gemini calls. Caps the number of requests in flight and
+    spaces request starts so at most `requests_per_minute` begin in any minute.
+    State is kept per event loop, so the limiter is safe to share between loops.
+    """
+
+    def __init__(self, max_concurrency, requests_per_minute):
+        self.max_concurrency = max_concurrency
+        self.min_interval = 60 / requests_per_minute if requests_per_minute else 0
+        self._states = weakref.WeakKeyDictionary()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._states.get(loop)
+        if state is None:
+            state = {'semaphore': asyncio.Semaphore(self.max_concurrency), 'next_start': 0.0}
+            self._states[loop] = state
+        return loop, state
+
+    async def __aenter__(self):
+        loop, state = self._state()
+        await state['semaphore'].acquire()
+        now = loop.time()
+        start_at = max(now, state['next_start'])
+        state['next_start'] = start_at + self.min_interval
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _, state = self._state()
+        state['semaphore'].release()
+        return False
+
+
+gemini_rate_limiter = GeminiRateLimiter(Config.GEMINI_MAX_CONCURRENCY, Config.GEMINI_REQUESTS_PER_MINUTE)
+
+
+class GeminiCachedContentError(Exception):
+    """The cachedContent referenced by a request has expired or was deleted."""
+
+
+def _refers_to_cache(error_text, cached_content):
+    """Whether a Gemini error body is about the cached content (expired, deleted, not found)."""
+    text = (error_text or '').lower()
+    return cached_content.lower() in text or 'cachedcontent' in text or 'cached content' in text
+
+
+class TokenMeter:
+    """
+    Counts the tokens of the Gemini calls made while it is set in `token_meter`. A call
+    is counted at its estimated prompt size when sent and corrected to the reported
+    total when the response arrives, so calls cancelled in flight still count.
+    """
+
+    __slots__ = ('calls', 'tokens')
+
+    def __init__(self):
+        self.calls = 0
+        self.tokens = 0
+
+    def sent(self, prompt):
+        estimate = estimate_tokens(prompt)
+        self.calls += 1
+        self.tokens += estimate
+        return estimate
+
+    def received(self, estimate, usage):
+        self.tokens += usage.get('totalTokenCount', estimate) - estimate
+
+
+token_meter = ContextVar('gemini_token_meter', default=None)
+
+
 # Making the function async is the best practice for API calls
 async def call_gemini_api(prompt, model="gemini-2.0-flash-lite"):
     """
@@ -16,7 +95,7 @@ async def call_gemini_api(prompt, model="gemini-2.0-flash-lite"):
         print("Error: GEMINI_API_KEY is not set in config.")
         return None
 
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={Config.GEMINI_API_KEY}"
+    api_url = f"{Config.GEMINI_API_BASE_URL}/models/{model}:generateContent?key={Config.GEMINI_API_KEY}"
     
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
@@ -35,9 +114,11 @@ async def call_gemini_api(prompt, model="gemini-2.0-flash-lite"):
         ]
     }
 
+    meter = token_meter.get()
+    estimate = meter.sent(prompt) if meter else 0
     try:
         # Use an async HTTP client (aiohttp) and a context manager
-        async with aiohttp.ClientSession() as session:
+        async with gemini_rate_limiter, aiohttp.ClientSession() as session:
             async with session.post(api_url, json=payload) as response:
                 response.raise_for_status() # Raises an exception for bad status codes
                 response_data = await response.json()
@@ -47,6 +128,8 @@ async def call_gemini_api(prompt, model="gemini-2.0-flash-lite"):
                 usage = response_data.get('usageMetadata', {})
                 prompt_token_count = usage.get('promptTokenCount', 0)
                 print(f"The prompt has {prompt_token_count} tokens.")
+                if meter:
+                    meter.received(estimate, usage)
 
                 if response_data and response_data.get('candidates'):
                     return response_data['candidates'][0]['content']['parts'][0]['text']
@@ -61,15 +144,19 @@ async def call_gemini_api(prompt, model="gemini-2.0-flash-lite"):
         return None
     
 
-async def call_gemini_api_structured(prompt, response_schema, temp=0.3, model="gemini-2.5-flash"):
+async def call_gemini_api_structured(prompt, response_schema, temp=0.3, model="gemini-2.5-flash", cached_content=None,
+                                     metadata=None):
     """
     Calls the Google Gemini API with the given prompt, requesting structured JSON output.
+    With cached_content (a "cachedContents/..." name), the cached prefix is prepended to
+    the prompt by Gemini; GeminiCachedContentError is raised if that cache is gone.
+    A `metadata` dict is filled with the candidate's avgLogprobs and finishReason.
     """
     if not Config.GEMINI_API_KEY:
         print("Error: GEMINI_API_KEY is not set in config.")
         return None
 
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={Config.GEMINI_API_KEY}"
+    api_url = f"{Config.GEMINI_API_BASE_URL}/models/{model}:generateContent?key={Config.GEMINI_API_KEY}"
     headers = {'Content-Type': 'application/json'}
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
@@ -88,25 +175,44 @@ async def call_gemini_api_structured(prompt, response_schema, temp=0.3, model="g
             {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
         ]
     }
+    if cached_content:
+        payload["cachedContent"] = cached_content
 
+    meter = token_meter.get()
+    estimate = meter.sent(prompt) if meter else 0
     try:
         # response = requests.post(api_url, headers=headers, json=payload)
-        async with aiohttp.ClientSession() as session:
+        async with gemini_rate_limiter, aiohttp.ClientSession() as session:
             async with session.post(api_url, headers=headers, json=payload) as response:
+                if cached_content and response.status in (400, 403, 404):
+                    error_text = await response.text()
+                    if _refers_to_cache(error_text, cached_content):
+                        raise GeminiCachedContentError(f"{cached_content}: {error_text}")
+                    print(f"Structured Gemini API error {response.status}: {error_text}")
+                    return None
                 response.raise_for_status()
                 response_data =await response.json()
 
                 usage = response_data.get('usageMetadata', {})
                 prompt_token_count = usage.get('promptTokenCount', 0)
-                print(f"The prompt has {prompt_token_count} tokens.")
+                cached_token_count = usage.get('cachedContentTokenCount', 0)
+                print(f"The prompt has {prompt_token_count} tokens ({cached_token_count} cached).")
+                if meter:
+                    meter.received(estimate, usage)
                 
                 if response_data and response_data.get('candidates'):
+                    candidate = response_data['candidates'][0]
+                    if metadata is not None:
+                        metadata['avg_logprobs'] = candidate.get('avgLogprobs')
+                        metadata['finish_reason'] = candidate.get('finishReason')
                     # The structured response is in a 'text' part, which is a JSON string
-                    json_string = response_data['candidates'][0]['content']['parts'][0]['text']
+                    json_string = candidate['content']['parts'][0]['text']
                     return json.loads(json_string) # Parse the JSON string into a Python dict
                 else:
                     print(f"Gemini API structured response did not contain expected content: {response_data}")
                     return None
+    except GeminiCachedContentError:
+        raise
     except requests.exceptions.RequestException as e:
         print(f"Error calling structured Gemini API: {e}. Response: {e.response.text if e.response else 'N/A'}")
         return None
@@ -126,7 +232,7 @@ def call_gemini_api_structured_output(prompt, response_schema, model="gemini-2.5
         print("Error: GEMINI_API_KEY is not set in config.")
         return None
 
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={Config.GEMINI_API_KEY}"
+    api_url = f"{Config.GEMINI_API_BASE_URL}/models/{model}:generateContent?key={Config.GEMINI_API_KEY}"
     headers = {'Content-Type': 'application/json'}
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
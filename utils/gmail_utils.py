@@ -1,18 +1,23 @@
 # utils.py
 import os
 import json
-import re
 import base64
 from datetime import datetime
-from bs4 import BeautifulSoup, NavigableString
 from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
 from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 
 from config import Config
-from utils.common_utils import conduct_analysis
+from utils.common_utils import conduct_analysis, conduct_thread_analysis
 from utils.transform_utils import convert_to_local_time
+from utils.attachment_decoding import AttachmentContent
+from utils.html_text import parse_mail_html
+from utils.message_parsing import extract_email_thread, compact_body
+from utils.attachment_triage import triage_attachment, SKIP, EXTRACT, OCR, SNIFF_BYTES
+from utils.header_rules import compact_headers
+from utils.near_duplicate import mail_fingerprint
+from utils.shared_analysis import content_hash
 from database import users_collection, inbox_conversations_collection
 
 # celery_app will be set dynamically from app.py
@@ -194,11 +199,25 @@ def fetch_gmail_history(credentials, email_address, start_history_id):
         return start_history_id
 
 
-def parse_message_parts(parts, attachments, gmail_service, message_id):
+def _body_cids(parts):
+    """Content-IDs referenced by cid: images in the text/html parts of a message."""
+    cids = set()
+    for part in parts:
+        if part.get('mimeType') == 'text/html' and part.get('body', {}).get('data'):
+            html_content = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
+            cids |= parse_mail_html(html_content).cids
+        elif part.get('parts'):
+            cids |= _body_cids(part['parts'])
+    return cids
+
+
+def parse_message_parts(parts, attachments, gmail_service, message_id, body_cids=None):
     """
     Recursively parses message parts to extract body content and attachments.
     """
-    pattern = r"\n+On\s+[A-Za-z]{3},\s+[A-Za-z]{3}\s+\d{1,2},\s+\d{4}.*$"
+    if body_cids is None:
+        # Collected up front: the HTML part may come after the images it embeds.
+        body_cids = _body_cids(parts)
     main_body = ''
     history_body = ''
     html_body = ''
@@ -207,19 +226,16 @@ def parse_message_parts(parts, attachments, gmail_service, message_id):
         if mime_type == 'text/plain':
             plain_text = base64.urlsafe_b64decode(
                 part['body']['data']).decode('utf-8', errors='ignore')
-            match = re.search(pattern, plain_text, flags=re.MULTILINE)
-
-            if match:
-                start_index = match.start()
+            new_text, quoted_text = extract_email_thread(plain_text)
 
-                main_body = plain_text[:start_index]
-                history_body = plain_text[start_index:]
-                history_body = history_body.replace('>', '')
+            if quoted_text:
+                main_body = new_text
+                history_body = quoted_text.replace('>', '')
                 history_body = os.linesep.join(
                     [s.strip() for s in history_body.splitlines() if s])
 
         if mime_type == 'text/html':
-            new_content, prev_content, html_body = get_text_from_soup(part)
+            new_content, prev_content, html_body = get_text_from_html_part(part)
             if not main_body:
                 main_body = new_content
                 history_body = prev_content
@@ -227,20 +243,26 @@ def parse_message_parts(parts, attachments, gmail_service, message_id):
         # Recursive step: It's a container, so parse its parts
         elif mime_type and mime_type.startswith('multipart/'):
             main_body, history_body, html_body, attachments = parse_message_parts(
-                part.get('parts', []), attachments, gmail_service, message_id
+                part.get('parts', []), attachments, gmail_service, message_id, body_cids
             )
 
         elif part.get('filename') and part.get('filename') != '':
             if part.get('filename') in main_body or part.get('filename') not in history_body:
                 # print(part)
+                content_id = _part_header(part, 'Content-ID')
                 attachment_info = {
                     'id': part.get('body', {}).get('attachmentId'),
                     'name': part['filename'],
                     'contentType': mime_type,
                     'size': part.get('body', {}).get('size'),
-                    'isInline': 'Content-ID' in [h['name'] for h in part.get('headers', [])],
+                    'isInline': content_id is not None,
+                    'contentId': content_id,
                 }
-                if part.get('body', {}).get('data'):
+                # Decide from the metadata before downloading anything.
+                action, kind = triage_attachment(attachment_info, body_cids=body_cids)
+                if action == SKIP:
+                    print(f"Triage: skipping attachment {part['filename']} ({kind or 'too large'})")
+                elif part.get('body', {}).get('data'):
                     try:
                         attachment_info['contentBytes'] = part['body']['data']
                     except Exception as e:
@@ -260,42 +282,33 @@ def parse_message_parts(parts, attachments, gmail_service, message_id):
                     except Exception as e:
                         print(
                             f"Unexpected error fetching separate attachment: {e}")
+                if action is None and attachment_info.get('contentBytes'):
+                    # The Gmail API has no ranged attachment reads, so ambiguous files are
+                    # sniffed from the decoded head of the downloaded data.
+                    head = AttachmentContent.for_provider(
+                        attachment_info['contentBytes'], 'gmail').head(SNIFF_BYTES)
+                    action, kind = triage_attachment(attachment_info, head=head)
+                    if action not in (EXTRACT, OCR):
+                        attachment_info.pop('contentBytes')
+                attachment_info['triage'] = {'action': action or SKIP, 'kind': kind}
                 # print(attachment_info.keys())
                 attachments.append(attachment_info)
 
     return main_body, history_body, html_body, attachments
 
 
-def get_text_from_soup(part):
-    html_content = base64.urlsafe_b64decode(
-        part['body']['data']).decode('utf-8', errors='ignore')
-    soup = BeautifulSoup(html_content, 'html.parser')
-
-    for img_tag in soup.find_all('img', alt=True):
-        alt_text = img_tag['alt']
-        img_tag.replace_with('[image: '+alt_text+']')
+def _part_header(part, header_name):
+    return next((h['value'] for h in part.get('headers', []) if h['name'].lower() == header_name.lower()), None)
 
-    for br_tag in soup.find_all('br'):
-        br_tag.replace_with('\n')
 
-    first_quote_div = soup.find(
-        'div', class_='gmail_quote gmail_quote_container')
-    new_content = ""
-    previous_content = ""
-
-    if first_quote_div:
-        new_content = ""
-        for element in first_quote_div.previous_siblings:
-            if isinstance(element, NavigableString):
-                new_content = str(element) + new_content
-            else:
-                new_content = element.get_text().strip() + new_content
-        previous_content = first_quote_div.get_text().strip()
-
-    else:
-        full_text = soup.get_text(separator=' ')
-        new_content = re.sub(r'\s+', ' ', full_text).strip()
-        previous_content = ""
+def get_text_from_html_part(part):
+    """Returns (new_content, previous_content, html_content) for a text/html part."""
+    html_content = base64.urlsafe_b64decode(
+        part['body']['data']).decode('utf-8', errors='ignore')
+    parsed = parse_mail_html(html_content)
+    # Quotes pasted as text (Outlook-style headers, "> " blocks) are split off as well.
+    new_content, quoted_text = extract_email_thread(parsed.text)
+    previous_content = "\n".join(t for t in (quoted_text, parsed.quoted_text) if t)
     return new_content, previous_content, html_content
 
 
@@ -313,6 +326,7 @@ def prepare_conversation_thread(email_address, thread_id, current_message_id):
         messages = thread.get('messages', [])
         # print(messages)
         # user_data = users_collection.find_one({'user_id': email_address})
+        msg_docs = []
         for msg in messages:
             msg_id = msg.get('id')
             if msg_id and 'TRASH' not in msg.get('labelIds', []):
@@ -321,10 +335,11 @@ def prepare_conversation_thread(email_address, thread_id, current_message_id):
                 # print(message)
                 result, thread_id, msg_doc = save_single_mail(
                     gmail_service, message, email_address)
-                if msg_id == current_message_id:
-                    conduct_analysis(email_address, thread_id, msg_doc)
+                msg_docs.append(msg_doc)
             else:
                 print("Skipping a malformed message object without an ID.")
+        # Oldest first, so each message finds the summaries of the earlier ones.
+        conduct_thread_analysis(email_address, thread_id, msg_docs, current_message_id)
         return True
     except Exception as e:
         print(f"Error occured during preparing thread for gmail {e}")
@@ -339,6 +354,7 @@ def save_single_mail(gmail_service, message, email_address):
     sender = next((h['value'] for h in headers if h['name'] == 'From'), 'N/A')
     subject = next((h['value']
                    for h in headers if h['name'] == 'Subject'), 'N/A')
+    internet_message_id = next((h['value'] for h in headers if h['name'].lower() == 'message-id'), None)
 
     def get_recipients_from_header(header_name):
         header_value = next((h['value']
@@ -365,6 +381,7 @@ def save_single_mail(gmail_service, message, email_address):
     main_conv, prev_conv, html_conv, attachments = parse_message_parts(
         payload.get('parts', []), attachments, gmail_service, message_id
     )
+    main_conv, body_tokens = compact_body(main_conv)
 
     analysis = {
         'completed': False
@@ -372,20 +389,25 @@ def save_single_mail(gmail_service, message, email_address):
 
     message_doc = {
         'message_id': message_id,
+        'internet_message_id': internet_message_id,
         'subject': subject,
         'sender': sender,
         'receivers': receivers_list,
         'cc': cc_list,
         'bcc': bcc_list,
         'body': main_conv,
+        'body_tokens': body_tokens,
         'previous_messages': prev_conv,
         'received_datetime': localize_dt,
         'attachments': attachments,
         'type': 'gmail_received_mail',
         'provider': 'gmail',
         'full_message_payload': html_conv,
+        'headers': compact_headers(headers),
+        'fingerprint': mail_fingerprint(subject, main_conv, [a.get('name') for a in attachments]),
         'analysis': analysis
     }
+    message_doc['content_hash'] = content_hash(message_doc)
 
     filter_query = {'conv_id': thread_id, 'email_address': email_address}
 
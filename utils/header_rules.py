@@ -0,0 +1,106 @@
+import re
+from email.utils import parseaddr
+
+from config import Config
+
+# Headers kept with a stored mail (lower-cased names); everything else is dropped.
+KEPT_HEADERS = (
+    'list-unsubscribe', 'list-unsubscribe-post', 'list-id', 'precedence', 'auto-submitted',
+    'x-auto-response-suppress', 'x-autoreply', 'x-autorespond', 'return-path', 'reply-to',
+    'x-mailer', 'feedback-id', 'x-spam-flag', 'x-ms-exchange-organization-scl',
+    'authentication-results', 'in-reply-to',
+)
+MAX_HEADER_CHARS = 300
+
+_NO_REPLY_RE = re.compile(r'^(no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon|postmaster|bounce[s]?)([-+_.].*)?$')
+_AUTH_RE = re.compile(r'\b(spf|dkim|dmarc)=(\w+)')
+_BULK_PRECEDENCE = {'bulk', 'list', 'junk'}
+
+
+def _summarize_authentication(value):
+    """'spf=pass dkim=pass dmarc=pass' out of a full Authentication-Results header."""
+    results = {}
+    for method, result in _AUTH_RE.findall(value.lower()):
+        results.setdefault(method, result)
+    return ' '.join(f"{m}={r}" for m, r in results.items())
+
+
+def compact_headers(pairs):
+    """
+    Keeps the headers the rules need from Gmail payload.headers / Outlook
+    internetMessageHeaders ([{'name', 'value'}]) as a small lower-cased dict.
+    """
+    headers = {}
+    for header in pairs or []:
+        name = (header.get('name') or '').lower()
+        if name not in KEPT_HEADERS or name in headers:
+            continue
+        value = (header.get('value') or '').strip()
+        if name == 'authentication-results':
+            value = _summarize_authentication(value)
+        headers[name] = value[:MAX_HEADER_CHARS]
+    return headers
+
+
+def _domain_matches(domain, domains):
+    return any(domain == d or domain.endswith('.' + d) for d in domains)
+
+
+def evaluate_headers(mail):
+    """
+    Answers the spam and reply-needed questions from the stored headers and sender
+    where that is safe. Returns {'is_spam', 'reply_needed', 'aligned', 'reasons'}
+    ('aligned': DMARC passed, so the From domain is genuine); a None value
+    means the rules are not confident and the LLM decides as usual. is_spam=False is
+    only a hint: headers can't tell whether the content is malicious, so the spam
+    check still runs for those mails.
+    """
+    headers = mail.get('headers') or {}
+    address = parseaddr(mail.get('sender') or '')[1].lower()
+    local, _, domain = address.partition('@')
+    return_path_domain = parseaddr(headers.get('return-path', ''))[1].lower().partition('@')[2]
+    auth = headers.get('authentication-results', '')
+    authenticated = 'dmarc=pass' in auth or 'dkim=pass' in auth
+    # DMARC passes only when SPF or DKIM is aligned with the From domain.
+    aligned = 'dmarc=pass' in auth
+    reasons = []
+
+    automated = []
+    if _NO_REPLY_RE.match(local):
+        automated.append('no-reply sender')
+    auto_submitted = headers.get('auto-submitted', '').lower()
+    if auto_submitted and not auto_submitted.startswith('no'):
+        automated.append(f"Auto-Submitted: {auto_submitted}")
+    # Either of these alone means no human reads a reply.
+    strong = len(automated)
+    precedence = headers.get('precedence', '').lower()
+    if precedence in _BULK_PRECEDENCE:
+        automated.append(f"Precedence: {precedence}")
+    if headers.get('list-unsubscribe') or headers.get('list-id'):
+        automated.append('mailing list headers')
+    newsletter = _domain_matches(domain, Config.NEWSLETTER_DOMAINS) or \
+        _domain_matches(return_path_domain, Config.NEWSLETTER_DOMAINS)
+    if newsletter:
+        automated.append('newsletter domain')
+    reasons += automated
+
+    is_spam = None
+    if headers.get('x-spam-flag', '').lower() == 'yes':
+        is_spam = True
+        reasons.append('X-Spam-Flag: YES')
+    elif headers.get('x-ms-exchange-organization-scl', '') in {'5', '6', '7', '8', '9'}:
+        is_spam = True
+        reasons.append(f"SCL {headers['x-ms-exchange-organization-scl']}")
+    elif automated and authenticated and (newsletter or len(automated) >= 2):
+        # Signed bulk mail from a known sender: a newsletter, not spam.
+        is_spam = False
+        reasons.append(auth)
+
+    return {
+        'is_spam': is_spam,
+        # Lists and groups also carry real customer mail, so one list header alone
+        # doesn't rule out a reply; otherwise leave it to the reply node.
+        'reply_needed': False if strong or len(automated) >= 2 or is_spam else None,
+        'aligned': aligned,
+        'reasons': reasons,
+    }
@@ -0,0 +1,125 @@
+import re
+from lxml import etree
+
+# Tags whose content is never shown to the reader.
+_SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template', 'xml'}
+
+# Tags that start a new line in the rendered text.
+_BLOCK_TAGS = {
+    'p', 'div', 'tr', 'li', 'ul', 'ol', 'table', 'blockquote', 'pre', 'hr',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'header', 'footer',
+    'address', 'dl', 'dt', 'dd', 'center', 'form', 'fieldset',
+}
+
+# Markers of the quoted history that mail clients insert above the previous messages.
+_QUOTE_CLASSES = ('gmail_quote', 'yahoo_quoted', 'moz-cite-prefix', 'OutlookMessageHeader')
+_QUOTE_IDS = ('divRplyFwdMsg', 'appendonsend', 'mail-editor-reference-message-container')
+
+_INLINE_SPACE = re.compile(r'[ \t\r\f\v\u00a0\u3000]+')
+_HTML_SPACE = re.compile(r'\s+')
+
+
+class ParsedHtml:
+    """Result of a single pass over a mail HTML body."""
+    __slots__ = ('text', 'quoted_text', 'cids', 'image_alts')
+
+    def __init__(self, text, quoted_text, cids, image_alts):
+        self.text = text
+        self.quoted_text = quoted_text
+        self.cids = cids
+        self.image_alts = image_alts
+
+    @property
+    def full_text(self):
+        return "\n".join(t for t in (self.text, self.quoted_text) if t)
+
+
+def _is_quote_start(tag, attrib):
+    if tag == 'blockquote' and attrib.get('type') == 'cite':
+        return True
+    if tag != 'div':
+        return False
+    classes = attrib.get('class', '')
+    if classes and any(c in classes for c in _QUOTE_CLASSES):
+        return True
+    return attrib.get('id', '') in _QUOTE_IDS
+
+
+def _clean_lines(parts):
+    lines = (_INLINE_SPACE.sub(' ', line).strip() for line in ''.join(parts).split('\n'))
+    return "\n".join(line for line in lines if line)
+
+
+class _MailHtmlTarget:
+    """
+    lxml parser target: receives parser events directly, so the text, CID references,
+    image alt text and the quote split are produced while parsing, without building a tree.
+    """
+
+    def __init__(self, image_alt_placeholders):
+        self.image_alt_placeholders = image_alt_placeholders
+        self.main = []
+        self.quoted = []
+        self.out = self.main
+        self.skip_depth = 0
+        self.cids = set()
+        self.image_alts = []
+
+    def start(self, tag, attrib):
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if self.skip_depth or tag in _SKIP_TAGS:
+            self.skip_depth += 1
+            return
+        if self.out is self.main and _is_quote_start(tag, attrib):
+            self.out = self.quoted
+        if tag == 'br' or tag in _BLOCK_TAGS:
+            self.out.append('\n')
+        elif tag in ('td', 'th'):
+            self.out.append(' ')
+        elif tag == 'img':
+            src = attrib.get('src', '')
+            if src[:4].lower() == 'cid:':
+                self.cids.add(src[4:])
+            alt = (attrib.get('alt') or '').strip()
+            if alt:
+                self.image_alts.append(alt)
+                if self.image_alt_placeholders:
+                    self.out.append(f'[image: {alt}]')
+
+    def end(self, tag):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if tag in _BLOCK_TAGS:
+            self.out.append('\n')
+
+    def data(self, text):
+        if not self.skip_depth:
+            # Source newlines are just whitespace in HTML; lines come from <br> and blocks.
+            self.out.append(_HTML_SPACE.sub(' ', text) if '\n' in text else text)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return ParsedHtml(_clean_lines(self.main), _clean_lines(self.quoted), self.cids, self.image_alts)
+
+
+def parse_mail_html(html_content, image_alt_placeholders=True):
+    """
+    Converts a mail HTML body to plain text in one pass of the lxml (libxml2) HTML parser.
+    Returns ParsedHtml with the new text, the quoted history (everything from the first
+    Gmail/Outlook/Thunderbird quote container on), the cid: image references and the
+    image alt texts. With image_alt_placeholders, images are rendered as "[image: alt]".
+    """
+    target = _MailHtmlTarget(image_alt_placeholders)
+    if not html_content:
+        return target.close()
+    parser = etree.HTMLParser(target=target, recover=True, remove_comments=True)
+    try:
+        parser.feed(html_content)
+        return parser.close()
+    except etree.LxmlError as e:
+        print(f"Error parsing mail HTML: {e}")
+        return target.close()
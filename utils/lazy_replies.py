@@ -0,0 +1,93 @@
+"""
+Reply suggestions on demand.
+
+Most mails are never opened in the add-in and far fewer are answered, so replies are
+no longer part of the ingest analysis (LAZY_REPLIES). They are generated when the
+add-in asks for them (/replies), then served from analysis.replies and pushed on the
+'analysis:<user_email>' channel like the other partial results. Two cases are still
+prefetched in the background: senders the user usually writes to, decided at planning
+time, and mails whose importance score reaches REPLY_PREFETCH_MIN_SCORE, decided after
+the analysis.
+"""
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import parseaddr
+
+from bson import ObjectId
+
+import database
+from config import Config
+
+PREFETCH_SENDER = 'sender'
+PREFETCH_IMPORTANCE = 'importance'
+ON_DEMAND = 'on_demand'
+
+
+class ReplyStats:
+    """Counts deferred, prefetched and requested reply generations per process."""
+
+    def __init__(self, report_every):
+        self.report_every = report_every
+        self.counts = {}
+
+    def count(self, event):
+        self.counts[event] = self.counts.get(event, 0) + 1
+        total = sum(self.counts.values())
+        if self.report_every and total % self.report_every == 0:
+            print(f"Lazy reply stats: {self.report()}")
+
+    def report(self):
+        return ', '.join(f"{k}: {v}" for k, v in sorted(self.counts.items())) or "no replies"
+
+
+reply_stats = ReplyStats(Config.MODEL_ROUTER_REPORT_EVERY)
+
+
+def usually_answers(user_email, sender):
+    """
+    True when the user sent at least REPLY_PREFETCH_MIN_ANSWERED mails to `sender`
+    within REPLY_PREFETCH_WINDOW_DAYS (outgoing mails checked by /validate_outgoing).
+    """
+    address = parseaddr(sender or '')[1].lower()
+    if '@' not in address:
+        return False
+    since = datetime.now(timezone.utc) - timedelta(days=Config.REPLY_PREFETCH_WINDOW_DAYS)
+    # The whole address, alone or in "Name <address>" / comma-separated lists, not a substring of another one.
+    pattern = {'$regex': f'(^|[\\s<,;]){re.escape(address)}($|[\\s>,;])', '$options': 'i'}
+    sent = database.draft_messages_collection.count_documents(
+        {'email_address': user_email, '_id': {'$gte': ObjectId.from_datetime(since)},
+         '$or': [{'receipients': pattern}, {'cc': pattern}]},
+        limit=Config.REPLY_PREFETCH_MIN_ANSWERED)
+    return sent >= Config.REPLY_PREFETCH_MIN_ANSWERED
+
+
+def defer_replies(email_address, msg_doc):
+    """Whether the planned reply suggestions wait for the add-in instead of running at ingest."""
+    if not Config.LAZY_REPLIES:
+        return False
+    try:
+        if usually_answers(email_address, msg_doc.get('sender')):
+            reply_stats.count(PREFETCH_SENDER)
+            return False
+    except Exception as e:
+        print(f"Error reading the reply history of {email_address}: {e}")
+    reply_stats.count('deferred')
+    return True
+
+
+def maybe_prefetch(email_data, analysis):
+    """After a deferred analysis: queues the replies of an important, clean mail."""
+    if not email_data.get('replies_deferred') or not analysis or analysis.get('replies'):
+        return
+    if analysis.get('is_spam') or analysis.get('is_malicious'):
+        return
+    if (analysis.get('importance_score') or 0) < Config.REPLY_PREFETCH_MIN_SCORE:
+        return
+    request_replies(email_data['conv_id'], email_data['msg_id'], email_data['user_email'], PREFETCH_IMPORTANCE)
+
+
+def request_replies(conv_id, msg_id, user_email, reason):
+    """Queues the reply generation of one message."""
+    from workers.tasks import generate_replies
+    reply_stats.count(reason)
+    generate_replies.delay(conv_id, msg_id, user_email, reason)
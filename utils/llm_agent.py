@@ -1,9 +1,6 @@
 import os
-from datetime import datetime
-import aiohttp
-import json
+from datetime import datetime, timedelta, timezone
 import sqlite3
-import base64
 import asyncio
 from typing import TypedDict, Optional, List, Literal
 from pydantic import BaseModel, Field
@@ -17,108 +14,38 @@ import logging
 from config import Config
 from database_async import users_collection_async, inbox_conversations_collection_async
 from utils.gemini_utils import call_gemini_api
+from utils.model_router import model_router
 from utils.transform_utils import convert_to_local_time
 from utils.attachment_processing import extract_text_from_attachment
+from utils.attachment_decoding import AttachmentContent
+from utils.attachment_triage import SKIP
+from utils.summarization import summarize_attachment_text
+from utils.prompt_builder import PRIORITY_HEADER, PRIORITY_BODY, PRIORITY_HISTORY
+from utils.prompt_templates import (
+    importance_template, SPAM_CHECK, SUGGEST_REPLIES, SUMMARIZE_AND_CATEGORIZE, PREVIOUS_CONVERSATION_SUMMARY
+)
+from utils.severity_matcher import match_severity
+from utils.teams_alert import is_helpdesk_mail, should_alert_early, send_critical_mail_alert
+from utils.triage_model import triage_message
+from utils.header_rules import evaluate_headers
+from utils.sender_reputation import sender_reputation
+from utils.near_duplicate import find_near_duplicate, same_figures, reused_results, duplicate_info, REUSED_RESULTS
+from utils import shared_analysis
+from utils.conversation_summary import previous_summary, fold_message
+from utils.speculation import speculation
+from utils.gemini_utils import token_meter
+from utils.progress import analysis_fields, publish
+from utils.mail_view import MailView, load_mail_view, load_attachment_bytes
+from utils.lazy_replies import maybe_prefetch
 
 logger = logging.getLogger(__name__)
-CONDITION_RULES = {
-    "severity_rules": {
-        "🔴 重大（クリティカル） - 即座に対応（15分以内）": {
-            "スコア": "80-100",
-            "システム影響": "購買・調達業務の完全停止、サプライチェーン断絶",
-            "状況": {
-                "購買管理システム": [
-                    "発注システム全停止",
-                    "仕入先マスタ全件アクセス不可",
-                    "承認ワークフロー完全停止",
-                    "在庫切れ商品の緊急発注不可",
-                    "月末締め処理の完全停止"
-                ],
-                "EDIシステム": [
-                    "EDI通信の完全断絶（全取引先）",
-                    "受発注データの送受信停止",
-                    "大手取引先との自動連携停止",
-                    "出荷指示データ送信不可",
-                    "請求・支払データ交換停止"
-                ]
-            },
-            "業務への影響": [
-                "生産ライン停止リスク",
-                "店舗・倉庫への商品供給停止",
-                "主要取引先との取引停止",
-                "決済・支払処理の全面停止"
-            ],
-            "キーワード": "「EDI停止」「発注できない（全社）」「取引先と繋がらない」「生産停止」「在庫切れ緊急」"
-        },
-        "🟡 高（高優先度） - 優先対応（1時間以内）": {
-            "スコア": "60-79",
-            "システム影響": "重要機能の部分停止、主要取引先への影響",
-            "状況": {
-                "購買管理システム": [
-                    "特定カテゴリの発注機能停止",
-                    "承認者不在による承認遅延",
-                    "発注書印刷・送付機能不具合",
-                    "仕入先別発注データ抽出不可",
-                    "予算管理機能の異常"
-                ],
-                "EDIシステム": [
-                    "特定取引先とのEDI通信障害",
-                    "データ変換エラー（一部取引先）",
-                    "自動発注の部分的停止",
-                    "在庫連携データの送信遅延",
-                    "受注確認データの未受信"
-                ]
-            },
-            "業務シナリオ": [
-                "主要仕入先との定期発注に支障",
-                "特定商品カテゴリの調達停止",
-                "大口取引先からの受注処理遅延",
-                "月次・週次の定期発注に影響"
-            ],
-            "キーワード": "「A社とのEDI不通」「○○カテゴリ発注不可」「定期発注エラー」「受注データ未着」"
-        },
-        "🟢 中（標準） - 通常対応（4時間以内）": {
-            "スコア": "30-59",
-            "システム影響": "個人・部分的な業務への影響",
-            "状況": {
-                "購買管理システム": [
-                    "個人の発注権限設定問題",
-                    "特定商品の単価・仕入先情報更新",
-                    "発注書印刷・送付機能不具合",
-                    "帳票レイアウトの軽微な問題",
-                    "ユーザー操作に関する質問"
-                ],
-                "EDIシステム": [
-                    "小規模取引先との通信問題",
-                    "データフォーマット軽微修正",
-                    "送信履歴・ログ確認方法",
-                    "EDI設定変更の相談"
-                ]
-            },
-            "キーワード": "「個人アカウント」「操作方法」「履歴確認」「軽微な修正」"
-        },
-        "🟦 低（一般） - 計画対応（1営業日以内）": {
-            "スコア": "0-29",
-            "システム影響": "業務継続に直接影響なし",
-            "内容": [
-                "システム改善要望",
-                "新規取引先EDI接続準備",
-                "マスタデータ整備計画",
-                "操作研修・マニュアル整備",
-                "将来的なシステム更改相談"
-            ]
-        }
-    }
-}
-
-
 if "GOOGLE_API_KEY" not in os.environ:
     os.environ["GOOGLE_API_KEY"] = Config.GEMINI_API_KEY
 
-gemini_llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
+gemini_llm = ChatGoogleGenerativeAI(model=Config.GEMINI_STRONG_MODEL)
 
 
-async def _extract_text_from_attachments(data, filename, email_provider):
+async def _extract_text_from_attachments(data, filename, email_provider, file_extension=None):
     """
     Helper function to extract plain text content from attachments within the
     full_message_payload (either Gmail or Outlook format).
@@ -127,14 +54,12 @@ async def _extract_text_from_attachments(data, filename, email_provider):
     """
     attachment_texts = []
     try:
-        if 'gmail' in email_provider:
-            decoded_bytes = base64.urlsafe_b64decode(data)
-        elif 'outlook' in email_provider:
-            decoded_bytes = base64.b64decode(data)
-        else:
+        if 'gmail' not in email_provider and 'outlook' not in email_provider:
             return attachment_texts
 
-        text = await extract_text_from_attachment(decoded_bytes, filename)
+        # Decoded lazily; large attachments are spilled to a temp file removed on exit.
+        with AttachmentContent.for_provider(data, email_provider) as content:
+            text = await extract_text_from_attachment(content, filename, file_extension)
         if text:
             attachment_texts.append(
                 f"--- Attachment: {filename} ---\n{text}\n--- End Attachment ---")
@@ -148,20 +73,6 @@ async def _extract_text_from_attachments(data, filename, email_provider):
 # =========================================================================
 
 
-class SpamCheckResult(BaseModel):
-    """The result of the spam and malicious content check."""
-    is_spam: bool = Field(..., description="True if the email is spam.")
-    is_malicious: bool = Field(...,
-                               description="True if the email contains malicious content.")
-
-
-class ImportanceScoreResult(BaseModel):
-    """The importance score and description for the email."""
-    score: int = Field(..., description="An importance score from 0-100.")
-    description: str = Field(...,
-                             description="A short Japanese description of the score reason.")
-
-
 class ReplyOption(BaseModel):
     """A single suggested reply for the email."""
     type: Literal["Concise", "Confirm", "Polite"]
@@ -174,26 +85,20 @@ class RepliesResult(BaseModel):
                                        description="A list of suggested replies.")
 
 
-class SummarizationAndCategoryResult(BaseModel):
-    """The summary and category for the email."""
-    summary: str = Field(..., description="A concise summary of the email.")
-    category: Literal["エラー", "修理", "問い合わせ", "報告",
-                      "キャンペーン", "プロモーション", "スパム", "有害", "返信不要"]
-
-
 class AgentState(TypedDict):
     """
     Represents the state of a single email analysis session.
     The state persists across multiple requests for the same email.
     """
     email_provider: str
-    current_mail: dict
+    current_mail: MailView  # Slim view; attachment bytes are loaded by the attachment node
     conv_id: str
     msg_id: str
     user_email: str
     attachment_summaries: Optional[str]
     previous_conversation_summary: Optional[str]
     user_choices: List[str]  # List of tasks to perform if not spam
+    header_rules: Optional[dict]  # Local verdict from utils/header_rules.py
 
     # Analysis results are updated by the nodes
     importance_score_result: Optional[dict]
@@ -226,21 +131,21 @@ async def generate_attachment_summary(state: AgentState):
             return {"name": name, "summary": summary}
         # else:
         attachment_id = attachment.get('id')
-        attachment_size = attachment.get('size')
-        if attachment_size < 1200000:
+        triage = attachment.get('triage') or {}
+        if triage.get('action') == SKIP or not attachment.get('has_content'):
+            # Inline logos, archives and unsupported files are never downloaded.
+            return None
+        attachment_size = attachment.get('size') or 0
+        if attachment_size <= Config.ATTACHMENT_MAX_BYTES:
+            content = await load_attachment_bytes(conv_id, user_id, msg_id, attachment['index'])
             extracted_text = await _extract_text_from_attachments(
-                attachment.get('contentBytes'), attachment.get(
-                    'name'), state["email_provider"]
-            )
+                content, attachment.get(
+                    'name'), state["email_provider"], triage.get('kind')
+            ) if content else None
             attachment_summary = ""
             if extracted_text:
-                prompt = (
-                    f'Summarize the content of the attachments: {extracted_text} '
-                    f'within 200 characters in Japanese. Only include Japanese, no Romaji.'
-                )
                 try:
-                    # Corrected: await the async call_gemini_api function
-                    attachment_summary = await call_gemini_api(prompt, model="gemini-2.0-flash")
+                    attachment_summary = await summarize_attachment_text("\n".join(extracted_text))
                     if attachment_summary:
                         # Corrected: Use await with the async database client (`motor`)
                         await inbox_conversations_collection_async.update_one(
@@ -266,7 +171,7 @@ async def generate_attachment_summary(state: AgentState):
             else:
                 print(f"Text extraction failed for attachment {attachment_id}")
         else:
-            print(f"File {attachment_id} is too large (>1.2MB). Skipping.")
+            print(f"File {attachment_id} is larger than ATTACHMENT_MAX_BYTES. Skipping.")
         return None
 
     # Get the unique identifiers for the thread from the state
@@ -299,7 +204,33 @@ async def generate_previous_conversation_summary(state: AgentState):
     if current_mail.get('previous_messages_summary'):
         return {"previous_conversation_summary": current_mail.get('previous_messages_summary')}
     current_received_time = current_mail.get('received_datetime')
-    # print(current_received_time)
+    # The newest mail of a thread reads the rolling summary; older ones (re-analyses) re-summarize.
+    summary = await previous_summary(state['conv_id'], state['user_email'], current_received_time)
+    if summary is not None:
+        print("Using the rolling conversation summary")
+    else:
+        summary = await _summarize_previous_messages(state, current_received_time)
+
+    # Corrected: Use await with the async database client (`motor`)
+    await inbox_conversations_collection_async.update_one(
+        {
+            'conv_id': state['conv_id'], 'email_address': state['user_email'], 'messages.message_id': state['msg_id']
+        },
+        {
+            '$set': {
+                'messages.$[message].previous_messages_summary': summary,
+            }
+        },
+        array_filters=[
+            {"message.message_id": state['msg_id']},
+        ]
+    )
+    print("Previous generation summary completed")
+    return {"previous_conversation_summary": summary}
+
+
+async def _summarize_previous_messages(state, current_received_time):
+    """Summarizes the summaries of all earlier messages of the thread in one call."""
     try:
         pipeline = [
             {"$match": {
@@ -357,30 +288,19 @@ async def generate_previous_conversation_summary(state: AgentState):
             logger.info("previous message summaries : %s",
                         previous_messages_summaries)
             if previous_messages_summaries:
-                prompt_summary = f'Summarize the key points and unresolved issues from the summaries of the previous email of this thread: {previous_messages_summaries} within 200 characters in Japanese. Only include Japanese, no Romaji.'
+                prompt_summary = (
+                    PREVIOUS_CONVERSATION_SUMMARY.builder()
+                    .add(previous_messages_summaries, 'Previous Mail Summaries', PRIORITY_HISTORY,
+                         Config.PROMPT_PREVIOUS_MESSAGES_TOKENS, keep_tail=True)
+                    .build()
+                )
 
                 try:
                     summary = await call_gemini_api(prompt_summary)
                     logger.info('Generated summary %s', summary)
                 except Exception as e:
                     print("Gemini error occured", e)
-
-    # Corrected: Use await with the async database client (`motor`)
-    await inbox_conversations_collection_async.update_one(
-        {
-            'conv_id': state['conv_id'], 'email_address': state['user_email'], 'messages.message_id': state['msg_id']
-        },
-        {
-            '$set': {
-                'messages.$[message].previous_messages_summary': summary,
-            }
-        },
-        array_filters=[
-            {"message.message_id": state['msg_id']},
-        ]
-    )
-    print("Previous generation summary completed")
-    return {"previous_conversation_summary": summary}
+    return summary
 
 # Corrected: This function is already async, no changes needed here.
 
@@ -408,38 +328,70 @@ async def initial_processing_and_parallel_nodes(state: AgentState):
 # Corrected: Change this to an async function and use ainvoke
 
 
-async def check_spam_and_malicious(state: AgentState):
-    """Checks if the email is spam or malicious."""
-    print("Running spam check...")
+async def _local_spam_verdict(state):
+    """
+    The spam verdict when it is known without the LLM (earlier analysis, shared result,
+    header rules, sender reputation), else None.
+    """
     current_mail = state.get('current_mail')
     analysis = current_mail.get('analysis', {})
     if len(analysis) != 0:
         cur_spam = analysis.get('is_spam')
         cur_malicious = analysis.get('is_malicious')
         if cur_spam == False and cur_malicious == False:
-            return {"spam_check_result": {'is_spam': cur_spam, 'is_malicious': cur_malicious}}
+            return {'is_spam': cur_spam, 'is_malicious': cur_malicious}
+    if state.get('spam_check_result'):
+        # Taken over from the same mail in another mailbox (utils/shared_analysis.py).
+        return state['spam_check_result']
+    header_rules = state.get('header_rules') or {}
+    # Only a positive is final: headers say nothing about malicious content, so a
+    # signed newsletter still goes through the LLM check.
+    if header_rules.get('is_spam'):
+        print(f"Header rules: spam ({', '.join(header_rules['reasons'])}), skipping the LLM")
+        return {'is_spam': True, 'is_malicious': False}
+    reputation = await sender_reputation.lookup(
+        current_mail.get('sender'), state['user_email'], header_rules.get('aligned', False))
+    if reputation:
+        print(f"Sender reputation: {reputation['source']} is_spam={reputation['is_spam']}, skipping the LLM")
+        return reputation
+    return None
+
+
+async def check_spam_and_malicious(state: AgentState):
+    """Checks if the email is spam or malicious."""
+    print("Running spam check...")
+    local = await _local_spam_verdict(state)
+    if local:
+        return {"spam_check_result": local}
+    return await _llm_spam_check(state)
+
+
+async def _llm_spam_check(state):
+    """The spam check by the LLM, recorded in the sender reputation."""
+    current_mail = state.get('current_mail')
+    sender = current_mail.get('sender')
     body = current_mail.get('body')
-    sender = current_mail.get('subject')
     subject = current_mail.get('subject')
-    prompt = (
-        f"Check the mail is spam or has malicious content"
-        f"Your response must be a single JSON object."
-        "The JSON should have two keys: 'is_spam' and 'is_malicious', with boolean values.\n"
-        f'Sender: {sender}\n'
-        f'Subject: {subject}\n'
-        f'Body:\n{body}\n\n'
+    attachment_summaries = state.get("attachment_summaries")
+    if attachment_summaries == "No Attachment":
+        attachment_summaries = None
+    builder = (
+        SPAM_CHECK.builder()
+        .add(sender, 'Sender', PRIORITY_HEADER, Config.PROMPT_HEADER_TOKENS)
+        .add(subject, 'Subject', PRIORITY_HEADER, Config.PROMPT_HEADER_TOKENS)
+        .add(body, 'Body', PRIORITY_BODY, Config.PROMPT_BODY_TOKENS)
+        .add_context(attachment_summaries, state.get('previous_conversation_summary'))
     )
-    if state.get("attachment_summaries") and state["attachment_summaries"] != "No Attachment":
-        prompt += f'Summary Of The Attachments :\n{state["attachment_summaries"]}\n\n'
-    if state.get('previous_conversation_summary'):
-        prompt += f"Previous Conversation Summary:\n{state['previous_conversation_summary']}"
 
     try:
-        llm_with_structured_output = gemini_llm.with_structured_output(
-            SpamCheckResult)
-        response = await asyncio.to_thread(llm_with_structured_output.invoke, [HumanMessage(prompt)])
-        # print(response)
-        return {"spam_check_result": {'is_spam': response.is_spam, 'is_malicious': response.is_malicious}}
+        # A positive ends the analysis, so it is confirmed by the strong model.
+        result = await model_router.call(
+            'spam_check', SPAM_CHECK, builder,
+            escalate_if=lambda r: r['is_spam'] or r['is_malicious'])
+        if not result:
+            raise ValueError("empty response")
+        await sender_reputation.record(sender, result['is_spam'], result['is_malicious'])
+        return {"spam_check_result": {'is_spam': result['is_spam'], 'is_malicious': result['is_malicious']}}
     except Exception as e:
         print(
             f"Error invoking Gemini with structured output for spam check: {e}")
@@ -448,120 +400,69 @@ async def check_spam_and_malicious(state: AgentState):
 # Corrected: These functions already use ainvoke correctly.
 
 
+async def _alert_unless_spam(state, mail, received_time, reason=None):
+    """Sends the Teams alert; under speculative execution only once the spam check came back clean."""
+    gate = state.get('spam_gate')
+    if gate is not None and not await asyncio.shield(gate):
+        return False
+    return await send_critical_mail_alert(mail, received_time, reason)
+
+
 async def get_importance_score(state: AgentState):
     """Assigns an importance score to the email."""
     print("Running importance score analysis...")
     current_mail = state.get('current_mail')
     body = current_mail.get('body')
     subject = current_mail.get('subject')
-    prompt = (
-        f"Assign an importance score from 0-100 based on these rules: {CONDITION_RULES} in the following email."
-        f'Then, Provide a one-sentence summary *within 100 characters* describing the reason behind the scoring in Japanese.'
-        f'If any keyword or its synonymous text from the conditions exists in the mail, score it corresponding to its category and mention the keyword in the description.'
-        f"Your response must be a single JSON object. The JSON should have two keys: 'score' (number) and 'description' (string).\n\n"
-        f'Subject: {subject}\n'
-        f'Body:\n{body}n\n'
-    )
-    if state.get("attachment_summaries"):
-        prompt += f'Attachment Summaries:\n{state["attachment_summaries"]}\n\n'
-    if state.get('previous_conversation_summary'):
-        prompt += f"Previous conversation summary: {state['previous_conversation_summary']}"
+    attachment_summaries = state.get("attachment_summaries")
+    severity_match = match_severity(subject, body, attachment_summaries)
+    template = importance_template('importance_score', severity_match)
+    builder = template.builder().add_mail(current_mail, sender=False)
+    if severity_match:
+        builder.add('、'.join(severity_match.matched), 'Matched Keywords', PRIORITY_HEADER, Config.PROMPT_HEADER_TOKENS)
+    builder.add_context(attachment_summaries, state.get('previous_conversation_summary'))
+
+    early_alert = None
     try:
-        llm_with_structured_output = gemini_llm.with_structured_output(
-            ImportanceScoreResult)
-        response = await asyncio.to_thread(llm_with_structured_output.invoke, [HumanMessage(prompt)])
-        # print(convert_to_local_time(current_mail.get(
-        #     'received_datetime')).strftime("%Y-%m-%d %H:%M:%S"))
-        # print(current_mail.get('received_datetime',
-        #       datetime.today).strftime("%Y-%m-%d %H:%M:%S"))
-        if response.score >= 70 and "helpdesk@ffp.co.jp" in current_mail.get('receivers', ''):
-            received_time = convert_to_local_time(current_mail.get(
-                'received_datetime')).strftime("%Y-%m-%d %H:%M:%S")
-            teams_payload = {
-                "type": "message",
-                "attachments": [
-                    {
-                        "contentType": "application/vnd.microsoft.card.adaptive",
-                        "content": {
-                            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                            "type": "AdaptiveCard",
-                            "version": "1.2",
-                            "body": [
-                                {
-                                    "type": "TextBlock",
-                                    "text": "Critical Mail Alert",
-                                    "wrap": True,
-                                    "style": "heading",
-                                    "color": "attention"
-                                },
-                                {
-                                    "type": "FactSet",
-                                    "facts": [
-                                        {
-                                            "title": "件名",
-                                            "value": f"{subject}"
-                                        },
-                                        {
-                                            "title": "受信日時",
-                                            "value": f"{received_time}"
-                                        },
-                                        {
-                                            "title": "本文",
-                                            "value": f"{body}"
-                                        }
-                                    ]
-                                },
-                            ],
-                        }
-                    }
-                ]
-            }
-
-            # Set up the headers for the request
-            teams_webhook_url = "https://prod-07.japaneast.logic.azure.com:443/workflows/7846e0ca56c44bd7a1b2aeb34ac6a4da/triggers/manual/paths/invoke?api-version=2016-06-01&sp=%2Ftriggers%2Fmanual%2Frun&sv=1.0&sig=-TVc0SuSMCleLgFr2QrR2us-Jbe81poMuU3QhWHbnFo"
-            headers = {
-                "Content-Type": "application/json"
-            }
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(teams_webhook_url, data=json.dumps(teams_payload), headers=headers) as response:
-                        response.raise_for_status()
-                        print("Message successfully sent to Teams.")
-                        return await response.text()  # or response.json() if you expect a JSON response
-            except aiohttp.ClientError as err:
-                print(f"HTTP Error: {err}")
-            except Exception as e:
-                print(f"An error occurred: {e}")
-
-        return {"importance_score_result": {'score': response.score, 'description': response.description}}
+        received_time = convert_to_local_time(current_mail.get(
+            'received_datetime')).strftime("%Y-%m-%d %H:%M:%S")
+        # A confident critical keyword match alerts the helpdesk while the LLM is still running.
+        if should_alert_early(severity_match, current_mail):
+            early_alert = asyncio.create_task(_alert_unless_spam(
+                state, current_mail, received_time, reason=f"キーワード: {'、'.join(severity_match.keywords)}"))
+        # REST call rather than the LangChain client: cached content can't be combined
+        # with the tool-calling that with_structured_output relies on.
+        result = await model_router.call(
+            'importance_score', template, builder,
+            escalate_if=lambda r: r['score'] >= Config.MODEL_ROUTER_ESCALATE_SCORE,
+            strong_first=severity_match is not None and severity_match.band in ('critical', 'high'))
+        if not result:
+            raise ValueError("empty response")
+        if result['score'] >= Config.TEAMS_ALERT_MIN_SCORE and is_helpdesk_mail(current_mail) and not early_alert:
+            await _alert_unless_spam(state, current_mail, received_time)
+        return {"importance_score_result": {'score': result['score'], 'description': result['description']}}
     except Exception as e:
         print(
             f"Error invoking Gemini with structured output for importance score: {e}")
         return {"importance_score_result": {'score': 0, 'description': "JSON parsing error"}}
+    finally:
+        if early_alert:
+            await early_alert
 
 
 async def suggest_replies(state: AgentState):
     """Suggests three business Japanese replies for the email."""
     print("Running reply suggestions...")
     current_mail = state.get('current_mail')
-    body = current_mail.get('body')
-    sender = current_mail.get('sender')
-    subject = current_mail.get('subject')
     prompt = (
-        f"Analyze the following email content and determine if reply needed or not."
-        f"If a reply is needed, generate three reply options in Business Japanese: 'Concise', 'Confirm', and 'Polite'.\n"
-        f"Your response must be a single JSON object. The JSON must have a single key 'replies' which is an array of objects.\n"
-        f"Each reply object should have 'type' (enum: 'Concise', 'Confirm', 'Polite') and 'text' (string).\n"
-        f"You must format the reply text to be highly readable. Insert newline characters (`\n`) for clarity.\n"
-        f"If no reply is needed, the 'replies' array should be empty.\n\n"
-        f'Sender: {sender}\n'
-        f'Subject: {subject}\n'
-        f'Body:\n{body}\n\n'
+        SUGGEST_REPLIES.builder()
+        .add_mail(current_mail)
+        .add_context(state.get("attachment_summaries"), state.get('previous_conversation_summary'))
+        .build()
     )
-    if state.get("attachment_summaries"):
-        prompt += f'Attachment Summaries:\n{state["attachment_summaries"]}\n\n'
-    if state.get('previous_conversation_summary'):
-        prompt += f"Previous conversation summary: {state['previous_conversation_summary']}"
+    meter = token_meter.get()
+    if meter:
+        meter.sent(prompt)  # The LangChain client doesn't report usage; counted at prompt size
 
     try:
         llm_with_structured_output = gemini_llm.with_structured_output(
@@ -581,35 +482,36 @@ async def summarize_and_categorize_email(state: AgentState):
     """Categorizes the email into a predefined category."""
     print("Running email categorization...")
     current_mail = state.get('current_mail')
-    body = current_mail.get('body')
-    sender = current_mail.get('sender')
-    subject = current_mail.get('subject')
-    prompt = (
-        f"Provide a concise summary (2-3 sentences) of the email and its context within the conversation history in Japanese."
-        f"Categorize the email into one of the following categories in Japanese: "
-        f"'問い合わせ', '報告', etc.\n\n{body}"
-        f"'エラー' (Error), '修理' (Repair), '問い合わせ' (Inquiry), '報告' (Report), 'キャンペーン' (Campaign),'お知らせ' (Notice), 'プロモーション' (Promotion), 'スパム' (Spam), '有害' (Harmful), '返信不要' (No reply needed)."
-        f"Your response must be a single JSON object. The JSON should have two keys: 'summary' (string) and 'category' (string).\n\n"
-        f'Sender: {sender}\n'
-        f'Subject: {subject}\n'
-        f'Body:\n{body}\n\n'
+    builder = (
+        SUMMARIZE_AND_CATEGORIZE.builder()
+        .add_mail(current_mail)
+        .add_context(state.get("attachment_summaries"), state.get('previous_conversation_summary'))
     )
-    if state.get("attachment_summaries"):
-        prompt += f'Attachment Summaries:\n{state["attachment_summaries"]}\n\n'
-    if state.get('previous_conversation_summary'):
-        prompt += f"Previous conversation summary: {state['previous_conversation_summary']}"
     try:
-        llm_with_structured_output = gemini_llm.with_structured_output(
-            SummarizationAndCategoryResult)
-        response = await asyncio.to_thread(llm_with_structured_output.invoke, [HumanMessage(prompt)])
-        # print(response)
-        return {"summarization_and_category_result": {'category': response.category, 'summary': response.summary}}
+        result = await model_router.call('summarize_and_categorize', SUMMARIZE_AND_CATEGORIZE, builder)
+        if not result:
+            raise ValueError("empty response")
+        return {"summarization_and_category_result": {'category': result['category'], 'summary': result['summary']}}
     except Exception as e:
         print(
             f"Error invoking Gemini with structured output for summary/category: {e}")
         return {"summarization_and_category_result": {'summary': "JSON parsing error", 'category': "返信不要"}}
 
 
+def _publishing(node):
+    """
+    Wraps a node so its result is written to the message (and pushed) as soon as it
+    finishes; under speculative execution only once the spam check came back clean.
+    """
+    async def run(state):
+        update = await node(state)
+        gate = state.get('spam_gate')
+        if gate is None or await asyncio.shield(gate):
+            await publish(state, update)
+        return update
+    return run
+
+
 async def run_all_chosen_analyses(state: AgentState):
     """
     A single node that wraps the parallel execution of the selected analysis nodes.
@@ -620,11 +522,11 @@ async def run_all_chosen_analyses(state: AgentState):
     tasks = []
 
     if 'importance_score' in choices:
-        tasks.append(get_importance_score(state))
+        tasks.append(_publishing(get_importance_score)(state))
     if 'replies' in choices:
-        tasks.append(suggest_replies(state))
+        tasks.append(_publishing(suggest_replies)(state))
     if 'summary_and_category' in choices:
-        tasks.append(summarize_and_categorize_email(state))
+        tasks.append(_publishing(summarize_and_categorize_email)(state))
     try:
         results = await asyncio.gather(*tasks)
         combined_results = {}
@@ -636,6 +538,50 @@ async def run_all_chosen_analyses(state: AgentState):
         return {}
 
 
+def _is_spam_result(update):
+    result = update.get('spam_check_result') or {}
+    return bool(result.get('is_spam') or result.get('is_malicious'))
+
+
+async def speculative_analyses(state: AgentState):
+    """
+    Speculative mode (Config.SPECULATIVE_ANALYSIS): the chosen analyses start together
+    with the spam check instead of after it, and are cancelled if the mail is spam.
+    Teams alerts from the importance node wait for the spam verdict. A verdict known
+    locally (see _local_spam_verdict) starts no speculative branch.
+    """
+    local = await _local_spam_verdict(state)
+    if local:
+        # Nothing to overlap with: the verdict is already known, so only a clean mail gets its analyses.
+        async def known_verdict(_state):
+            return {"spam_check_result": local}
+        spam_update = await _publishing(known_verdict)(state)
+        if _is_spam_result(spam_update):
+            print("Spam detected. Skipping the analyses.")
+            return spam_update
+        return {**spam_update, **await run_all_chosen_analyses(state)}
+    print("Running spam check with speculative analyses...")
+    gate = asyncio.get_running_loop().create_future()
+    branch_state = {**state, 'spam_gate': gate}
+    choices = state['user_choices']
+    branches = []
+    if 'importance_score' in choices:
+        branches.append(_publishing(get_importance_score)(branch_state))
+    if 'replies' in choices:
+        branches.append(_publishing(suggest_replies)(branch_state))
+    if 'summary_and_category' in choices:
+        branches.append(_publishing(summarize_and_categorize_email)(branch_state))
+    spam_update, results = await speculation.run(
+        _publishing(_llm_spam_check)(state), branches, _is_spam_result, gate=gate)
+    combined_results = dict(spam_update)
+    if results is None:
+        print("Spam detected. Discarding the speculative analyses.")
+    else:
+        for res in results:
+            combined_results.update(res)
+    return combined_results
+
+
 def spam_router(state: AgentState) -> str:
     """
     Determines the next step based on the spam check result.
@@ -659,7 +605,7 @@ workflow = StateGraph(AgentState)
 
 # Define the graph structure with the new node
 workflow.add_node("initial_processing", initial_processing_and_parallel_nodes)
-workflow.add_node("spam_check", check_spam_and_malicious)
+workflow.add_node("spam_check", _publishing(check_spam_and_malicious))
 workflow.add_node("importance_score", get_importance_score)
 workflow.add_node("suggest_replies", suggest_replies)
 workflow.add_node("summarize_and_categorize", summarize_and_categorize_email)
@@ -681,23 +627,77 @@ workflow.add_edge("run_all_chosen_analyses", END)
 # Compile the graph with the SqliteSaver checkpointer
 agent = workflow.compile()
 
+# Speculative mode: the spam check and the chosen analyses run in one node.
+speculative_workflow = StateGraph(AgentState)
+speculative_workflow.add_node("initial_processing", initial_processing_and_parallel_nodes)
+speculative_workflow.add_node("speculative_analyses", speculative_analyses)
+speculative_workflow.set_entry_point("initial_processing")
+speculative_workflow.add_edge("initial_processing", "speculative_analyses")
+speculative_workflow.add_edge("speculative_analyses", END)
+speculative_agent = speculative_workflow.compile()
 
-async def run_analysis_agent_stateful_async(thread_id: str, email_data: dict, choices: Optional[List[str]] = None):
+
+async def _save_analysis(conv_id, user_email, msg_id, analyzing_results, extra_fields=None, unless_completed=False):
     """
-    Runs the LangGraph agent in a stateful manner.
-    The `thread_id` is used to load and save the state.
+    Saves a message's analysis and folds its summary into the conversation's rolling summary.
+    With `unless_completed` a completed analysis already stored is left as it is.
     """
-    logger.info("Async processing started for thread_id=%s", thread_id)
+    update = {'messages.$[message].analysis': analyzing_results}
+    for key, value in (extra_fields or {}).items():
+        update[f'messages.$[message].{key}'] = value
+    message_filter = {"message.message_id": msg_id}
+    if unless_completed:
+        message_filter["message.analysis.completed"] = {'$ne': True}
+    try:
+        result = await inbox_conversations_collection_async.update_one(
+            {
+                'conv_id': conv_id,
+                'email_address': user_email,
+                'messages.message_id': msg_id
+            },
+            {
+                '$set': update
+            },
+            array_filters=[
+                message_filter
+            ]
+        )
+    except Exception as e:
+        print(f"Error updating database with analyzing_results: {e}")
+        return
+    if unless_completed and not result.modified_count:
+        print(f"Message '{msg_id}' was analysed meanwhile, keeping that analysis")
+        return
+    print(
+        f"DB Update: Saved analyzing_results for message '{msg_id}'")
+    await fold_message(conv_id, user_email, msg_id, analyzing_results.get('summary'))
+
+
+async def _run_agent(thread_id, email_data, current_mail, choices, reused=None, duplicate_of=None):
+    """
+    Runs the LangGraph agent on a stored mail and saves its analysis; returns the analysis.
+    `reused` holds node results taken over from a near-duplicate original or, for the
+    spam check, from the same mail in another mailbox: those nodes are not run again.
+    The header rules and triage always run, and a positive spam check discards the
+    reused analysis results.
+    """
+    reused = reused or {}
     async with aiosqlite.connect(":memory:") as conn:
         sqlite_saver = AsyncSqliteSaver(conn=conn)
         config = {"configurable": {"thread_id": thread_id},
                   "checkpointer": sqlite_saver}
-        current_mail_doc = await inbox_conversations_collection_async.find_one(
-            {'conv_id': email_data.get('conv_id'), "email_address": email_data.get(
-                'user_email'), 'messages.message_id': email_data.get('msg_id')},
-            {'_id': 0, 'messages.$': 1}
-        )
-        current_mail = current_mail_doc['messages'][0]
+
+        summary_result = None
+        triage = triage_message(current_mail)
+        if triage and triage['skip']:
+            # An obvious promotion / no-reply mail: keep the cheap checks, skip the reply and summary calls.
+            print(f"Triage: {triage['category']} ({triage['confidence']:.2f}), skipping replies and summary")
+            choices = [c for c in choices if c not in ('replies', 'summary_and_category')]
+            summary_result = {'summary': '', 'category': triage['category']}
+        header_rules = evaluate_headers(current_mail)
+        if header_rules['reply_needed'] is False and 'replies' in choices:
+            print(f"Header rules: no reply needed ({', '.join(header_rules['reasons'])}), skipping replies")
+            choices.remove('replies')
 
         initial_state = {
             'email_provider': email_data['email_provider'],
@@ -706,61 +706,197 @@ async def run_analysis_agent_stateful_async(thread_id: str, email_data: dict, ch
             'user_email': email_data.get('user_email'),
             'msg_id': email_data.get('msg_id'),
             'previous_conversation_summary': None,
-            'user_choices': choices if choices is not None else [],
+            'user_choices': choices,
+            'header_rules': header_rules,
             'attachment_summaries': None,
             'importance_score_result': None,
             'replies_result': None,
-            'summarization_and_category_result': None,
+            'summarization_and_category_result': summary_result,
             'spam_check_result': None,
         }
+        if reused:
+            initial_state.update(reused)
+            initial_state['user_choices'] = [c for c in choices if REUSED_RESULTS.get(c) not in reused]
 
-        final_state = await agent.ainvoke(initial_state, config=config)
+        graph = speculative_agent if Config.SPECULATIVE_ANALYSIS else agent
+        final_state = await graph.ainvoke(initial_state, config=config)
+        if reused and _is_spam_result(final_state):
+            final_state = {**final_state, **{key: None for key in reused if key != 'spam_check_result'}}
 
         # logger.info("importance_score_result: %s", final_state.get("importance_score_result"))
         # logger.info("replies_result: %s", final_state.get("replies_result"))
         # logger.info("summarization_and_category_result: %s", final_state.get("summarization_and_category_result"))
 
-    analyzing_results = {}
-
-    if final_state.get("spam_check_result"):
-        analyzing_results["is_spam"] = final_state["spam_check_result"].get(
-            'is_spam')
-        analyzing_results["is_malicious"] = final_state["spam_check_result"].get(
-            'is_malicious')
-    if final_state.get("importance_score_result"):
-        analyzing_results["importance_score"] = final_state["importance_score_result"].get(
-            'score')
-        analyzing_results["importance_description"] = final_state["importance_score_result"].get(
-            'description')
-    if final_state.get("summarization_and_category_result"):
-        analyzing_results["summary"] = final_state["summarization_and_category_result"].get(
-            'summary')
-        analyzing_results["category"] = final_state["summarization_and_category_result"].get(
-            'category')
-    if final_state.get("replies_result"):
-        analyzing_results["replies"] = final_state["replies_result"]
+    # The nodes have already published their fields; this write replaces the analysis as a whole.
+    analyzing_results, ready = analysis_fields(final_state)
+    analyzing_results["ready"] = ready
+    if triage:
+        analyzing_results["triage"] = triage
+    if header_rules['reasons']:
+        analyzing_results["header_rules"] = header_rules
+    if email_data.get('replies_deferred'):
+        analyzing_results["replies_deferred"] = True
+    extra_fields = None
+    if duplicate_of:
+        analyzing_results["duplicate_of"] = duplicate_of
+        extra_fields = {'fingerprint.group': duplicate_of['group']}
     analyzing_results["completed"] = True
-    if analyzing_results:
-        try:
-            await inbox_conversations_collection_async.update_one(
-                {
-                    'conv_id': final_state['conv_id'],
-                    'email_address': final_state['user_email'],
-                    'messages.message_id': final_state['msg_id']
-                },
-                {
-                    '$set': {
-                        'messages.$[message].analysis': analyzing_results
-                    }
-                },
-                array_filters=[
-                    {"message.message_id": final_state['msg_id']}
-                ]
-            )
-            print(
-                f"DB Update: Saved analyzing_results for message '{final_state['msg_id']}'")
-        except Exception as e:
-            print(f"Error updating database with analyzing_results: {e}")
+    await _save_analysis(final_state['conv_id'], final_state['user_email'], final_state['msg_id'], analyzing_results,
+                         extra_fields)
 
     print(f"\n--- Analysis complete for thread ID: {thread_id} ---")
-    return final_state
+    return analyzing_results
+
+
+async def _run_history_pass(email_data, current_mail):
+    """
+    Summary-only pass for an earlier message of a thread imported at once: no attachment,
+    spam, importance or reply calls, just what the next messages need as history.
+    A message that already has a completed analysis (e.g. from the full-analysis
+    chain of another import of the thread) is left alone.
+    """
+    if current_mail.analysis.get('completed'):
+        print(f"Message '{email_data.get('msg_id')}' is already analysed, skipping the history pass")
+        return current_mail.analysis
+    state = {
+        'current_mail': current_mail,
+        'conv_id': email_data.get('conv_id'),
+        'user_email': email_data.get('user_email'),
+        'msg_id': email_data.get('msg_id'),
+        'attachment_summaries': None,
+    }
+    state.update(await generate_previous_conversation_summary(state))
+    result = (await summarize_and_categorize_email(state))['summarization_and_category_result']
+    analyzing_results = {
+        'summary': result.get('summary'),
+        'category': result.get('category'),
+        'history_pass': True,
+        'completed': True,
+    }
+    await _save_analysis(state['conv_id'], state['user_email'], state['msg_id'], analyzing_results,
+                         unless_completed=True)
+    return analyzing_results
+
+
+async def _fan_out(current_mail, email_data, analyzing_results):
+    """
+    Shares the owner's spam verdict and attachment summaries with the other mailboxes
+    that received the same mail and runs their analyses, which take those over.
+    """
+    conv_id, user_email, msg_id = email_data.get('conv_id'), email_data.get('user_email'), email_data.get('msg_id')
+    analysed_mail = await load_mail_view(conv_id, user_email, msg_id) or current_mail  # With the new attachment summaries
+    shared, others = await shared_analysis.complete(
+        current_mail, msg_id, shared_analysis.shared_part(analyzing_results, analysed_mail))
+    for recipient in others:
+        shared_analysis.requeue(recipient)
+    if others:
+        print(f"Shared analysis {shared['_id']}: shared with {len(others)} other mailbox(es)")
+
+
+async def run_analysis_agent_stateful_async(thread_id: str, email_data: dict, choices: Optional[List[str]] = None):
+    """
+    Runs the LangGraph agent in a stateful manner.
+    The `thread_id` is used to load and save the state.
+
+    The same mail delivered to several mailboxes is checked once: the first run owns
+    the shared analysis, the others take over its spam verdict and attachment
+    summaries and run the history-dependent nodes on their own conversation.
+    """
+    logger.info("Async processing started for thread_id=%s", thread_id)
+    conv_id, user_email, msg_id = email_data.get('conv_id'), email_data.get('user_email'), email_data.get('msg_id')
+    current_mail = await load_mail_view(conv_id, user_email, msg_id)
+    if current_mail is None:
+        print(f"Message '{msg_id}' not found in thread '{conv_id}', skipping analysis")
+        return None
+    choices = list(choices) if choices is not None else []
+    if email_data.get('history_pass'):
+        return await _run_history_pass(email_data, current_mail)
+
+    # A user override (/not_malicious) re-runs the analysis, so only fresh mails share or reuse one.
+    fresh = 'is_spam' not in current_mail.get('analysis', {})
+    shared_state = None
+    reused, duplicate_of = {}, None
+    if fresh:
+        shared_state, shared = await shared_analysis.claim(
+            current_mail, shared_analysis.recipient_record(email_data, choices))
+        if shared_state == shared_analysis.RUNNING:
+            print(f"Shared analysis: another mailbox is analysing message '{msg_id}', it will share the result")
+            return None
+        if shared_state == shared_analysis.DONE:
+            print(f"Shared analysis {shared['_id']}: taking over the spam verdict and attachment summaries")
+            await shared_analysis.adopt_attachment_summaries(shared, current_mail, conv_id, user_email, msg_id)
+            reused.update(shared_analysis.shared_results(shared))
+
+    try:
+        duplicate = await find_near_duplicate(user_email, current_mail) if fresh else None
+        if duplicate:
+            original, distance = duplicate
+            same_numbers = same_figures(original, current_mail)
+            print(f"Near-duplicate of {original['message_id']} ({distance} bits, "
+                  f"{'same' if same_numbers else 'different'} numbers), reusing its analysis")
+            reused.update(reused_results(original, choices, same_numbers))
+            duplicate_of = duplicate_info(original, distance, same_numbers)
+        analyzing_results = await _run_agent(thread_id, email_data, current_mail, choices, reused, duplicate_of)
+    except Exception:
+        if shared_state == shared_analysis.OWNER:
+            for recipient in await shared_analysis.release(current_mail, msg_id):
+                shared_analysis.requeue(recipient)
+        raise
+
+    if shared_state == shared_analysis.OWNER:
+        await _fan_out(current_mail, email_data, analyzing_results)
+    maybe_prefetch(email_data, analyzing_results)
+    return analyzing_results
+
+
+async def generate_replies_async(conv_id, user_email, msg_id, reason):
+    """
+    Generates the reply suggestions of an analysed mail on their own (utils/lazy_replies.py)
+    and publishes them like a node result. Mails already having replies, spam,
+    mails with a generation in progress and mails whose last generation failed less
+    than REPLY_RETRY_BACKOFF ago (analysis.replies_failed_at) are skipped.
+    """
+    now = datetime.now(timezone.utc)
+    stale = now - timedelta(seconds=Config.REPLY_CLAIM_TIMEOUT)
+    retry_after = now - timedelta(seconds=Config.REPLY_RETRY_BACKOFF)
+    claimed = await inbox_conversations_collection_async.update_one(
+        {'conv_id': conv_id, 'email_address': user_email,
+         'messages': {'$elemMatch': {
+             'message_id': msg_id, 'analysis.completed': True, 'analysis.replies': {'$exists': False},
+             'analysis.is_spam': {'$ne': True}, 'analysis.is_malicious': {'$ne': True},
+             'analysis.replies_failed_at': {'$not': {'$gte': retry_after}},
+             '$or': [{'analysis.replies_started_at': {'$exists': False}}, {'analysis.replies_started_at': {'$lt': stale}}]}}},
+        {'$set': {'messages.$.analysis.replies_started_at': now}})
+    if not claimed.modified_count:
+        print(f"Replies for message '{msg_id}' exist, are being generated or failed recently, skipping")
+        return None
+    replies = None
+    try:
+        current_mail = await load_mail_view(conv_id, user_email, msg_id)
+        state = {
+            'current_mail': current_mail,
+            'conv_id': conv_id,
+            'user_email': user_email,
+            'msg_id': msg_id,
+            'attachment_summaries': '\n'.join(
+                f"File Name: {a['name']}\t\t Summary: {a['attachment_summary']}"
+                for a in current_mail.attachments if a.get('attachment_summary')) or None,
+        }
+        state.update(await generate_previous_conversation_summary(state))
+        update = await suggest_replies(state)
+        replies = update['replies_result']
+        await publish(state, update)
+        if replies:
+            print(f"Replies generated for message '{msg_id}' ({reason})")
+        else:
+            print(f"Reply generation failed for message '{msg_id}' ({reason}), retrying in {Config.REPLY_RETRY_BACKOFF}s at the earliest")
+        return replies or None
+    finally:
+        # An empty result or an error is recorded, so polling /replies doesn't retry it at once.
+        release = {'$unset': {'messages.$.analysis.replies_started_at': ''}}
+        if not replies:
+            release['$set'] = {'messages.$.analysis.replies_failed_at': datetime.now(timezone.utc)}
+        else:
+            release['$unset']['messages.$.analysis.replies_failed_at'] = ''
+        await inbox_conversations_collection_async.update_one(
+            {'conv_id': conv_id, 'email_address': user_email, 'messages.message_id': msg_id}, release)
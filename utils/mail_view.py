@@ -0,0 +1,89 @@
+"""
+Slim view of a stored message for the analysis agent.
+
+The agent state used to carry the whole message document, including the raw provider
+payload and the base64 content of every attachment, and the checkpointer copied it at
+each step. The view keeps only the fields the prompts and local checks read; attachments
+are metadata plus their position in the message, and their bytes are loaded by
+reference in the attachment node (load_attachment_bytes).
+"""
+from dataclasses import dataclass, field, fields
+from datetime import datetime
+from typing import Optional
+
+from database_async import inbox_conversations_collection_async
+
+ATTACHMENT_FIELDS = ('id', 'name', 'contentType', 'size', 'isInline', 'triage', 'attachment_summary')
+
+
+@dataclass(slots=True)
+class MailView:
+    message_id: str
+    internet_message_id: Optional[str] = None
+    content_hash: Optional[str] = None
+    provider: Optional[str] = None
+    sender: Optional[str] = None
+    receivers: Optional[str] = None
+    cc: Optional[str] = None
+    subject: Optional[str] = None
+    body: Optional[str] = None
+    received_datetime: Optional[datetime] = None
+    previous_messages_summary: Optional[str] = None
+    headers: dict = field(default_factory=dict)
+    fingerprint: Optional[dict] = None
+    analysis: dict = field(default_factory=dict)
+    attachments: list = field(default_factory=list)  # Metadata with 'has_content' and 'index', no bytes
+
+    def get(self, key, default=None):
+        """dict-style access, so helpers written for message documents accept the view."""
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+VIEW_FIELDS = tuple(f.name for f in fields(MailView) if f.name != 'attachments')
+
+
+def _message_expr(msg_id):
+    return {'$arrayElemAt': [
+        {'$filter': {'input': '$messages', 'as': 'msg', 'cond': {'$eq': ['$$msg.message_id', msg_id]}}}, 0]}
+
+
+async def load_mail_view(conv_id, user_email, msg_id):
+    """
+    Loads one message as a MailView. The projection runs in Mongo, so the raw payload
+    and the attachment contents never leave the database. Returns None when not found.
+    """
+    attachment = {f: f'$$a.{f}' for f in ATTACHMENT_FIELDS}
+    attachment['has_content'] = {'$gt': [{'$strLenBytes': {'$ifNull': ['$$a.contentBytes', '']}}, 0]}
+    pipeline = [
+        {'$match': {'conv_id': conv_id, 'email_address': user_email, 'messages.message_id': msg_id}},
+        {'$limit': 1},
+        {'$project': {'_id': 0, 'm': _message_expr(msg_id)}},
+        {'$project': {
+            **{f: f'$m.{f}' for f in VIEW_FIELDS},
+            'attachments': {'$map': {'input': {'$ifNull': ['$m.attachments', []]}, 'as': 'a', 'in': attachment}},
+        }},
+    ]
+    docs = await (await inbox_conversations_collection_async.aggregate(pipeline)).to_list(length=1)
+    if not docs or not docs[0].get('message_id'):
+        return None
+    doc = docs[0]
+    for index, item in enumerate(doc['attachments']):
+        item['index'] = index
+    return MailView(**{k: v for k, v in doc.items() if v is not None})
+
+
+async def load_attachment_bytes(conv_id, user_email, msg_id, index):
+    """The stored (base64) content of the message's attachment at `index`, or None."""
+    pipeline = [
+        {'$match': {'conv_id': conv_id, 'email_address': user_email, 'messages.message_id': msg_id}},
+        {'$limit': 1},
+        {'$project': {'_id': 0, 'a': {'$arrayElemAt': [
+            {'$let': {'vars': {'m': _message_expr(msg_id)}, 'in': {'$ifNull': ['$$m.attachments', []]}}}, index]}}},
+        {'$project': {'data': '$a.contentBytes'}},
+    ]
+    docs = await (await inbox_conversations_collection_async.aggregate(pipeline)).to_list(length=1)
+    return docs[0].get('data') if docs else None
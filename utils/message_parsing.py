@@ -1,10 +1,13 @@
 import base64
-from bs4 import BeautifulSoup
 import re
 import io
+import unicodedata
 from PyPDF2 import PdfReader # pip install pypdf2
 from docx import Document # pip install python-docx
 
+from utils.html_text import parse_mail_html, ParsedHtml
+from utils.token_utils import estimate_tokens
+
 patterns = [
         re.compile(r'[-—・]{4,}'),      # Matches 4 or more dashes, em dashes, or interpuncts
         re.compile(r'(\.{3,}\-){2,}'),  # Matches sequences like ...- that repeat two or more times
@@ -14,24 +17,16 @@ patterns = [
         re.compile(r'(\s*・～\s*){4,}'), # Matches the ・～ sequence with optional whitespace, repeated 4+ times
     ]
 
-def get_unique_body_outlook(body_content):
-    body_plain = body_content.get('content', 'No body available.')
-    cleaned_body = ""
-    if body_content.get('contentType') == 'html':
-        soup = BeautifulSoup(body_plain, 'html.parser')
-        body_plain = soup.get_text().splitlines()
-        non_empty_lines = [line for line in body_plain if line.strip()]
-        cleaned_body = "\n".join(non_empty_lines)
-    return cleaned_body
-
-def get_inline_attachments_outlook(body_content):
+def parse_outlook_body(body_content):
+    """
+    Parses an Outlook uniqueBody once, returning the new text (.text), the marked-up
+    quotes split off from it (.quoted_text) and the cid: references of inline images (.cids).
+    """
     body_plain = body_content.get('content', 'No body available.')
-    cid_references = set()
     if body_content.get('contentType') == 'html':
-        soup = BeautifulSoup(body_plain, 'html.parser')
-        cid_pattern = re.compile(r'src="cid:(.*?)"')
-        cid_references = set(cid_pattern.findall(str(soup)))
-    return cid_references
+        return parse_mail_html(body_plain, image_alt_placeholders=False)
+    non_empty_lines = [line for line in body_plain.splitlines() if line.strip()]
+    return ParsedHtml("\n".join(non_empty_lines), "", set(), [])
 
 
 # def extract_email_thread_outlook(body_content, delim1, delim2):
@@ -208,52 +203,132 @@ def parse_email_body_and_attachments(message_payload, message_type):
     
     return plain_body_content, attachments_data
 
+# Markers that start the quoted history, in Japanese and English. Every pattern is
+# matched at the start of a line; the earliest match in the body is the split point.
+QUOTE_MARKERS = [
+    # -----Original Message----- / -----元のメッセージ----- / ---------- Forwarded message ---------
+    ('original_message', r'-{3,}\s*(?:Original Message|Forwarded message|元のメッセージ|オリジナル ?メッセージ|転送(?:された)?メッセージ)\s*-{3,}'),
+    # Outlook header block, optionally below a ____ rule:
+    # "差出人: ..." / "From: ..." followed within three lines by "送信日時:" / "Sent:" / "Date:"
+    ('header_block', r'(?:_{10,}[ \t]*\n\s*)?(?:From|差出人|送信者)[ \t]*[:：][^\n]*(?:\n[^\n]*){0,2}?\n[ \t]*(?:Sent|Date|送信日時|送信日|日時)[ \t]*[:：]'),
+    # "On Mon, Jan 1, 2024 at 10:00 Taro <taro@example.com> wrote:" (may wrap onto a second line)
+    ('attribution_en', r'On [^\n]{4,200}?(?:\n[^\n]{0,200}?)?wrote[ \t]*:[ \t]*$'),
+    # "2024年1月1日(月) 10:00 山田 太郎 <taro@example.co.jp>:" / "2024/01/01 10:00、山田様のメッセージ:"
+    ('attribution_ja', r'\d{4}\s*[年/.-]\s*\d{1,2}\s*[月/.-]\s*\d{1,2}日?[^\n]{0,120}?(?:<[^>\n]+@[^>\n]+>|wrote|さん|様|より|のメッセージ|書きました)[^\n]{0,40}[:：][ \t]*$'),
+    # Two or more consecutive "> " quoted lines
+    ('quote_block', r'[>＞][^\n]*\n[ \t]*[>＞]'),
+]
+
+
+def _compile_quote_markers(markers):
+    """One compiled alternation, so a single scan of the body finds the earliest marker."""
+    alternatives = '|'.join(f'(?P<{name}>{pattern})' for name, pattern in markers)
+    return re.compile(f'^[ \\t]*(?:{alternatives})', re.MULTILINE)
+
+
+_QUOTE_SPLIT_RE = _compile_quote_markers(QUOTE_MARKERS)
+
+
+def find_quote_start(body_plain, pattern=_QUOTE_SPLIT_RE):
+    """Returns (index, marker name) of the first quote marker in the body, or (None, None)."""
+    match = pattern.search(body_plain)
+    if not match:
+        return None, None
+    return match.start(), match.lastgroup
+
+
 def extract_email_thread(body_plain, *separators):
     """
     Extracts the current message and previous conversation history from a plain text email body.
-    It splits the body based on common email client reply separators.
+    It splits the body at the first reply/forward marker in QUOTE_MARKERS (Japanese and
+    English Outlook/Gmail headers, attribution lines, "> " blocks). Extra separators are
+    matched literally at the start of a line.
     Returns a tuple: (current_message, previous_history_string)
     """
-    # Common separators used by email clients
-    default_separators = [
-        "-----Original Message-----",
-        "From:", # Often precedes quoted history
-        "On ", # "On [Date], [Sender] wrote:"
-        "Sent from my iPhone", # Common mobile signature, often at end of current message
-        "Sent from my Android",
-        "Sent from my Samsung device",
-        "________________________________",
-        "--- Forwarded message ---",
-        "---------- Forwarded message ---------"
-    ]
-    all_separators = list(separators) + default_separators
+    if not body_plain:
+        return "", ""
+    pattern = _QUOTE_SPLIT_RE
+    if separators:
+        extra = '|'.join(re.escape(sep) for sep in separators)
+        pattern = _compile_quote_markers([('custom', extra)] + QUOTE_MARKERS)
+    split_point, _ = find_quote_start(body_plain, pattern)
+    if split_point is None:
+        # If no clear separator, the whole body is considered the current message
+        return body_plain.strip(), ""
+    return body_plain[:split_point].strip(), body_plain[split_point:].strip()
 
-    current_message_parts = []
-    history_parts = []
-    in_history = False
 
-    lines = body_plain.splitlines()
-    for line in lines:
-        is_separator = False
-        for sep in all_separators:
-            if line.strip().startswith(sep):
-                is_separator = True
-                in_history = True
-                break
-        
-        if is_separator:
-            history_parts.append(line) # Include the separator in history
-        elif in_history:
-            history_parts.append(line)
-        else:
-            current_message_parts.append(line)
-    
-    current_message = "\n".join(current_message_parts).strip()
-    previous_history = "\n".join(history_parts).strip()
+# Decorative characters that Japanese signatures and banners are drawn with.
+_RULE_CHARS = '-—―─━═=＝_＿*＊~～〜・◆◇■□●○★☆◎※'
+# "--" (RFC 3676) or any line with a run of four or more rule characters, e.g. "━━━━ 株式会社サンプル ━━━━".
+_SIGNATURE_SEPARATOR = re.compile(rf'^\s*(?:--|.*?(?:[{_RULE_CHARS}]\s*){{4,}}.*?)\s*$')
+_CONTACT_MARKERS = re.compile(
+    r'TEL|Tel|tel|FAX|Fax|fax|〒|E-?mail|e-?mail|MAIL|Mail|URL|https?://|www\.|携帯|Mobile|電話|住所|内線|[\w.+-]+@[\w-]+\.\w',
+)
+_LEGAL_FOOTER = re.compile(
+    r'機密|守秘|秘密情報|誤って|誤送信|削除して|破棄して|免責|confidential|intended recipient|privileged|disclaimer',
+    re.IGNORECASE,
+)
+_MOBILE_SIGNATURE = re.compile(r'^(?:Sent from my [^\n]+|Get Outlook for [^\n]+|[^\n]{1,20}から送信)$')
+_SPACE_RUN = re.compile(r'[ \t\u3000]+')
+
+SIGNATURE_MAX_LINES = 15
+
+
+def _strip_signature(lines):
+    """
+    Cuts the signature: the last separator line in the final SIGNATURE_MAX_LINES lines
+    whose tail holds at least two contact markers (TEL, FAX, 〒, mail, URL, ...).
+    """
+    start = max(0, len(lines) - SIGNATURE_MAX_LINES)
+    for i in range(len(lines) - 1, start - 1, -1):
+        if _SIGNATURE_SEPARATOR.match(lines[i]):
+            tail = "\n".join(lines[i + 1:])
+            if len(_CONTACT_MARKERS.findall(tail)) >= 2:
+                return lines[:i]
+    return lines
+
+
+def _strip_trailing_footers(lines):
+    """Drops trailing legal disclaimers (paragraphs with confidentiality wording) and mobile signatures."""
+    while lines:
+        if _MOBILE_SIGNATURE.match(lines[-1].strip()):
+            lines = lines[:-1]
+            continue
+        # Last paragraph = lines after the last blank line.
+        para_start = len(lines)
+        while para_start > 0 and lines[para_start - 1].strip():
+            para_start -= 1
+        paragraph = "\n".join(lines[para_start:])
+        if para_start > 0 and len(lines) - para_start <= SIGNATURE_MAX_LINES and _LEGAL_FOOTER.search(paragraph):
+            lines = lines[:para_start]
+            while lines and not lines[-1].strip():
+                lines = lines[:-1]
+            continue
+        return lines
+    return lines
 
-    # If no clear separator, the whole body is considered the current message
-    if not previous_history and current_message == body_plain.strip():
-        return body_plain.strip(), ""
-    
-    return current_message, previous_history
 
+def compact_body(body_plain):
+    """
+    Compacts a mail body before it is stored and sent to the LLM: drops the signature
+    block, legal footers and mobile signatures, removes the separator/banner `patterns`,
+    applies NFKC normalization (full-width ASCII, half-width kana) and collapses whitespace.
+    Returns (compact_body, {'raw': tokens_before, 'compact': tokens_after}).
+    """
+    if not body_plain:
+        return body_plain, {'raw': 0, 'compact': 0}
+    lines = body_plain.splitlines()
+    lines = _strip_trailing_footers(_strip_signature(lines))
+    compact_lines = []
+    for line in lines:
+        # The banner patterns are applied line by line so their \s* can't join lines,
+        # and before NFKC, which would rewrite the full-width ＿ and ～ they look for.
+        for pattern in patterns:
+            line = pattern.sub('', line)
+        line = _SPACE_RUN.sub(' ', unicodedata.normalize('NFKC', line)).strip()
+        # Keep a single blank line between paragraphs.
+        if line or (compact_lines and compact_lines[-1]):
+            compact_lines.append(line)
+    compact = "\n".join(compact_lines).strip()
+    return compact, {'raw': estimate_tokens(body_plain), 'compact': estimate_tokens(compact)}
@@ -0,0 +1,141 @@
+import math
+import time
+from collections import Counter
+
+from config import Config
+from utils.gemini_cache import call_gemini_template_structured
+
+# Escalation reasons
+INVALID = 'schema'
+LOW_CONFIDENCE = 'low_confidence'
+POLICY = 'policy'
+DIRECT = 'direct'  # Sent to the strong model without a fast attempt
+
+
+def schema_errors(schema, value, path='$'):
+    """Checks a parsed response against a Gemini responseSchema; returns a list of problems."""
+    kind = (schema.get('type') or '').upper()
+    if kind == 'OBJECT':
+        if not isinstance(value, dict):
+            return [f"{path}: expected object"]
+        errors = [f"{path}.{key}: missing" for key in schema.get('required', []) if key not in value]
+        for key, prop in schema.get('properties', {}).items():
+            if key in value:
+                errors += schema_errors(prop, value[key], f"{path}.{key}")
+        return errors
+    if kind == 'ARRAY':
+        if not isinstance(value, list):
+            return [f"{path}: expected array"]
+        return [e for i, item in enumerate(value) for e in schema_errors(schema.get('items', {}), item, f"{path}[{i}]")]
+    if kind in ('NUMBER', 'INTEGER'):
+        ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+        return [] if ok else [f"{path}: expected number"]
+    if kind == 'BOOLEAN':
+        return [] if isinstance(value, bool) else [f"{path}: expected boolean"]
+    if kind == 'STRING':
+        if not isinstance(value, str):
+            return [f"{path}: expected string"]
+        if schema.get('enum') and value not in schema['enum']:
+            return [f"{path}: {value!r} not in enum"]
+    return []
+
+
+class _NodeStats:
+    __slots__ = ('calls', 'escalations', 'reasons', 'fast_seconds', 'fast_calls', 'strong_seconds', 'strong_calls')
+
+    def __init__(self):
+        self.calls = 0
+        self.escalations = 0
+        self.reasons = Counter()
+        self.fast_seconds = self.strong_seconds = 0.0
+        self.fast_calls = self.strong_calls = 0
+
+
+class ModelRouter:
+    """
+    Cascade for structured Gemini calls: the fast model answers first and the strong
+    model is only called when the fast answer fails schema validation, its average
+    token log-probability is low, or the node's escalate_if policy asks for it
+    (e.g. a high importance score). Escalation rates and latencies are kept per node.
+    """
+
+    def __init__(self, fast_model, strong_model, min_confidence, report_every):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.min_confidence = min_confidence
+        self.report_every = report_every
+        self.stats = {}
+
+    def _escalation_reason(self, template, result, metadata, escalate_if):
+        if result is None or schema_errors(template.response_schema, result):
+            return INVALID
+        avg_logprobs = metadata.get('avg_logprobs')
+        if avg_logprobs is not None and math.exp(avg_logprobs) < self.min_confidence:
+            return LOW_CONFIDENCE
+        if escalate_if and escalate_if(result):
+            return POLICY
+        return None
+
+    async def _timed_call(self, template, builder, temp, model, metadata):
+        start = time.perf_counter()
+        result = await call_gemini_template_structured(template, builder, temp, model, metadata=metadata)
+        return result, time.perf_counter() - start
+
+    async def call(self, node, template, builder, temp=0.3, escalate_if=None, strong_first=False):
+        """
+        Runs a template call through the cascade and returns the parsed response
+        (None if both models failed). `escalate_if(result)` is the node's policy;
+        strong_first skips the fast model, e.g. for mails pre-matched as critical.
+        """
+        stats = self.stats.setdefault(node, _NodeStats())
+        stats.calls += 1
+        fast_result = None
+        reason = DIRECT
+        if not strong_first:
+            metadata = {}
+            fast_result, seconds = await self._timed_call(template, builder, temp, self.fast_model, metadata)
+            stats.fast_calls += 1
+            stats.fast_seconds += seconds
+            reason = self._escalation_reason(template, fast_result, metadata, escalate_if)
+            if reason is None:
+                self._maybe_report()
+                return fast_result
+            print(f"Model router: escalating '{node}' to {self.strong_model} ({reason})")
+        stats.escalations += 1
+        stats.reasons[reason] += 1
+        result, seconds = await self._timed_call(template, builder, temp, self.strong_model, {})
+        stats.strong_calls += 1
+        stats.strong_seconds += seconds
+        self._maybe_report()
+        if result is None or schema_errors(template.response_schema, result):
+            # Keep a usable fast answer if the strong model failed too.
+            return fast_result if reason != INVALID else result
+        return result
+
+    def report(self):
+        """
+        Per node: escalation rate, reasons, mean latency per model and the time saved
+        against sending every call to the strong model (estimated from the mean
+        strong-model latency seen on escalations).
+        """
+        lines = []
+        for node, s in self.stats.items():
+            fast_mean = s.fast_seconds / s.fast_calls if s.fast_calls else 0.0
+            strong_mean = s.strong_seconds / s.strong_calls if s.strong_calls else None
+            line = (f"{node}: {s.calls} calls, {s.escalations} escalated ({100 * s.escalations / s.calls:.0f}%"
+                    f"{', ' + ', '.join(f'{r} {n}' for r, n in s.reasons.items()) if s.reasons else ''}), "
+                    f"fast {fast_mean * 1000:.0f} ms")
+            if strong_mean is not None:
+                saved = s.calls * strong_mean - s.fast_seconds - s.strong_seconds
+                line += f", strong {strong_mean * 1000:.0f} ms, saved {saved:.1f}s"
+            lines.append(line)
+        return lines
+
+    def _maybe_report(self):
+        total = sum(s.calls for s in self.stats.values())
+        if self.report_every and total % self.report_every == 0:
+            print("Model router stats:\n  " + "\n  ".join(self.report()))
+
+
+model_router = ModelRouter(Config.GEMINI_FAST_MODEL, Config.GEMINI_STRONG_MODEL,
+                           Config.MODEL_ROUTER_MIN_CONFIDENCE, Config.MODEL_ROUTER_REPORT_EVERY)
@@ -0,0 +1,155 @@
+import hashlib
+import re
+import unicodedata
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from config import Config
+from database_async import inbox_conversations_collection_async
+from utils.progress import RESULT_FIELDS
+
+SHINGLE_SIZE = 4  # Character shingles: no tokenizer needed for Japanese
+MAX_CHARS = 4000
+BANDS = 4  # LSH bands of 16 bits: mails within BANDS - 1 bits share at least one band
+
+# Node results a near-duplicate takes over from its original, per user choice. The
+# header rules, triage and spam check always run on the new mail itself.
+REUSED_RESULTS = {
+    'importance_score': 'importance_score_result',
+    'replies': 'replies_result',
+    'summary_and_category': 'summarization_and_category_result',
+}
+# Choices still reused when the numbers differ (alerts with a new timestamp or order
+# number); the summary and replies are generated again so they state the new figures.
+FIGURE_FREE_CHOICES = ('importance_score',)
+
+_DIGITS_RE = re.compile(r'\d+')
+_SPACE_RE = re.compile(r'\s+')
+_BITS = np.arange(64, dtype=np.uint64)
+_MULTIPLIER = np.uint64(0x100000001B3)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def normalize(text):
+    """NFKC, lower case, no whitespace, and every number collapsed to 0 (timestamps, order numbers)."""
+    text = unicodedata.normalize('NFKC', text[:MAX_CHARS]).lower()
+    return _DIGITS_RE.sub('0', _SPACE_RE.sub('', text))
+
+
+def simhash(text):
+    """64-bit SimHash of the character shingles of text."""
+    codes = np.frombuffer(normalize(text).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    count = len(codes) - SHINGLE_SIZE + 1
+    if count <= 0:
+        return 0
+    h = np.zeros(count, dtype=np.uint64)
+    for k in range(SHINGLE_SIZE):
+        h = h * _MULTIPLIER + codes[k:k + count]
+    h ^= h >> np.uint64(30)
+    h *= _MIX_1
+    h ^= h >> np.uint64(27)
+    h *= _MIX_2
+    h ^= h >> np.uint64(31)
+    h = np.unique(h)  # Each shingle counts once
+    votes = ((h[:, None] >> _BITS) & np.uint64(1)).sum(axis=0) * 2 > len(h)
+    return int((votes.astype(np.uint64) << _BITS).sum())
+
+
+def numbers_key(text):
+    """
+    Hash of the numbers of a text in order. The SimHash ignores them, so a near-duplicate
+    with different numbers (an alert with a new timestamp, an invoice with another
+    amount or account) only reuses FIGURE_FREE_CHOICES: its text must not state the
+    original's figures.
+    """
+    numbers = _DIGITS_RE.findall(unicodedata.normalize('NFKC', text[:MAX_CHARS]))
+    return hashlib.sha1(' '.join(numbers).encode('ascii')).hexdigest()[:16]
+
+
+def mail_fingerprint(subject, body, attachment_names=()):
+    """Stored with a mail at ingest: the SimHash (hex), its LSH band keys and the numbers key."""
+    text = '\n'.join([subject or '', body or '', *(n or '' for n in attachment_names)])
+    value = simhash(text)
+    width = 64 // BANDS
+    mask = (1 << width) - 1
+    return {
+        'simhash': f"{value:016x}",
+        'bands': [f"{i}:{(value >> (i * width)) & mask:x}" for i in range(BANDS)],
+        'numbers': numbers_key(text),
+    }
+
+
+def hamming(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+async def find_near_duplicate(email_address, mail):
+    """
+    The most recent analysed mail in the same mailbox from the same sender whose
+    SimHash is within NEAR_DUPLICATE_MAX_DISTANCE bits of `mail`, looked up through the
+    band keys (messages.fingerprint.bands is indexed). Returns (message, distance) or None.
+    """
+    fingerprint = mail.get('fingerprint')
+    if not fingerprint:
+        return None
+    since = datetime.now() - timedelta(hours=Config.NEAR_DUPLICATE_WINDOW_HOURS)
+    pipeline = [
+        {'$match': {'email_address': email_address, 'messages.fingerprint.bands': {'$in': fingerprint['bands']}}},
+        {'$unwind': '$messages'},
+        {'$match': {
+            'messages.fingerprint.bands': {'$in': fingerprint['bands']},
+            'messages.message_id': {'$ne': mail.get('message_id')},
+            'messages.sender': mail.get('sender'),
+            'messages.analysis.completed': True,
+            'messages.analysis.history_pass': {'$ne': True},  # Summary only, never spam-checked
+            'messages.analysis.duplicate_of': {'$exists': False},
+            'messages.received_datetime': {'$gte': since},
+        }},
+        {'$sort': {'messages.received_datetime': -1}},
+        {'$limit': Config.NEAR_DUPLICATE_MAX_CANDIDATES},
+        {'$project': {'_id': 0, 'conv_id': 1, 'message': '$messages'}},
+    ]
+    best = None
+    async for doc in await inbox_conversations_collection_async.aggregate(pipeline):
+        distance = hamming(fingerprint['simhash'], doc['message']['fingerprint']['simhash'])
+        if distance <= Config.NEAR_DUPLICATE_MAX_DISTANCE and (best is None or distance < best[1]):
+            best = (doc['message'], distance)
+    return best
+
+
+def group_of(message):
+    """Near-duplicates share fingerprint.group; the first mail of a group is its own group."""
+    return (message.get('fingerprint') or {}).get('group') or message['message_id']
+
+
+def same_figures(original, mail):
+    """Whether both mails carry the same numbers (fingerprints without a numbers key never do)."""
+    numbers = (mail.get('fingerprint') or {}).get('numbers')
+    return bool(numbers) and numbers == (original.get('fingerprint') or {}).get('numbers')
+
+
+def reused_results(original, choices, same_numbers):
+    """
+    The node results of the chosen tasks rebuilt from the original's analysis, to be
+    put in the agent state of the near-duplicate instead of calling the LLM. With
+    different numbers only FIGURE_FREE_CHOICES are reused.
+    """
+    if not same_numbers:
+        choices = [c for c in choices if c in FIGURE_FREE_CHOICES]
+    analysis = original['analysis']
+    results = {}
+    for choice, key in REUSED_RESULTS.items():
+        _, mapping = RESULT_FIELDS[key]
+        if choice not in choices or any(field not in analysis for field in mapping):
+            continue
+        results[key] = {name: analysis[field] for field, name in mapping.items()} \
+            if None not in mapping.values() else analysis[next(iter(mapping))]
+    return results
+
+
+def duplicate_info(original, distance, same_numbers):
+    """Where a near-duplicate's results came from (stored as analysis.duplicate_of)."""
+    return {'message_id': original['message_id'], 'distance': distance, 'group': group_of(original),
+            'same_numbers': same_numbers}
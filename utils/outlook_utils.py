@@ -1,15 +1,18 @@
 import json
 import requests
-import re
 
 from bs4 import BeautifulSoup
 from datetime import datetime, timedelta, timezone
 
 from config import Config
 from database import users_collection, inbox_conversations_collection
-from utils.common_utils import conduct_analysis
+from utils.common_utils import conduct_analysis, conduct_thread_analysis
 from utils.transform_utils import decode_conversation_index, convert_utc_str_to_local_datetime, convert_to_local_time
-from utils.message_parsing import get_unique_body_outlook, get_inline_attachments_outlook
+from utils.message_parsing import parse_outlook_body, extract_email_thread, compact_body
+from utils.attachment_triage import triage_attachment, SKIP, EXTRACT, OCR, SNIFF_BYTES
+from utils.header_rules import compact_headers
+from utils.near_duplicate import mail_fingerprint
+from utils.shared_analysis import content_hash
 
 celery_app = None
 msal_app = None
@@ -283,18 +286,6 @@ def subscribe_to_outlook_mail_webhook(user_id):
         return False
 
 
-def extract_email_thread(text, delim1, delim2):
-    pattern = re.compile(f"({re.escape(delim1)}|{re.escape(delim2)})")
-    match = pattern.search(text)
-    if match:
-        split_point = match.start()
-        # print(split_point)
-        delimiter_length = len(match.group(0))
-        return [text[:split_point], text[split_point + delimiter_length:]]
-    else:
-        return [text]
-
-
 def process_outlook_mail(message_id, owner_mail):
     user_data = users_collection.find_one({'user_id': owner_mail})
     if not user_data:
@@ -417,13 +408,15 @@ def prepare_conversation_thread(email_address, conversation_id, current_message_
 
     conv_messages = conv_response_data.get('value', [])
     messages = []
+    msg_docs = []
     for msg in conv_messages:
         message_id = msg.get('id')
         result, message_doc = save_single_mail(
             msg, email_address, conversation_id, user_data)
         messages.append(message_id)
-        if current_message_id == message_id:
-            conduct_analysis(email_address, conversation_id, message_doc)
+        msg_docs.append(message_doc)
+    # Oldest first, so each message finds the summaries of the earlier ones.
+    conduct_thread_analysis(email_address, conversation_id, msg_docs, current_message_id)
     if current_message_id not in messages:
         process_outlook_mail(current_message_id, email_address)
     return True
@@ -445,12 +438,23 @@ def process_single_mail(email_address, conversation_id, message, user_data):
     return conversation_id, message_id
 
 
+def _read_attachment_head(attach_url, headers):
+    """Streams the raw attachment and reads only the first bytes for magic-byte sniffing."""
+    try:
+        with requests.get(f"{attach_url}/$value", headers=headers, stream=True) as resp:
+            resp.raise_for_status()
+            return next(resp.iter_content(chunk_size=SNIFF_BYTES), b'')
+    except requests.exceptions.RequestException as e:
+        print(f"  Could not sniff attachment {attach_url}: {e}")
+        return None
+
+
 def save_single_mail(message, email_address, conversation_id, user_data):
     message_id = message.get('id')
     account_type = user_data.get('account_type')
     BASE_ENDPOINT = get_base_endpoint(email_address, account_type)
     headers = get_url_headers(email_address, account_type, user_data)
-    msg_endpoint = f"{BASE_ENDPOINT}/messages/{message_id}?$select=uniqueBody"
+    msg_endpoint = f"{BASE_ENDPOINT}/messages/{message_id}?$select=uniqueBody,internetMessageHeaders"
     single_msg_resp = requests.get(msg_endpoint, headers=headers)
     single_msg_resp.raise_for_status()
     single_msg_data = single_msg_resp.json()
@@ -470,11 +474,17 @@ def save_single_mail(message, email_address, conversation_id, user_data):
     bcc_list = [r.get('emailAddress', {}).get('address', 'N/A')
                 for r in message.get('bccRecipients', [])]
     body_content = single_msg_data.get("uniqueBody", {})
-    cleaned_body = get_unique_body_outlook(body_content)
-    inline_attachments = get_inline_attachments_outlook(body_content)
+    parsed_body = parse_outlook_body(body_content)
+    # uniqueBody still carries quotes that Outlook didn't recognise (e.g. pasted 差出人:/送信日時: headers).
+    # The HTML engine already split off marked-up quotes (.quoted_text); same as Gmail's get_text_from_html_part.
+    cleaned_body, quoted_text = extract_email_thread(parsed_body.text)
+    previous_messages = "\n".join(t for t in (quoted_text, parsed_body.quoted_text) if t)
+    cleaned_body, body_tokens = compact_body(cleaned_body)
+    inline_attachments = parsed_body.cids
     attachments_data = []
     if message.get('hasAttachments') or len(inline_attachments) > 0:
-        attachments_url = f"{BASE_ENDPOINT}/messages/{message_id}/attachments"
+        # List metadata only; content is fetched per attachment after triage.
+        attachments_url = f"{BASE_ENDPOINT}/messages/{message_id}/attachments?$select=id,name,contentType,size,isInline,contentId"
         try:
             attachments_resp = requests.get(attachments_url, headers=headers)
             attachments_resp.raise_for_status()
@@ -487,8 +497,24 @@ def save_single_mail(message, email_address, conversation_id, user_data):
                     'contentType': attach.get('contentType'),
                     'size': attach.get('size'),
                     'isInline': attach.get('isInline', False),
-                    'contentBytes': attach.get('contentBytes')
+                    'contentId': attach.get('contentId'),
                 }
+                attach_url = f"{BASE_ENDPOINT}/messages/{message_id}/attachments/{attach.get('id')}"
+                if attach.get('@odata.type', '').endswith('fileAttachment'):
+                    action, kind = triage_attachment(attachment_info, body_cids=inline_attachments)
+                    if action is None:
+                        head = _read_attachment_head(attach_url, headers)
+                        action, kind = triage_attachment(attachment_info, head=head)
+                else:
+                    # Item and reference attachments (mails, events, cloud links) carry no bytes.
+                    action, kind = SKIP, None
+                if action in (EXTRACT, OCR):
+                    attach_resp = requests.get(attach_url, headers=headers)
+                    attach_resp.raise_for_status()
+                    attachment_info['contentBytes'] = attach_resp.json().get('contentBytes')
+                else:
+                    print(f"Triage: skipping attachment {attach.get('name')} ({kind or 'too large'})")
+                attachment_info['triage'] = {'action': action or SKIP, 'kind': kind}
                 attachments_data.append(attachment_info)
         except requests.exceptions.RequestException as attach_e:
             print(
@@ -504,6 +530,7 @@ def save_single_mail(message, email_address, conversation_id, user_data):
     # print(received_time)
     message_doc = {
         'message_id': message_id,
+        'internet_message_id': message.get('internetMessageId'),
         'subject': subject,
         'conv_index': conv_index,
         "child_replies": number_of_child_replies,
@@ -512,13 +539,18 @@ def save_single_mail(message, email_address, conversation_id, user_data):
         'cc': cc_list,
         'bcc': bcc_list,
         'body': cleaned_body,
+        'body_tokens': body_tokens,
+        'previous_messages': previous_messages,
         'full_body': message.get('body'),
         'received_datetime': received_time,
         'attachments': attachments_data,
         'type': 'outlook_received_mail',
         'provider': 'outlook',
+        'headers': compact_headers(single_msg_data.get('internetMessageHeaders')),
+        'fingerprint': mail_fingerprint(subject, cleaned_body, [a.get('name') for a in attachments_data]),
         "analysis": analysis
     }
+    message_doc['content_hash'] = content_hash(message_doc)
     filter_query = {'conv_id': conversation_id, 'email_address': email_address}
 
     update_operations = {
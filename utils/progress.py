@@ -0,0 +1,69 @@
+import json
+
+from config import Config
+from database_async import inbox_conversations_collection_async
+
+# Node result key -> (readiness flag, {analysis field: result field})
+RESULT_FIELDS = {
+    'spam_check_result': ('spam', {'is_spam': 'is_spam', 'is_malicious': 'is_malicious', 'spam_source': 'source'}),
+    'importance_score_result': ('importance', {'importance_score': 'score', 'importance_description': 'description'}),
+    'summarization_and_category_result': ('summary', {'summary': 'summary', 'category': 'category'}),
+    'replies_result': ('replies', {'replies': None}),  # None: the whole result
+}
+
+_redis = None
+
+
+def analysis_fields(update):
+    """
+    Maps a node's state update to analysis fields; returns (fields, readiness flags).
+    """
+    fields, ready = {}, {}
+    for key, (flag, mapping) in RESULT_FIELDS.items():
+        result = update.get(key)
+        if not result:
+            continue
+        for field, name in mapping.items():
+            if name is None:
+                fields[field] = result
+            elif result.get(name) is not None:
+                fields[field] = result[name]
+        ready[flag] = True
+    return fields, ready
+
+
+def _push_client():
+    global _redis
+    if _redis is None and Config.ANALYSIS_PUSH_REDIS_URL:
+        import redis.asyncio
+        _redis = redis.asyncio.from_url(Config.ANALYSIS_PUSH_REDIS_URL)
+    return _redis
+
+
+async def publish(state, update):
+    """
+    Writes the analysis fields of one finished node to the message right away, with
+    analysis.ready.<flag> set, and pushes them on the Redis channel
+    'analysis:<user_email>' when ANALYSIS_PUSH_REDIS_URL is set.
+    """
+    fields, ready = analysis_fields(update)
+    if not fields:
+        return
+    msg_id = state['msg_id']
+    update_doc = {f'messages.$[message].analysis.{k}': v for k, v in fields.items()}
+    update_doc.update({f'messages.$[message].analysis.ready.{flag}': True for flag in ready})
+    try:
+        await inbox_conversations_collection_async.update_one(
+            {'conv_id': state['conv_id'], 'email_address': state['user_email'], 'messages.message_id': msg_id},
+            {'$set': update_doc},
+            array_filters=[{"message.message_id": msg_id}])
+    except Exception as e:
+        print(f"Error publishing partial analysis for message '{msg_id}': {e}")
+        return
+    client = _push_client()
+    if client is not None:
+        payload = {'conv_id': state['conv_id'], 'msg_id': msg_id, 'ready': list(ready), 'analysis': fields}
+        try:
+            await client.publish(f"analysis:{state['user_email']}", json.dumps(payload, ensure_ascii=False, default=str))
+        except Exception as e:
+            print(f"Error pushing partial analysis for message '{msg_id}': {e}")
@@ -0,0 +1,112 @@
+from config import Config
+from utils.token_utils import estimate_tokens, truncate_to_tokens
+
+# Section priorities: when the prompt is over budget, the lowest priority is cut first.
+# Required sections (instructions, rules, output format) are never cut.
+PRIORITY_REQUIRED = 100
+PRIORITY_HEADER = 90
+PRIORITY_BODY = 80
+PRIORITY_ATTACHMENTS = 50
+PRIORITY_HISTORY = 40
+
+TRUNCATION_MARKER = "\n…(以下省略)"
+HEAD_TRUNCATION_MARKER = "(前略)…\n"
+# Sections that would be cut below this many tokens are dropped instead.
+MIN_SECTION_TOKENS = 40
+
+
+class _Section:
+    __slots__ = ('label', 'text', 'priority', 'keep_tail', 'tokens')
+
+    def __init__(self, label, text, priority, keep_tail):
+        self.label = label
+        self.text = text
+        self.priority = priority
+        self.keep_tail = keep_tail
+        self.tokens = estimate_tokens(text)
+
+    def truncate(self, max_tokens):
+        if self.tokens <= max_tokens:
+            return
+        if max_tokens < MIN_SECTION_TOKENS:
+            self.text, self.tokens = '', 0
+            return
+        if self.keep_tail:
+            # Keep the most recent part of chronological text such as a thread history.
+            kept = truncate_to_tokens(self.text[::-1], max_tokens - estimate_tokens(HEAD_TRUNCATION_MARKER))[::-1]
+            self.text = HEAD_TRUNCATION_MARKER + kept
+        else:
+            self.text = truncate_to_tokens(self.text, max_tokens - estimate_tokens(TRUNCATION_MARKER)) + TRUNCATION_MARKER
+        self.tokens = estimate_tokens(self.text)
+
+    def render(self):
+        if self.label:
+            return f"{self.label}:\n{self.text}\n\n"
+        return self.text
+
+
+class PromptBuilder:
+    """
+    Builds an LLM prompt from prioritized sections within a token budget.
+
+    Each section can have its own cap (max_tokens); if the prompt is still over the
+    total budget, the lowest-priority sections are truncated (and dropped once too
+    small) until it fits. The final size is logged and kept in `tokens`.
+    """
+
+    def __init__(self, name, max_tokens=None, prefix=None):
+        self.name = name
+        self.max_tokens = max_tokens or Config.PROMPT_MAX_TOKENS
+        self.sections = []
+        self.tokens = 0
+        # A static prefix is kept as the first section so build() can leave it out
+        # when it is already held in a Gemini context cache.
+        self.has_prefix = bool(prefix)
+        self.add(prefix)
+
+    def add(self, text, label=None, priority=PRIORITY_REQUIRED, max_tokens=None, keep_tail=False):
+        """
+        Adds a section; empty sections are skipped. Truncated sections keep their start,
+        or their end with keep_tail. Returns the builder for chaining.
+        """
+        if text is None or text == '':
+            return self
+        section = _Section(label, str(text), priority, keep_tail)
+        if max_tokens is not None and priority < PRIORITY_REQUIRED:
+            section.truncate(max_tokens)
+        self.sections.append(section)
+        return self
+
+    def add_mail(self, mail, sender=True):
+        """Adds the sender, subject and body of a stored message with the default budgets."""
+        if sender:
+            self.add(mail.get('sender'), 'Sender', PRIORITY_HEADER, Config.PROMPT_HEADER_TOKENS)
+        self.add(mail.get('subject'), 'Subject', PRIORITY_HEADER, Config.PROMPT_HEADER_TOKENS)
+        return self.add(mail.get('body'), 'Body', PRIORITY_BODY, Config.PROMPT_BODY_TOKENS)
+
+    def add_context(self, attachment_summaries=None, previous_summary=None):
+        """Adds the attachment summaries and the previous-conversation summary (lowest priorities)."""
+        self.add(attachment_summaries, 'Attachment Summaries', PRIORITY_ATTACHMENTS, Config.PROMPT_ATTACHMENT_TOKENS)
+        return self.add(previous_summary, 'Previous Conversation Summary', PRIORITY_HISTORY, Config.PROMPT_HISTORY_TOKENS)
+
+    def build(self, include_prefix=True):
+        total = sum(s.tokens for s in self.sections)
+        # Labels and separators count against the budget too.
+        budget = self.max_tokens - sum(estimate_tokens(s.render()) - s.tokens for s in self.sections)
+        cut = []
+        if total > budget:
+            for section in sorted(self.sections, key=lambda s: s.priority):
+                if section.priority >= PRIORITY_REQUIRED or total <= budget:
+                    break
+                before = section.tokens
+                section.truncate(max(0, before - (total - budget)))
+                total -= before - section.tokens
+                cut.append(section.label or 'text')
+        sections = self.sections if include_prefix or not self.has_prefix else self.sections[1:]
+        prompt = ''.join(s.render() for s in sections if s.text)
+        self.tokens = estimate_tokens(prompt)
+        note = f" (cut: {', '.join(cut)})" if cut else ''
+        if not include_prefix and self.has_prefix:
+            note += " (prefix cached)"
+        print(f"Prompt '{self.name}': {self.tokens} tokens{note}")
+        return prompt
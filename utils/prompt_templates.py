@@ -0,0 +1,319 @@
+import hashlib
+import json
+
+from utils.prompt_builder import PromptBuilder
+from utils.severity_rules import CONDITION_RULES, SEVERITY_BANDS, band_rules
+
+# All analysis prompts live here as versioned templates. The static prefix of each
+# prompt (instructions, rules) is rendered once at import; only the mail-specific
+# sections are added per call. Bump a template's version whenever its text or schema
+# changes, so that anything keyed on `hash` (caches, analytics) is invalidated.
+
+PROMPT_TEMPLATES = {}
+
+
+def compact_json(obj):
+    """JSON without indentation or ASCII escaping: the same content in far fewer tokens."""
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+class PromptTemplate:
+    """
+    A prompt with a fixed, pre-rendered prefix and an optional response schema.
+
+    The schema is only sent as the API's responseSchema (or pydantic model for the
+    LangGraph agent), never repeated as text in the prompt.
+    """
+
+    def __init__(self, name, version, prefix, response_schema=None):
+        self.name = name
+        self.version = version
+        self.prefix = prefix
+        self.response_schema = response_schema
+        schema_text = compact_json(response_schema) if response_schema else ''
+        digest = hashlib.sha256(f"{name}\0{version}\0{prefix}\0{schema_text}".encode('utf-8'))
+        self.hash = digest.hexdigest()[:16]
+
+    @property
+    def key(self):
+        return f"{self.name}@v{self.version}"
+
+    def builder(self, max_tokens=None):
+        """Returns a PromptBuilder that already holds the static prefix."""
+        return PromptBuilder(f"{self.key} {self.hash}", max_tokens, prefix=self.prefix)
+
+
+def register_template(name, version, prefix, response_schema=None):
+    template = PromptTemplate(name, version, prefix, response_schema)
+    PROMPT_TEMPLATES[name] = template
+    return template
+
+
+def get_template(name):
+    return PROMPT_TEMPLATES[name]
+
+
+def importance_template(name, severity_match=None):
+    """
+    The variant of an importance template for a keyword pre-match (utils/severity_matcher.py):
+    with a match, only the matched severity band is sent instead of all the rules.
+    """
+    if severity_match is None:
+        return get_template(name)
+    return get_template(f"{name}_{severity_match.band}")
+
+
+CONDITION_RULES_JSON = compact_json(CONDITION_RULES)
+
+SEVERITY_BAND_OVERVIEW = ', '.join(
+    f"{name.split(' - ')[0]} {rules.get('スコア', '')}" for name, rules in CONDITION_RULES['severity_rules'].items()
+)
+
+
+def _severity_rules_text(band=None):
+    if band is None:
+        return f"Severity rules:\n{CONDITION_RULES_JSON}\n\n"
+    name, rules = band_rules(band)
+    return (
+        f"Severity rules of the band whose keywords were found in the mail (listed under Matched Keywords); "
+        f"score outside its range only if the mail clearly calls for it. All bands: {SEVERITY_BAND_OVERVIEW}.\n"
+        f"{compact_json({name: rules})}\n\n"
+    )
+
+
+def _register_importance(name, version, text, response_schema):
+    """Registers the full-rules template and one variant per severity band."""
+    template = register_template(name, version, text + _severity_rules_text(), response_schema)
+    for band in SEVERITY_BANDS.values():
+        register_template(f"{name}_{band}", version, text + _severity_rules_text(band), response_schema)
+    return template
+
+CATEGORY_LIST = (
+    "'エラー' (Error), '修理' (Repair), '問い合わせ' (Inquiry), '報告' (Report), 'キャンペーン' (Campaign),"
+    "'お知らせ' (Notice), 'プロモーション' (Promotion), 'スパム' (Spam), '有害' (Harmful), '返信不要' (No reply needed)."
+)
+
+CATEGORY_ENUM = ["エラー", "修理", "問い合わせ", "報告", "キャンペーン", "プロモーション", "スパム", "有害", "返信不要"]
+
+SUMMARY_AND_REPLIES_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "summary": {"type": "STRING"},
+        "replies": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "type": {"type": "STRING", "enum": ["Concise", "Confirm", "Polite"]},
+                    "text": {"type": "STRING"}
+                },
+                "required": ["type", "text"]
+            }
+        },
+        "category": {
+            "type": "STRING",
+            "enum": CATEGORY_ENUM
+        }
+    },
+    "required": ["summary", "replies", "category"]
+}
+
+IMPORTANCE_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "is_spam": {"type": "boolean"},
+        "is_malicious": {"type": "boolean"},
+        "importance": {
+            "type": "OBJECT",
+            "properties": {
+                "score": {"type": "number"},
+                "description": {"type": "string"}
+            },
+            "required": ["score", "description"]
+        }
+    },
+    "required": ["is_spam", "is_malicious", "importance"]
+}
+
+SPAM_CHECK_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "is_spam": {"type": "boolean"},
+        "is_malicious": {"type": "boolean"}
+    },
+    "required": ["is_spam", "is_malicious"]
+}
+
+SUMMARIZE_AND_CATEGORIZE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "summary": {"type": "STRING"},
+        "category": {"type": "STRING", "enum": CATEGORY_ENUM}
+    },
+    "required": ["summary", "category"]
+}
+
+IMPORTANCE_SCORE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "score": {"type": "integer"},
+        "description": {"type": "string"}
+    },
+    "required": ["score", "description"]
+}
+
+VALIDATE_OUTGOING_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "sensitive_data": {
+            "type": "OBJECT",
+            "properties": {
+                "has_sensitive_data": {"type": "boolean"},
+                "comment": {"type": "string"}
+            },
+            "required": ["has_sensitive_data", "comment"]
+        },
+        "attachments": {
+            "type": "OBJECT",
+            "properties": {
+                "has_missing_attachments": {"type": "boolean"},
+                "comment": {"type": "string"}
+            },
+            "required": ["has_missing_attachments", "comment"]
+        },
+        "grammatical_errors": {
+            "type": "OBJECT",
+            "properties": {
+                "has_errors": {"type": "boolean"},
+                "comment": {"type": "string"}
+            },
+            "required": ["has_errors", "comment"]
+        },
+        "best_practices": {
+            "type": "OBJECT",
+            "properties": {
+                "is_not_followed": {"type": "boolean"},
+                "comment": {"type": "string"}
+            },
+            "required": ["is_not_followed", "comment"]
+        },
+        "spelling_mistakes": {
+            "type": "OBJECT",
+            "properties": {
+                "has_mistakes": {"type": "boolean"},
+                "comment": {"type": "string"}
+            },
+            "required": ["has_mistakes", "comment"]
+        }
+    },
+    "required": ["sensitive_data", "attachments", "grammatical_errors", "best_practices", "spelling_mistakes"]
+}
+
+# Celery tasks (REST API with responseSchema)
+
+IMPORTANCE_ANALYSIS = _register_importance(
+    'importance_analysis', 1,
+    'Analyze the following email (Sender + Subject + Body + Attachment Summary + Summary from the previous emails of the conversation thread). '
+    'First, check if the mail is spam or has malicious content. '
+    'Then, assign it an urgency score "importance score" from 0 to 100, based on the severity rules below. '
+    'Provide a one-sentence summary *within 100 characters* describing the reason behind the scoring in Japanese. '
+    'If any keyword or its synonymous text from the conditions exists in the mail, score it corresponding to its category and mention the keyword in the description.\n\n',
+    IMPORTANCE_ANALYSIS_SCHEMA,
+)
+
+SUMMARY_AND_REPLIES = register_template(
+    'summary_and_replies', 1,
+    "Analyze the following email thread. "
+    "Here is the original email, summary of the attached file and a summary of the previous conversation thread. "
+    "Based on the content, perform the following tasks.\n\n"
+    "1. **Summarize the email**: Provide a concise summary (2-3 sentences) of the latest email and its context within the conversation history.\n"
+    "2. **Suggest Replies**: If a reply is needed, suggest three reply options in Business Japanese. "
+    "These replies should be **from the recipient of this email (the user of this system) to the sender of this email** (the Sender below).\n"
+    "   - One 'Concise' reply.\n"
+    "   - One 'Confirm' reply (for confirmation of receipt or understanding).\n"
+    "   - One 'Polite' reply (using the most polite form of Japanese).\n"
+    "   - **You must format the replies to be highly readable. Insert newline character (`\\n`) with regards to standard Japanese mail to separate sentences or phrases for clarity.**\n"
+    "   If no reply is needed (e.g., sender contains 'no-reply' or content is purely informational with no action required), "
+    "the replies should be empty and the summary should state '返信不要' (No reply needed).\n"
+    f"3. **Categorize the email**: Assign the email to one of the following categories in Japanese: {CATEGORY_LIST}\n\n",
+    SUMMARY_AND_REPLIES_SCHEMA,
+)
+
+PREVIOUS_EMAILS_SUMMARY = register_template(
+    'previous_emails_summary', 1,
+    'Summarize the key points and unresolved issues from this previous email of this thread '
+    'within 200 characters in Japanese. Only include Japanese, no Romaji.\n\n',
+)
+
+# LangGraph agent. Spam, importance and category go through the REST API (model cascade
+# and context cache); replies still use the pydantic model in llm_agent.
+
+SPAM_CHECK = register_template(
+    'spam_check', 2,
+    "Check whether the following mail is spam or has malicious content.\n\n",
+    SPAM_CHECK_SCHEMA,
+)
+
+IMPORTANCE_SCORE = _register_importance(
+    'importance_score', 2,
+    "Assign an importance score from 0-100 to the following email based on the severity rules below. "
+    "Then, provide a one-sentence description *within 100 characters* of the reason behind the scoring in Japanese. "
+    "If any keyword or its synonymous text from the conditions exists in the mail, score it corresponding to its category and mention the keyword in the description.\n\n",
+    IMPORTANCE_SCORE_SCHEMA,
+)
+
+SUGGEST_REPLIES = register_template(
+    'suggest_replies', 1,
+    "Analyze the following email content and determine if reply needed or not. "
+    "If a reply is needed, generate three reply options in Business Japanese: 'Concise', 'Confirm', and 'Polite'.\n"
+    "You must format the reply text to be highly readable. Insert newline characters (`\\n`) for clarity.\n"
+    "If no reply is needed, return no replies.\n\n",
+)
+
+SUMMARIZE_AND_CATEGORIZE = register_template(
+    'summarize_and_categorize', 2,
+    "Provide a concise summary (2-3 sentences) of the email and its context within the conversation history in Japanese. "
+    f"Categorize the email into one of the following categories in Japanese: {CATEGORY_LIST}\n\n",
+    SUMMARIZE_AND_CATEGORIZE_SCHEMA,
+)
+
+PREVIOUS_CONVERSATION_SUMMARY = register_template(
+    'previous_conversation_summary', 1,
+    'Summarize the key points and unresolved issues from the summaries of the previous email of this thread '
+    'within 200 characters in Japanese. Only include Japanese, no Romaji.\n\n',
+)
+
+# Conversation-level rolling summary (utils/conversation_summary.py)
+
+ROLLING_SUMMARY_UPDATE = register_template(
+    'rolling_summary_update', 1,
+    'Update the running summary of this email thread with the summary of its newest mail. '
+    'Keep the key points and unresolved issues, drop issues the newest mail resolves, '
+    'within 300 characters in Japanese. Only include Japanese, no Romaji.\n\n',
+)
+
+ROLLING_SUMMARY_COMPACT = register_template(
+    'rolling_summary_compact', 1,
+    'The following are summaries of consecutive parts of one email thread, oldest first. '
+    'Merge them into one summary of the key points and unresolved issues '
+    'within 300 characters in Japanese. Only include Japanese, no Romaji.\n\n',
+)
+
+# Add-on
+
+VALIDATE_OUTGOING = register_template(
+    'validate_outgoing', 1,
+    "Analyze the following email. "
+    "The analysis should cover four key areas: sensitive data, missing attachments, grammatical/spelling issues, and general business etiquette.\n\n"
+    "Provide a True/False result for each condition. If an issue is found (e.g., True), provide a clear and concise description of the error in Japanese within 200 characters. "
+    "If no issue is found (e.g., False), provide a brief explanatory comment in Japanese.\n\n"
+    "**Instructions:**\n"
+    "- **Sensitive Data:** Check the email body and subject for any Personally Identifiable Information (PII) or other sensitive content. "
+    "**Exclude the email signature from this check, as it is considered personal information that is always present and acceptable.**\n"
+    "- **Missing Attachments:** Based on the body content (e.g., phrases like 'see attached file'), determine if an attachment is mentioned but not present in the provided list. "
+    "Assume the provided 'attachments' list contains the names of all files.\n"
+    "- **Grammar & Spelling:** Identify all grammatical and spelling errors. Be sure to check recipient names against previous email data for consistency.\n"
+    "- **Japanese Business Etiquette:** Evaluate if the email follows standard Japanese business etiquette, including appropriate use of honorifics (e.g., `様` and `さん`), "
+    "formal language (`keigo`), and a respectful tone. \n\n",
+    VALIDATE_OUTGOING_SCHEMA,
+)
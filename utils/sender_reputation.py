@@ -0,0 +1,113 @@
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parseaddr
+
+from pymongo import ReturnDocument
+
+from config import Config
+from database_async import sender_reputation_collection_async
+
+# Verdict classes counted per sender and per domain
+SPAM = 'spam'
+MALICIOUS = 'malicious'
+CLEAN = 'clean'
+VERDICTS = (SPAM, MALICIOUS, CLEAN)
+# Mailboxes whose user marked the address as not malicious (/not_malicious)
+CLEAN_FOR = 'clean_for'
+
+# Shared mail providers: the domain says nothing about the sender.
+FREE_MAIL_DOMAINS = {
+    'gmail.com', 'googlemail.com', 'yahoo.co.jp', 'yahoo.com', 'outlook.com', 'outlook.jp', 'hotmail.com',
+    'live.jp', 'icloud.com', 'me.com', 'docomo.ne.jp', 'ezweb.ne.jp', 'au.com', 'softbank.ne.jp', 'i.softbank.jp',
+}
+
+
+def reputation_keys(sender):
+    """('addr:<address>', 'domain:<domain>' or None) for a From value such as 'Name <a@b.com>'."""
+    address = parseaddr(sender or '')[1].lower()
+    if '@' not in address:
+        return None, None
+    domain = address.rpartition('@')[2]
+    return f"addr:{address}", (None if domain in FREE_MAIL_DOMAINS else f"domain:{domain}")
+
+
+def verdict_of(is_spam, is_malicious):
+    return MALICIOUS if is_malicious else SPAM if is_spam else CLEAN
+
+
+def _unanimous(doc):
+    """The verdict of a reputation entry with a long history of one verdict only, else None."""
+    if not doc:
+        return None
+    counts = {v: doc.get(v, 0) for v in VERDICTS}
+    total = sum(counts.values())
+    if total < Config.REPUTATION_MIN_VERDICTS:
+        return None
+    verdict = max(counts, key=counts.get)
+    return verdict if counts[verdict] == total else None
+
+
+class SenderReputation:
+    """
+    Spam verdicts counted per sender address and per domain in MongoDB, with a small
+    in-process cache. A sender (or domain) with at least REPUTATION_MIN_VERDICTS
+    verdicts, all the same, gets that verdict without the LLM; a user override from
+    /not_malicious marks the address clean for that user. REPUTATION_SAMPLE_RATE of those
+    mails still go to the LLM, so a sender that changes gets a mixed history and
+    drops out of the shortcut.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # key -> (doc or None, valid until)
+
+    async def _get(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        doc = await sender_reputation_collection_async.find_one({'_id': key})
+        self._entries[key] = (doc, time.time() + self.ttl)
+        return doc
+
+    async def lookup(self, sender, user_email, aligned):
+        """
+        Returns {'is_spam', 'is_malicious', 'source'} when the history decides the
+        verdict, None when the LLM should check the mail. The From header can be
+        forged, so a clean verdict (history or override) is only trusted when the
+        mail passed DMARC (`aligned`, see evaluate_headers), and a /not_malicious
+        override only applies to the mailbox of the user who set it.
+        """
+        address_key, domain_key = reputation_keys(sender)
+        if address_key is None:
+            return None
+        address_doc = await self._get(address_key)
+        if aligned and address_doc and user_email in address_doc.get(CLEAN_FOR, []):
+            return {'is_spam': False, 'is_malicious': False, 'source': f"{address_key} (user override)"}
+        for key, doc in ((address_key, address_doc), (domain_key, await self._get(domain_key) if domain_key else None)):
+            verdict = _unanimous(doc)
+            if verdict is None or (verdict == CLEAN and not aligned):
+                continue
+            if random.random() < Config.REPUTATION_SAMPLE_RATE:
+                print(f"Sender reputation: sampling {key} ({verdict}) with the LLM")
+                return None
+            return {'is_spam': verdict != CLEAN, 'is_malicious': verdict == MALICIOUS, 'source': key}
+        return None
+
+    async def record(self, sender, is_spam, is_malicious):
+        """Counts an LLM verdict for the sender and its domain."""
+        verdict = verdict_of(is_spam, is_malicious)
+        now = datetime.now(timezone.utc)
+        for key in reputation_keys(sender):
+            if key is None:
+                continue
+            try:
+                doc = await sender_reputation_collection_async.find_one_and_update(
+                    {'_id': key}, {'$inc': {verdict: 1}, '$set': {'updated_at': now}},
+                    upsert=True, return_document=ReturnDocument.AFTER)
+                self._entries[key] = (doc, time.time() + self.ttl)
+            except Exception as e:
+                print(f"Error updating sender reputation for {key}: {e}")
+
+
+sender_reputation = SenderReputation(Config.REPUTATION_CACHE_TTL)
@@ -0,0 +1,163 @@
+import json
+import os
+import re
+import unicodedata
+from collections import deque
+
+from utils.severity_rules import CONDITION_RULES, band_code
+
+CRITICAL_CONDITION_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'files', 'critical_condition.json')
+
+# Most severe first: a mail matching several bands is put in the first one.
+BAND_ORDER = ('critical', 'high', 'medium', 'low')
+
+# Rule fields that describe a band rather than list phrases to look for.
+_DESCRIPTION_FIELDS = {'スコア', 'システム影響'}
+
+_KEYWORD_RE = re.compile(r'「(.+?)」')
+_QUALIFIER_RE = re.compile(r'\([^)]*\)')
+# Placeholders in the keyword list: 「A社とのEDI不通」「○○カテゴリ発注不可」
+_PLACEHOLDER_RE = re.compile(r'^(○○|[a-z]社)(との|の)?')
+_SPACE_RE = re.compile(r'\s+')
+
+KEYWORD = 'keyword'
+SITUATION = 'situation'
+MIN_PHRASE_CHARS = 3
+
+
+def normalize(text):
+    """NFKC, lower case and no whitespace, so full-width/half-width and line breaks don't matter."""
+    return _SPACE_RE.sub('', unicodedata.normalize('NFKC', text).lower())
+
+
+class _AhoCorasick:
+    """Multi-pattern matcher: one pass over the text finds every pattern it contains."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for pattern, value in patterns:
+            node = 0
+            for char in pattern:
+                nxt = self.goto[node].get(char)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][char] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(value)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text):
+        node = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                yield from out[node]
+
+
+class SeverityMatch:
+    """Pre-match result: the most severe band hit and the phrases that hit it."""
+    __slots__ = ('band', 'keywords', 'situations')
+
+    def __init__(self, band, keywords, situations):
+        self.band = band
+        self.keywords = keywords
+        self.situations = situations
+
+    @property
+    def confident(self):
+        """A listed キーワード matched, not only a 状況 phrase."""
+        return bool(self.keywords)
+
+    @property
+    def matched(self):
+        return self.keywords + self.situations
+
+
+def _phrase_variants(phrase):
+    """
+    Yields (pattern, exact). Placeholders are dropped; a (…) qualifier such as （全社）
+    is dropped too, but such a pattern is not exact: 「発注できない」 alone is weaker
+    evidence than 「発注できない（全社）」.
+    """
+    base = _PLACEHOLDER_RE.sub('', normalize(phrase))
+    unqualified = _QUALIFIER_RE.sub('', base)
+    if len(base) >= MIN_PHRASE_CHARS:
+        yield base, True
+    if unqualified != base and len(unqualified) >= MIN_PHRASE_CHARS:
+        yield unqualified, False
+
+
+def _band_phrases(rules):
+    for field, value in rules.items():
+        if field in _DESCRIPTION_FIELDS:
+            continue
+        if field == 'キーワード':
+            for keyword in _KEYWORD_RE.findall(value):
+                yield KEYWORD, keyword
+        elif isinstance(value, dict):
+            yield from _band_phrases(value)
+        elif isinstance(value, list):
+            for item in value:
+                yield SITUATION, item
+
+
+def _rule_sources():
+    yield CONDITION_RULES['severity_rules']
+    if os.path.exists(CRITICAL_CONDITION_FILE):
+        with open(CRITICAL_CONDITION_FILE, encoding='utf-8') as f:
+            for bands in json.load(f).values():
+                yield bands
+
+
+def _compile():
+    patterns = {}
+    for bands in _rule_sources():
+        for band_name, rules in bands.items():
+            band = band_code(band_name)
+            if band is None:
+                continue
+            for kind, phrase in _band_phrases(rules):
+                for pattern, exact in _phrase_variants(phrase):
+                    patterns.setdefault(pattern, set()).add((band, kind if exact else SITUATION, phrase))
+    return _AhoCorasick((pattern, hit) for pattern, hits in patterns.items() for hit in hits)
+
+
+_matcher = _compile()
+
+
+def match_severity(*texts):
+    """
+    Looks for the severity keywords and 状況 phrases of CONDITION_RULES and
+    files/critical_condition.json in the given texts (subject, body, attachment
+    summaries). Returns a SeverityMatch for the most severe band hit, or None.
+    """
+    found = {}
+    for text in texts:
+        if text:
+            for band, kind, phrase in _matcher.find(normalize(text)):
+                found.setdefault(band, {KEYWORD: [], SITUATION: []})
+                if phrase not in found[band][kind]:
+                    found[band][kind].append(phrase)
+    for band in BAND_ORDER:
+        if band in found:
+            keywords = found[band][KEYWORD]
+            return SeverityMatch(band, keywords, [p for p in found[band][SITUATION] if p not in keywords])
+    return None
@@ -0,0 +1,106 @@
+# Severity bands used to score incoming mail (purchasing / EDI helpdesk).
+# Shared by the LangGraph agent and the Celery tasks; rendered into prompts by utils/prompt_templates.py.
+CONDITION_RULES = {
+    "severity_rules": {
+        "🔴 重大（クリティカル） - 即座に対応（15分以内）": {
+            "スコア": "80-100",
+            "システム影響": "購買・調達業務の完全停止、サプライチェーン断絶",
+            "状況": {
+                "購買管理システム": [
+                    "発注システム全停止",
+                    "仕入先マスタ全件アクセス不可",
+                    "承認ワークフロー完全停止",
+                    "在庫切れ商品の緊急発注不可",
+                    "月末締め処理の完全停止"
+                ],
+                "EDIシステム": [
+                    "EDI通信の完全断絶（全取引先）",
+                    "受発注データの送受信停止",
+                    "大手取引先との自動連携停止",
+                    "出荷指示データ送信不可",
+                    "請求・支払データ交換停止"
+                ]
+            },
+            "業務への影響": [
+                "生産ライン停止リスク",
+                "店舗・倉庫への商品供給停止",
+                "主要取引先との取引停止",
+                "決済・支払処理の全面停止"
+            ],
+            "キーワード": "「EDI停止」「発注できない（全社）」「取引先と繋がらない」「生産停止」「在庫切れ緊急」"
+        },
+        "🟡 高（高優先度） - 優先対応（1時間以内）": {
+            "スコア": "60-79",
+            "システム影響": "重要機能の部分停止、主要取引先への影響",
+            "状況": {
+                "購買管理システム": [
+                    "特定カテゴリの発注機能停止",
+                    "承認者不在による承認遅延",
+                    "発注書印刷・送付機能不具合",
+                    "仕入先別発注データ抽出不可",
+                    "予算管理機能の異常"
+                ],
+                "EDIシステム": [
+                    "特定取引先とのEDI通信障害",
+                    "データ変換エラー（一部取引先）",
+                    "自動発注の部分的停止",
+                    "在庫連携データの送信遅延",
+                    "受注確認データの未受信"
+                ]
+            },
+            "業務シナリオ": [
+                "主要仕入先との定期発注に支障",
+                "特定商品カテゴリの調達停止",
+                "大口取引先からの受注処理遅延",
+                "月次・週次の定期発注に影響"
+            ],
+            "キーワード": "「A社とのEDI不通」「○○カテゴリ発注不可」「定期発注エラー」「受注データ未着」"
+        },
+        "🟢 中（標準） - 通常対応（4時間以内）": {
+            "スコア": "30-59",
+            "システム影響": "個人・部分的な業務への影響",
+            "状況": {
+                "購買管理システム": [
+                    "個人の発注権限設定問題",
+                    "特定商品の単価・仕入先情報更新",
+                    "発注書印刷・送付機能不具合",
+                    "帳票レイアウトの軽微な問題",
+                    "ユーザー操作に関する質問"
+                ],
+                "EDIシステム": [
+                    "小規模取引先との通信問題",
+                    "データフォーマット軽微修正",
+                    "送信履歴・ログ確認方法",
+                    "EDI設定変更の相談"
+                ]
+            },
+            "キーワード": "「個人アカウント」「操作方法」「履歴確認」「軽微な修正」"
+        },
+        "🟦 低（一般） - 計画対応（1営業日以内）": {
+            "スコア": "0-29",
+            "システム影響": "業務継続に直接影響なし",
+            "内容": [
+                "システム改善要望",
+                "新規取引先EDI接続準備",
+                "マスタデータ整備計画",
+                "操作研修・マニュアル整備",
+                "将来的なシステム更改相談"
+            ]
+        }
+    }
+}
+
+# Band codes by the colour mark that starts each band name (the same in files/critical_condition.json).
+SEVERITY_BANDS = {'🔴': 'critical', '🟡': 'high', '🟢': 'medium', '🟦': 'low'}
+
+
+def band_code(band_name):
+    return SEVERITY_BANDS.get(band_name[:1])
+
+
+def band_rules(code):
+    """Returns (band name, rules) of a band in CONDITION_RULES."""
+    for name, rules in CONDITION_RULES['severity_rules'].items():
+        if band_code(name) == code:
+            return name, rules
+    raise KeyError(code)
@@ -0,0 +1,158 @@
+import hashlib
+import unicodedata
+from datetime import datetime, timedelta, timezone
+from email.utils import parseaddr
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from config import Config
+from database_async import shared_analyses_collection_async, inbox_conversations_collection_async
+
+OWNER = 'owner'
+RUNNING = 'running'
+DONE = 'done'
+SEPARATE = 'separate'
+
+
+def content_hash(mail):
+    """sha256 over the sender address, subject, body and attachment names/sizes of a stored mail."""
+    parts = [
+        parseaddr(mail.get('sender') or '')[1].lower(),
+        mail.get('subject') or '',
+        mail.get('body') or '',
+        *(f"{a.get('name')}:{a.get('size')}" for a in mail.get('attachments') or []),
+    ]
+    text = unicodedata.normalize('NFKC', '\n'.join(parts))
+    return hashlib.sha256(' '.join(text.split()).encode('utf-8')).hexdigest()
+
+
+def shared_key(mail):
+    """Internet-Message-ID when the mail has one, the content hash otherwise."""
+    if mail.get('internet_message_id'):
+        return f"mid:{mail['internet_message_id'].strip().strip('<>').lower()}"
+    return f"hash:{mail.get('content_hash') or content_hash(mail)}"
+
+
+def recipient_record(email_data, choices):
+    return {
+        'user_email': email_data.get('user_email'),
+        'conv_id': email_data.get('conv_id'),
+        'msg_id': email_data.get('msg_id'),
+        'email_provider': email_data.get('email_provider'),
+        'choices': list(choices),
+        'replies_deferred': bool(email_data.get('replies_deferred')),
+    }
+
+
+def shared_part(analysis, mail):
+    """
+    What another mailbox can take over from the owner's run: the spam verdict and the
+    attachment summaries. Importance, summary and replies read the mailbox's own
+    conversation history, so every mailbox computes those itself.
+    """
+    # A verdict from the sender reputation, in particular a user's /not_malicious override,
+    # belongs to the owner's mailbox: the other mailboxes run their own spam check then.
+    verdict_shared = not analysis.get('spam_source')
+    return {
+        'analysis': {k: analysis[k] for k in ('is_spam', 'is_malicious') if k in analysis and verdict_shared},
+        'attachment_summaries': [
+            {'name': a.get('name'), 'size': a.get('size'), 'summary': a['attachment_summary']}
+            for a in mail.get('attachments') or [] if a.get('attachment_summary')],
+    }
+
+
+def shared_results(shared):
+    """The owner's spam verdict as a node result for this mailbox's agent state."""
+    analysis = shared.get('analysis') or {}
+    if 'is_spam' not in analysis:
+        return {}
+    return {'spam_check_result': {'is_spam': analysis['is_spam'], 'is_malicious': analysis.get('is_malicious', False),
+                                  'source': f"shared:{shared['_id']}"}}
+
+
+async def adopt_attachment_summaries(shared, mail, conv_id, user_email, msg_id):
+    """
+    Stores the owner's attachment summaries on this mailbox's copies of the attachments
+    (matched by name and size) and on the view, so the attachment node skips them.
+    """
+    summaries = {(a['name'], a['size']): a['summary'] for a in shared.get('attachment_summaries') or []}
+    for attachment in mail.attachments:
+        summary = summaries.get((attachment.get('name'), attachment.get('size')))
+        if not summary or attachment.get('attachment_summary'):
+            continue
+        attachment['attachment_summary'] = summary
+        await inbox_conversations_collection_async.update_one(
+            {'conv_id': conv_id, 'email_address': user_email, 'messages.message_id': msg_id},
+            {'$set': {f"messages.$[message].attachments.{attachment['index']}.attachment_summary": summary}},
+            array_filters=[{"message.message_id": msg_id}])
+
+
+async def claim(mail, recipient):
+    """
+    Registers the mailbox on the shared analysis of this mail. Returns
+    ('owner', None) when this run should analyse the mail and fan the result out,
+    ('running', None) when another mailbox's run is doing that, ('done', doc) when
+    the result already exists, or ('separate', None) when the Message-ID is shared
+    with a different mail.
+    """
+    key = shared_key(mail)
+    hash_ = mail.get('content_hash') or content_hash(mail)
+    now = datetime.now(timezone.utc)
+    update = {'$setOnInsert': {'status': RUNNING, 'claimed_at': now, 'content_hash': hash_, 'owner': recipient['msg_id']},
+              '$addToSet': {'recipients': recipient}}
+    try:
+        doc = await shared_analyses_collection_async.find_one_and_update(
+            {'_id': key}, update, upsert=True, return_document=ReturnDocument.BEFORE)
+    except DuplicateKeyError:
+        # Lost a concurrent upsert: the document exists now, so this only registers us.
+        doc = await shared_analyses_collection_async.find_one_and_update(
+            {'_id': key}, update, return_document=ReturnDocument.BEFORE)
+    if doc is None:
+        return OWNER, None
+    if doc.get('content_hash') != hash_:
+        # Same Message-ID but different content (a sender reusing IDs): analyse separately.
+        await shared_analyses_collection_async.update_one({'_id': key}, {'$pull': {'recipients': recipient}})
+        return SEPARATE, None
+    if doc['status'] == DONE:
+        return DONE, doc
+    stale = now - timedelta(seconds=Config.SHARED_ANALYSIS_CLAIM_TIMEOUT)
+    claimed_at = doc['claimed_at'].replace(tzinfo=timezone.utc) if doc['claimed_at'].tzinfo is None else doc['claimed_at']
+    if claimed_at < stale:
+        result = await shared_analyses_collection_async.update_one(
+            {'_id': key, 'status': RUNNING, 'claimed_at': doc['claimed_at']},
+            {'$set': {'claimed_at': now, 'owner': recipient['msg_id']}})
+        if result.modified_count:
+            print(f"Shared analysis {key}: taking over a stale claim")
+            return OWNER, None
+    return RUNNING, None
+
+
+async def complete(mail, owner_msg_id, part):
+    """
+    Stores the owner's mailbox-independent results (shared_part) and returns the other
+    mailboxes registered so far; mailboxes registering later find the result themselves.
+    """
+    doc = await shared_analyses_collection_async.find_one_and_update(
+        {'_id': shared_key(mail), 'owner': owner_msg_id},
+        {'$set': {'status': DONE, **part, 'completed_at': datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER)
+    if doc is None:
+        return None, []
+    return doc, [r for r in doc.get('recipients', []) if r['msg_id'] != owner_msg_id]
+
+
+async def release(mail, owner_msg_id):
+    """Drops a failed claim and returns the other mailboxes waiting on it."""
+    doc = await shared_analyses_collection_async.find_one_and_delete(
+        {'_id': shared_key(mail), 'owner': owner_msg_id, 'status': RUNNING})
+    return [r for r in (doc or {}).get('recipients', []) if r['msg_id'] != owner_msg_id]
+
+
+def requeue(recipient):
+    """Runs the analysis of a waiting mailbox again (it claims or takes over the result itself)."""
+    from workers.tasks import run_analysis_agent_stateful
+    email_data = {k: recipient[k] for k in ('user_email', 'conv_id', 'msg_id', 'email_provider')}
+    if recipient.get('replies_deferred'):
+        email_data['replies_deferred'] = True
+    run_analysis_agent_stateful.delay(f"{recipient['conv_id']}---{recipient['msg_id']}", email_data, recipient['choices'])
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+from config import Config
+from utils.gemini_utils import TokenMeter, token_meter
+
+
+async def _metered(coro, meter):
+    token_meter.set(meter)  # Only affects this task's context
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        meter.seconds = time.perf_counter() - start
+
+
+class _BranchMeter(TokenMeter):
+    __slots__ = ('seconds',)
+
+    def __init__(self):
+        super().__init__()
+        self.seconds = 0.0
+
+
+class Speculation:
+    """
+    Runs a gating check (the spam check) and the work that normally waits for it (the
+    chosen analyses) at the same time. When the check comes back positive the
+    speculative branches are cancelled and their results discarded.
+
+    Per run it records the latency gained against running the check first (check time
+    + branch time - actual time) and, for positives, the tokens the discarded branches
+    used; report() summarizes both.
+    """
+
+    def __init__(self, report_every):
+        self.report_every = report_every
+        self.runs = 0
+        self.positives = 0
+        self.saved_seconds = 0.0
+        self.wasted_calls = 0
+        self.wasted_tokens = 0
+
+    async def run(self, check, branches, is_positive, gate=None):
+        """
+        Awaits `check` with the `branches` coroutines running alongside. Returns
+        (check result, branch results or None when they were discarded). `gate`, an
+        asyncio.Future, is resolved with True for a negative check before the branches
+        are cancelled, so branches can hold side effects until the check is known.
+        """
+        start = time.perf_counter()
+        meters = [_BranchMeter() for _ in branches]
+        tasks = [asyncio.create_task(_metered(b, m)) for b, m in zip(branches, meters)]
+        try:
+            check_result = await check
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        check_seconds = time.perf_counter() - start
+        positive = is_positive(check_result)
+        if gate is not None and not gate.done():
+            gate.set_result(not positive)
+        self.runs += 1
+        if positive:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.positives += 1
+            self.wasted_calls += sum(m.calls for m in meters)
+            self.wasted_tokens += sum(m.tokens for m in meters)
+            self._maybe_report()
+            return check_result, None
+        results = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        self.saved_seconds += check_seconds + max((m.seconds for m in meters), default=0.0) - elapsed
+        self._maybe_report()
+        return check_result, results
+
+    def report(self):
+        if not self.runs:
+            return "no speculative runs"
+        return (f"{self.runs} runs, {self.positives} positive ({100 * self.positives / self.runs:.1f}%), "
+                f"saved {self.saved_seconds:.1f}s ({self.saved_seconds / self.runs * 1000:.0f} ms per run), "
+                f"wasted {self.wasted_calls} calls / ~{self.wasted_tokens} tokens")
+
+    def _maybe_report(self):
+        if self.report_every and self.runs % self.report_every == 0:
+            print(f"Speculative analysis stats: {self.report()}")
+
+
+speculation = Speculation(Config.MODEL_ROUTER_REPORT_EVERY)
@@ -0,0 +1,105 @@
+import asyncio
+
+from config import Config
+from utils.gemini_utils import call_gemini_api
+from utils.token_utils import estimate_tokens, iter_token_chunks
+
+SUMMARY_MODEL = "gemini-2.0-flash"
+
+FINAL_SUMMARY_INSTRUCTION = 'within 200 characters in Japanese. Only include Japanese, no Romaji.'
+# Appended when SUMMARY_MAX_CHUNKS left parts of the attachment out of the summary.
+PARTIAL_SUMMARY_NOTE = '（長文のため一部のみ要約: {selected}/{total} 部分）'
+
+
+def _select_chunks(chunks, max_chunks):
+    """
+    Keeps at most max_chunks chunks, spread evenly over the document and always
+    including the first and the last one, so cost stays fixed for any file size.
+    """
+    if len(chunks) <= max_chunks:
+        return chunks
+    if max_chunks == 1:
+        return chunks[:1]
+    step = (len(chunks) - 1) / (max_chunks - 1)
+    return [chunks[round(i * step)] for i in range(max_chunks)]
+
+
+async def _summarize_chunk(chunk, index, total):
+    """Map step: summarizes one part of the document into key facts."""
+    prompt = (
+        f'The following is part {index + 1} of {total} of an email attachment. '
+        f'List the key facts, figures, dates, requests and problems it contains '
+        f'within 400 characters in Japanese. Only include Japanese, no Romaji.\n\n{chunk}'
+    )
+    return await call_gemini_api(prompt, model=SUMMARY_MODEL)
+
+
+async def _merge_summaries(summaries, final):
+    """Reduce step: merges partial summaries, either into another partial or the final summary."""
+    joined = "\n\n".join(f"[{i + 1}] {s}" for i, s in enumerate(summaries))
+    if final:
+        prompt = f'Summarize the content of the attachment from these partial summaries: {joined} {FINAL_SUMMARY_INSTRUCTION}'
+    else:
+        prompt = (
+            f'Merge these partial summaries of one email attachment into a single list of key facts '
+            f'within 400 characters in Japanese. Only include Japanese, no Romaji.\n\n{joined}'
+        )
+    return await call_gemini_api(prompt, model=SUMMARY_MODEL)
+
+
+def _group_for_reduce(summaries):
+    """Groups partial summaries so every reduce call stays within the chunk budget and fan-in."""
+    groups = []
+    group = []
+    group_tokens = 0
+    for summary in summaries:
+        tokens = estimate_tokens(summary)
+        if group and (len(group) >= Config.SUMMARY_REDUCE_FAN_IN or group_tokens + tokens > Config.SUMMARY_CHUNK_TOKENS):
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(summary)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+async def summarize_attachment_text(text):
+    """
+    Summarizes extracted attachment text into the 200-character Japanese summary.
+    Short texts take a single call. Longer ones are split into token-budgeted chunks,
+    summarized concurrently (bounded by the shared Gemini rate limiter) and reduced
+    hierarchically. At most SUMMARY_MAX_CHUNKS map calls are made, so the total
+    number of calls is bounded regardless of the file size; when chunks had to be
+    skipped the summary ends with PARTIAL_SUMMARY_NOTE.
+    """
+    if not text or not text.strip():
+        return ""
+    chunks = list(iter_token_chunks(text, Config.SUMMARY_CHUNK_TOKENS))
+    if len(chunks) == 1:
+        prompt = f'Summarize the content of the attachments: {chunks[0]} {FINAL_SUMMARY_INSTRUCTION}'
+        return await call_gemini_api(prompt, model=SUMMARY_MODEL)
+
+    selected = _select_chunks(chunks, Config.SUMMARY_MAX_CHUNKS)
+    partial = len(selected) < len(chunks)
+    if partial:
+        print(f"Attachment text has {len(chunks)} chunks; summarizing only {len(selected)} evenly spaced chunks, "
+              f"{len(chunks) - len(selected)} chunks are skipped and the summary is marked as partial.")
+
+    partials = await asyncio.gather(*[
+        _summarize_chunk(chunk, i, len(selected)) for i, chunk in enumerate(selected)
+    ])
+    summaries = [s for s in partials if s]
+    if not summaries:
+        return ""
+
+    while True:
+        groups = _group_for_reduce(summaries)
+        if len(groups) == 1 or len(groups) == len(summaries):
+            # One group left, or the partials are too long to shrink further: finish here.
+            summary = await _merge_summaries(summaries, final=True)
+            if partial and summary:
+                summary += PARTIAL_SUMMARY_NOTE.format(selected=len(selected), total=len(chunks))
+            return summary
+        merged = await asyncio.gather(*[_merge_summaries(group, final=False) for group in groups])
+        summaries = [s for s in merged if s] or summaries[:1]
@@ -0,0 +1,63 @@
+import aiohttp
+
+from config import Config
+
+
+def is_helpdesk_mail(mail):
+    return Config.HELPDESK_ADDRESS in (mail.get('receivers') or '')
+
+
+def should_alert_early(severity_match, mail):
+    """A listed critical-band keyword in a helpdesk mail is alerted without waiting for the LLM score."""
+    return bool(severity_match and severity_match.band == 'critical' and severity_match.confident
+                and is_helpdesk_mail(mail))
+
+
+def build_alert_payload(subject, received_time, body, reason=None):
+    """Adaptive card posted to the helpdesk Teams channel."""
+    facts = [
+        {"title": "件名", "value": f"{subject}"},
+        {"title": "受信日時", "value": f"{received_time}"},
+        {"title": "本文", "value": f"{body}"},
+    ]
+    if reason:
+        facts.insert(2, {"title": "判定", "value": reason})
+    return {
+        "type": "message",
+        "attachments": [
+            {
+                "contentType": "application/vnd.microsoft.card.adaptive",
+                "content": {
+                    "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+                    "type": "AdaptiveCard",
+                    "version": "1.2",
+                    "body": [
+                        {
+                            "type": "TextBlock",
+                            "text": "Critical Mail Alert",
+                            "wrap": True,
+                            "style": "heading",
+                            "color": "attention"
+                        },
+                        {"type": "FactSet", "facts": facts},
+                    ],
+                }
+            }
+        ]
+    }
+
+
+async def send_critical_mail_alert(mail, received_time, reason=None):
+    """Posts a critical-mail card for a stored message to Teams. Returns True when sent."""
+    payload = build_alert_payload(mail.get('subject'), received_time, mail.get('body'), reason)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(Config.TEAMS_ALERT_WEBHOOK_URL, json=payload) as response:
+                response.raise_for_status()
+                print("Message successfully sent to Teams.")
+                return True
+    except aiohttp.ClientError as err:
+        print(f"HTTP Error: {err}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    return False
@@ -0,0 +1,64 @@
+import re
+
+# Kana, kanji, full-width forms and CJK punctuation. Gemini spends roughly one
+# token per character on these, while ASCII text averages about four characters per token.
+_WIDE_CHARS = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+ASCII_CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    """
+    Estimates the Gemini token count of a text locally, tuned for mixed Japanese/English mail.
+    """
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARS.findall(text))
+    narrow = len(text) - wide
+    return wide + (narrow + ASCII_CHARS_PER_TOKEN - 1) // ASCII_CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    Cuts a text so its estimated token count stays within max_tokens.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # Binary search on the character length; estimate_tokens is monotonic in the prefix length.
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def iter_token_chunks(text, max_tokens):
+    """
+    Yields consecutive chunks of the text, each within max_tokens.
+    Chunks break on line boundaries where possible; a single line larger than the
+    budget is split on its own. `text` is a string or any iterable of lines; chunks
+    are produced one at a time, but a string argument is of course held in full.
+    """
+    lines = text.splitlines(keepends=True) if isinstance(text, str) else text
+    chunk = []
+    chunk_tokens = 0
+    for line in lines:
+        line_tokens = estimate_tokens(line)
+        while line_tokens > max_tokens:
+            head = truncate_to_tokens(line, max_tokens)
+            if chunk:
+                yield "".join(chunk)
+                chunk, chunk_tokens = [], 0
+            yield head
+            line = line[len(head):]
+            line_tokens = estimate_tokens(line)
+        if chunk_tokens + line_tokens > max_tokens and chunk:
+            yield "".join(chunk)
+            chunk, chunk_tokens = [], 0
+        if line:
+            chunk.append(line)
+            chunk_tokens += line_tokens
+    if chunk:
+        yield "".join(chunk)
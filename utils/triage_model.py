@@ -0,0 +1,154 @@
+import os
+import time
+import unicodedata
+
+import numpy as np
+
+from config import Config
+
+# Categories whose mails need no reply or summary call when the model is confident.
+SKIP_CATEGORIES = {'プロモーション', 'キャンペーン', '返信不要'}
+
+# Bumped when the feature scheme changes; models of another format are not loaded.
+FORMAT_VERSION = 1
+DEFAULT_DIM = 2 ** 17  # Hashed feature buckets
+NGRAM_SIZES = (1, 2, 3)  # Character n-grams: no tokenizer needed for Japanese
+MAX_CHARS = 2000  # Sender, subject and the start of the body are enough to triage
+
+_MULTIPLIER = np.uint64(0x100000001B3)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_SHIFT_1 = np.uint64(30)
+_SHIFT_2 = np.uint64(31)
+
+
+def mail_text(mail):
+    text = f"{mail.get('sender') or ''}\n{mail.get('subject') or ''}\n{mail.get('body') or ''}"
+    return unicodedata.normalize('NFKC', text[:MAX_CHARS]).lower()
+
+
+def hashed_ngrams(text, dim):
+    """Returns (bucket indices, counts) of the character n-grams of text, hashed with NumPy."""
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    hashes = []
+    for n in NGRAM_SIZES:
+        if len(codes) < n:
+            continue
+        h = np.full(len(codes) - n + 1, n, dtype=np.uint64)
+        for k in range(n):
+            h = h * _MULTIPLIER + codes[k:len(codes) - n + 1 + k]
+        hashes.append(h)
+    if not hashes:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    h = np.concatenate(hashes)
+    h ^= h >> _SHIFT_1
+    h *= _MIX_1
+    h ^= h >> _SHIFT_2
+    return np.unique((h % np.uint64(dim)).astype(np.int64), return_counts=True)
+
+
+class TriageModel:
+    """
+    Multinomial logistic regression over TF-IDF weighted, hashed character n-grams,
+    distilled from the categories Gemini assigned to past mails.
+    """
+
+    def __init__(self, classes, weights, bias, idf, version):
+        self.classes = list(classes)
+        self.weights = weights  # (classes, dim)
+        self.bias = bias
+        self.idf = idf
+        self.version = version
+        self.dim = len(idf)
+
+    def features(self, text):
+        idx, counts = hashed_ngrams(text, self.dim)
+        values = (1.0 + np.log(counts)) * self.idf[idx]
+        norm = np.sqrt(values @ values)
+        return idx, (values / norm if norm else values).astype(np.float32)
+
+    def predict_proba(self, text):
+        idx, values = self.features(text)
+        logits = self.weights[:, idx] @ values + self.bias
+        exp = np.exp(logits - logits.max())
+        return exp / exp.sum()
+
+    def predict(self, mail):
+        """Returns (category, probability) for a stored mail."""
+        proba = self.predict_proba(mail_text(mail))
+        best = int(proba.argmax())
+        return self.classes[best], float(proba[best])
+
+    @classmethod
+    def fit(cls, texts, labels, dim=DEFAULT_DIM, epochs=8, learning_rate=0.5, l2=1e-5, seed=0):
+        """Trains with plain SGD; features are sparse, so only the touched columns are updated."""
+        classes = sorted(set(labels))
+        target = np.array([classes.index(label) for label in labels])
+        grams = [hashed_ngrams(text, dim) for text in texts]
+        df = np.zeros(dim, dtype=np.float64)
+        for idx, _ in grams:
+            df[idx] += 1
+        idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        model = cls(classes, np.zeros((len(classes), dim), dtype=np.float32),
+                    np.zeros(len(classes), dtype=np.float32), idf, time.strftime('%Y%m%d-%H%M%S'))
+        rows = [model.features(text) for text in texts]
+        rng = np.random.default_rng(seed)
+        for epoch in range(epochs):
+            rate = learning_rate / (1 + epoch)
+            for i in rng.permutation(len(rows)):
+                idx, values = rows[i]
+                logits = model.weights[:, idx] @ values + model.bias
+                proba = np.exp(logits - logits.max())
+                proba /= proba.sum()
+                proba[target[i]] -= 1
+                model.weights[:, idx] *= 1 - rate * l2
+                model.weights[:, idx] -= rate * np.outer(proba, values)
+                model.bias -= rate * proba
+        return model
+
+    def save(self, path):
+        np.savez_compressed(
+            path, format_version=FORMAT_VERSION, version=self.version, classes=np.array(self.classes),
+            weights=self.weights, bias=self.bias, idf=self.idf)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['format_version']) != FORMAT_VERSION:
+                raise ValueError(f"unsupported triage model format {int(data['format_version'])}")
+            return cls(data['classes'].tolist(), data['weights'], data['bias'], data['idf'], str(data['version']))
+
+
+_model = None
+_model_loaded = False
+
+
+def get_triage_model():
+    """The model at Config.TRIAGE_MODEL_PATH, loaded once; None when there is no usable model."""
+    global _model, _model_loaded
+    if not _model_loaded:
+        _model_loaded = True
+        if os.path.exists(Config.TRIAGE_MODEL_PATH):
+            try:
+                _model = TriageModel.load(Config.TRIAGE_MODEL_PATH)
+                print(f"Loaded triage model {_model.version} ({len(_model.classes)} categories)")
+            except (OSError, KeyError, ValueError) as e:
+                print(f"Error loading triage model {Config.TRIAGE_MODEL_PATH}: {e}")
+    return _model
+
+
+def triage_message(mail):
+    """
+    Local first-pass triage of a stored mail. Returns None without a model, otherwise
+    {'category', 'confidence', 'skip', 'model_version'}; `skip` means the mail is an
+    obvious promotion / no-reply mail that doesn't need the reply and summary calls.
+    """
+    model = get_triage_model()
+    if model is None:
+        return None
+    category, confidence = model.predict(mail)
+    return {
+        'category': category,
+        'confidence': round(confidence, 4),
+        'skip': category in SKIP_CATEGORIES and confidence >= Config.TRIAGE_SKIP_CONFIDENCE,
+        'model_version': model.version,
+    }
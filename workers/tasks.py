@@ -1,7 +1,4 @@
-import json
 import time
-import requests
-import base64
 import asyncio
 import threading
 from typing import TypedDict, Optional, List
@@ -9,10 +6,21 @@ from bs4 import BeautifulSoup
  # Assuming this is your central message collection
 from database import inbox_messages_collection, inbox_conversations_collection
 from utils.gemini_utils import call_gemini_api, call_gemini_api_structured
+from utils.model_router import model_router
 # from celery import Celery, shared_task
 from app import celery_app
 from utils.attachment_processing import extract_text_from_attachment
-from utils.llm_agent import run_analysis_agent_stateful_async
+from utils.attachment_decoding import AttachmentContent
+from utils.attachment_triage import SKIP
+from utils.summarization import summarize_attachment_text
+from utils.prompt_builder import PRIORITY_HEADER, PRIORITY_HISTORY
+from utils.prompt_templates import importance_template, SUMMARY_AND_REPLIES, PREVIOUS_EMAILS_SUMMARY
+from utils.severity_matcher import match_severity
+from utils.teams_alert import is_helpdesk_mail, should_alert_early, send_critical_mail_alert
+from config import Config
+from utils.llm_agent import run_analysis_agent_stateful_async, generate_replies_async
+from utils.conversation_summary import render as render_rolling_summary, covers as covers_rolling_summary, \
+    COVERAGE_PROJECTION as ROLLING_COVERAGE_PROJECTION
 
 from app import create_app # Import your Flask app factory
 # from .some_module import some_function_that_uses_app_context
@@ -22,136 +30,6 @@ from app import create_app # Import your Flask app factory
 # celery_app = None
 # Task 1: Generate Importance Score and Description
 
-GEMINI_RESPONSE_SCHEMA = {
-    "type": "OBJECT",
-    "properties": {
-        "summary": {"type": "STRING"},
-        "replies": {
-            "type": "ARRAY",
-            "items": {
-                "type": "OBJECT",
-                "properties": {
-                    "type": {"type": "STRING", "enum": ["Concise", "Confirm", "Polite"]},
-                    "text": {"type": "STRING"}
-                },
-                "required": ["type", "text"]
-            }
-        },
-        "category": {
-            "type": "STRING",
-            "enum": ["エラー", "修理", "問い合わせ", "報告", "キャンペーン", "プロモーション", "スパム", "有害", "返信不要"]
-        }
-    },
-    "required": ["summary", "replies", "category"]
-}
-
-GEMINI_RESPONSE_SCHEMA_IAS = {
-    "type": "OBJECT",
-    "properties": {
-        "is_spam": {"type": "boolean"},
-        "is_mallicious": {"type": "boolean"},
-        "importance": {
-            "type": "OBJECT",
-            "properties": {
-                "score": {"type": "number"},
-                "description": {"type": "string"}
-            },
-            "required": ["score", "description"]
-        }
-    },
-    "required": ["is_spam", "is_mallicious", "importance"]
-}
-
-CONDITION_RULES = {
-    "severity_rules": {
-        "🔴 重大（クリティカル） - 即座に対応（15分以内）": {
-            "スコア": "80-100",
-            "システム影響": "購買・調達業務の完全停止、サプライチェーン断絶",
-            "状況": {
-                "購買管理システム": [
-                    "発注システム全停止",
-                    "仕入先マスタ全件アクセス不可",
-                    "承認ワークフロー完全停止",
-                    "在庫切れ商品の緊急発注不可",
-                    "月末締め処理の完全停止"
-                ],
-                "EDIシステム": [
-                    "EDI通信の完全断絶（全取引先）",
-                    "受発注データの送受信停止",
-                    "大手取引先との自動連携停止",
-                    "出荷指示データ送信不可",
-                    "請求・支払データ交換停止"
-                ]
-            },
-            "業務への影響": [
-                "生産ライン停止リスク",
-                "店舗・倉庫への商品供給停止",
-                "主要取引先との取引停止",
-                "決済・支払処理の全面停止"
-            ],
-            "キーワード": "「EDI停止」「発注できない（全社）」「取引先と繋がらない」「生産停止」「在庫切れ緊急」"
-        },
-        "🟡 高（高優先度） - 優先対応（1時間以内）": {
-            "スコア": "60-79",
-            "システム影響": "重要機能の部分停止、主要取引先への影響",
-            "状況": {
-                "購買管理システム": [
-                    "特定カテゴリの発注機能停止",
-                    "承認者不在による承認遅延",
-                    "発注書印刷・送付機能不具合",
-                    "仕入先別発注データ抽出不可",
-                    "予算管理機能の異常"
-                ],
-                "EDIシステム": [
-                    "特定取引先とのEDI通信障害",
-                    "データ変換エラー（一部取引先）",
-                    "自動発注の部分的停止",
-                    "在庫連携データの送信遅延",
-                    "受注確認データの未受信"
-                ]
-            },
-            "業務シナリオ": [
-                "主要仕入先との定期発注に支障",
-                "特定商品カテゴリの調達停止",
-                "大口取引先からの受注処理遅延",
-                "月次・週次の定期発注に影響"
-            ],
-            "キーワード": "「A社とのEDI不通」「○○カテゴリ発注不可」「定期発注エラー」「受注データ未着」"
-        },
-        "🟢 中（標準） - 通常対応（4時間以内）": {
-            "スコア": "30-59",
-            "システム影響": "個人・部分的な業務への影響",
-            "状況": {
-                "購買管理システム": [
-                    "個人の発注権限設定問題",
-                    "特定商品の単価・仕入先情報更新",
-                    "発注書印刷・送付機能不具合",
-                    "帳票レイアウトの軽微な問題",
-                    "ユーザー操作に関する質問"
-                ],
-                "EDIシステム": [
-                    "小規模取引先との通信問題",
-                    "データフォーマット軽微修正",
-                    "送信履歴・ログ確認方法",
-                    "EDI設定変更の相談"
-                ]
-            },
-            "キーワード": "「個人アカウント」「操作方法」「履歴確認」「軽微な修正」"
-        },
-        "🟦 低（一般） - 計画対応（1営業日以内）": {
-            "スコア": "0-29",
-            "システム影響": "業務継続に直接影響なし",
-            "内容": [
-                "システム改善要望",
-                "新規取引先EDI接続準備",
-                "マスタデータ整備計画",
-                "操作研修・マニュアル整備",
-                "将来的なシステム更改相談"
-            ]
-        }
-    }
-}
-
 def get_previous_messages(conv_id, email_address, current_message_id, current_message_time):
     """
     Finds and returns all messages in a conversation received before a specific message.
@@ -214,7 +92,7 @@ def run_async(coro, timeout=None):
     return future.result(timeout)
 
 
-async def _extract_text_from_attachments(data, filename, message_type):
+async def _extract_text_from_attachments(data, filename, message_type, file_extension=None):
     """
     Helper function to extract plain text content from attachments within the
     full_message_payload (either Gmail or Outlook format).
@@ -223,15 +101,13 @@ async def _extract_text_from_attachments(data, filename, message_type):
     """
     attachment_texts = []
     try:
-        if 'gmail' in message_type:
-            decoded_bytes = base64.urlsafe_b64decode(data)
-        elif 'outlook' in message_type:
-            decoded_bytes = base64.b64decode(data)
-        else:
+        if 'gmail' not in message_type and 'outlook' not in message_type:
             return attachment_texts
 
-        # Await the coroutine instead of calling asyncio.run()
-        text = await extract_text_from_attachment(decoded_bytes, filename)
+        # Decoded lazily; large attachments are spilled to a temp file removed on exit.
+        with AttachmentContent.for_provider(data, message_type) as content:
+            # Await the coroutine instead of calling asyncio.run()
+            text = await extract_text_from_attachment(content, filename, file_extension)
         if text:
             attachment_texts.append(f"--- Attachment: {filename} ---\n{text}\n--- End Attachment ---")
     except Exception as e:
@@ -262,15 +138,18 @@ async def _generate_attachment_summary_async(conv_id, msg_id, user_id, provider_
         pass
     attachments = message_result['messages'][0].get('attachments', [])
     for attachment in attachments:
+        triage = attachment.get('triage') or {}
+        if triage.get('action') == SKIP or not attachment.get('contentBytes'):
+            print(f"Attachment {attachment.get('name')} was skipped at triage")
+            continue
         time.sleep(2)
-        attachment_size = attachment.get('size')
-        if attachment_size<1200000:
-            extracted_text =await _extract_text_from_attachments(attachment.get('contentBytes'), attachment.get('name'), provider_type)
+        attachment_size = attachment.get('size') or 0
+        if attachment_size <= Config.ATTACHMENT_MAX_BYTES:
+            extracted_text =await _extract_text_from_attachments(attachment.get('contentBytes'), attachment.get('name'), provider_type, triage.get('kind'))
             attachment_summary = ""
             if extracted_text:
-                prompt_attachment_summary = f'Summarize the content of the attatchments: {extracted_text} within 200 characters in Japanese. Only include Japanese, no Romaji.'
                 try:
-                    attachment_summary = await call_gemini_api(prompt_attachment_summary,  model="gemini-2.0-flash")
+                    attachment_summary = await summarize_attachment_text("\n".join(extracted_text))
                     inbox_conversations_collection.update_one(
                         {
                             'conv_id': conv_id, 'email_address': user_id, 'messages.message_id':msg_id
@@ -306,12 +185,45 @@ def generate_attachment_summary(conv_id, msg_id, user_id, provider_type):
         return f'Error: {str(e)}'
 
 
+def _previous_messages_prompt(previous_message_texts):
+    return (
+        PREVIOUS_EMAILS_SUMMARY.builder()
+        .add(previous_message_texts, 'Previous Emails', PRIORITY_HISTORY,
+             Config.PROMPT_PREVIOUS_MESSAGES_TOKENS, keep_tail=True)
+        .build()
+    )
+
+
+def _save_previous_messages_summary(conv_id, user_id, message_id, summary):
+    inbox_conversations_collection.update_one(
+        {
+            'conv_id': conv_id, 'email_address': user_id, 'messages.message_id':message_id
+        },
+        {
+            '$set': {
+            'messages.$[message].previous_messages_summary': summary,
+            }
+        },
+        array_filters=[
+            {"message.message_id": message_id},
+        ]
+    )
+
+
 async def _generate_previous_emails_summary_async(conv_id, message_id, user_id):
     current_message_doc = inbox_conversations_collection.find_one(
         {'conv_id': conv_id, "email_address":user_id, 'messages.message_id': message_id},
-        {'_id': 0, 'messages.$': 1}
+        {'_id': 0, 'messages.$': 1, 'rolling_summary': 1}
     )
     current_message = current_message_doc['messages'][0]
+    rolling = current_message_doc.get('rolling_summary')
+    received = current_message.get('received_datetime')
+    thread = rolling and inbox_conversations_collection.find_one(
+        {'conv_id': conv_id, "email_address": user_id}, {'_id': 0, **ROLLING_COVERAGE_PROJECTION})
+    if thread and covers_rolling_summary(rolling, thread.get('messages', []), received):
+        # The rolling summary already covers every earlier message; no need to re-read their bodies.
+        _save_previous_messages_summary(conv_id, user_id, message_id, render_rolling_summary(rolling))
+        return True
     previous_message_texts = ''
     pm_count = 1
     if current_message_doc and 'messages' in current_message_doc:
@@ -323,26 +235,14 @@ async def _generate_previous_emails_summary_async(conv_id, message_id, user_id):
                 previous_message_texts+=f'Messages {pm_count}: \n{pm.get('body', '')}\n\n'
             pm_count+=1
 
-    prompt_summary = f'Summarize the key points and unresolved issues from this previous email of this thread: {previous_message_texts} within 200 characters in Japanese. Only include Japanese, no Romaji.'
+    prompt_summary = _previous_messages_prompt(previous_message_texts)
 
     try:
         # time.sleep(2)
         summary = ""
         if previous_message_texts:
             summary = await call_gemini_api(prompt_summary)
-        inbox_conversations_collection.update_one(
-            {
-                'conv_id': conv_id, 'email_address': user_id, 'messages.message_id':message_id
-            },
-            {
-                '$set': {
-                'messages.$[message].previous_messages_summary': summary,
-                }
-            },
-            array_filters=[
-                {"message.message_id": message_id},
-            ]
-        )
+        _save_previous_messages_summary(conv_id, user_id, message_id, summary)
     except Exception as e:
         print("Gemini error occured", e)
         return False
@@ -366,7 +266,8 @@ async def _generate_previous_emails_summary_gmail_async(conv_id, message_id, use
     previous_message_texts = current_message.get('previous_messages', '')
 
     if previous_message_texts:
-        prompt_summary = f'Summarize the key points and unresolved issues from this previous email of this thread: {previous_message_texts} within 200 characters in Japanese. Only include Japanese, no Romaji.'
+        # Gmail keeps the raw quoted history, which can be very long; only its most recent part is sent.
+        prompt_summary = _previous_messages_prompt(previous_message_texts)
 
         try:
             # time.sleep(2)
@@ -407,7 +308,6 @@ async def _generate_importance_analysis_async(conv_id, message_id, user_id):
         {'_id': 0, 'messages.$': 1}
     )
     current_message = current_message_doc['messages'][0]
-    sender = current_message.get('sender', 'sender')
     subject = current_message.get('subject', '')
     body = current_message.get('body')
     attachments = current_message.get('attachments', {})
@@ -421,24 +321,25 @@ async def _generate_importance_analysis_async(conv_id, message_id, user_id):
     previous_emails_summary = current_message.get("previous_messages_summary")
     if not previous_emails_summary:
         previous_emails_summary = "No previous emails"
-    formatted_rules = json.dumps(CONDITION_RULES, indent=2, ensure_ascii=False)
-    prompt_template = (
-        f'Analyze the following email (Sender + Subject + Body + Attachment Summary + Summary from the previous emails of the conversation thread).'
-        f'First, check if the mail is spam or has malicious content.'
-        f'Then, assign it an urgency score"importance score" from 0 to 100, based on these conditions: {formatted_rules}.'
-        f'Provide a one-sentence summary *within 100 characters* describing the reason behind the scoring in Japanese.'
-        f'If any keyword or its synonymous text from the conditions exists in the mail, score it corresponding to its category and mention the keyword in the description.'
-        f'\n\n'
-        f'**Output Format (JSON)**:\n'
-        f'{json.dumps(GEMINI_RESPONSE_SCHEMA_IAS, indent=2)}\n\n'
-        f'Sender: {sender}\n'
-        f'Subject: {subject}\n'
-        f'Body:\n{body}\n\n'
-        f'Attachment Summary:\n{attachment_summary}\n\n'
-        f'Previous Conversation Summary:\n{previous_emails_summary}'
-    ) 
-
-    gemini_response = await call_gemini_api_structured(prompt_template, GEMINI_RESPONSE_SCHEMA_IAS, temp=0.8, model="gemini-2.0-flash")
+    received_time = current_message.get('received_time', '')
+    severity_match = match_severity(subject, body, attachment_summary)
+    template = importance_template('importance_analysis', severity_match)
+    builder = template.builder().add_mail(current_message)
+    if severity_match:
+        builder.add('、'.join(severity_match.matched), 'Matched Keywords', PRIORITY_HEADER, Config.PROMPT_HEADER_TOKENS)
+    builder.add_context(attachment_summary, previous_emails_summary)
+
+    # A confident critical keyword match alerts the helpdesk while the LLM is still running.
+    early_alert = None
+    if should_alert_early(severity_match, current_message):
+        early_alert = asyncio.create_task(send_critical_mail_alert(
+            current_message, received_time, reason=f"キーワード: {'、'.join(severity_match.keywords)}"))
+    gemini_response = await model_router.call(
+        'importance_analysis', template, builder, temp=0.8,
+        escalate_if=lambda r: r['is_spam'] or r['is_malicious'] or r['importance']['score'] >= Config.MODEL_ROUTER_ESCALATE_SCORE,
+        strong_first=severity_match is not None and severity_match.band in ('critical', 'high'))
+    if early_alert:
+        await early_alert
 
     is_spam = False
     is_malicious = False
@@ -453,61 +354,8 @@ async def _generate_importance_analysis_async(conv_id, message_id, user_id):
             importance_score = importance.get('score', importance_score)
             importance_description = importance.get('description', importance_description)
 
-            if importance_score >= 70 and "helpdesk@ffp.co.jp" in current_message.get('receivers', ''):
-                received_time = current_message.get('received_time', '')
-                teams_payload = {
-                    "type": "message",
-                    "attachments": [
-                        {
-                        "contentType": "application/vnd.microsoft.card.adaptive",
-                        "content": {
-                            "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                            "type": "AdaptiveCard",
-                            "version": "1.2",
-                            "body": [
-                                {
-                                    "type": "TextBlock",
-                                    "text": "Critical Mail Alert",
-                                    "wrap": True,
-                                    "style": "heading",
-                                    "color":"attention"
-                                },
-                                {
-                                    "type": "FactSet",
-                                    "facts": [
-                                        {
-                                        "title": "件名",
-                                        "value": f"{subject}"
-                                        },
-                                        {
-                                        "title": "受信日時",
-                                        "value": f"{received_time}"
-                                        },
-                                        {
-                                        "title": "本文",
-                                        "value": f"{body}"
-                                        }
-                                    ]
-                                },
-                            ],
-                        }
-                    }
-                    ]
-                }
-
-                # Set up the headers for the request
-                headers = {
-                    "Content-Type": "application/json"
-                }
-                try:
-                    teams_webhook_url = "https://prod-07.japaneast.logic.azure.com:443/workflows/7846e0ca56c44bd7a1b2aeb34ac6a4da/triggers/manual/paths/invoke?api-version=2016-06-01&sp=%2Ftriggers%2Fmanual%2Frun&sv=1.0&sig=-TVc0SuSMCleLgFr2QrR2us-Jbe81poMuU3QhWHbnFo"
-                    response = requests.post(teams_webhook_url, data=json.dumps(teams_payload), headers=headers)
-                    response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-                    print("Message successfully sent to Teams.")
-                except requests.exceptions.HTTPError as err:
-                    print(f"HTTP Error: {err}")
-                except Exception as e:
-                    print(f"An error occurred: {e}")
+            if importance_score >= Config.TEAMS_ALERT_MIN_SCORE and is_helpdesk_mail(current_message) and not early_alert:
+                await send_critical_mail_alert(current_message, received_time)
 
         except Exception as e:
             print(f"Error parsing Gemini importance response for {message_id}: {e}")
@@ -558,36 +406,19 @@ async def _generate_summary_and_replies_async(conv_id, message_id, user_id):
     )
     current_message = current_message_doc['messages'][0]
 
-    subject = current_message.get('subject', '')
-    body = current_message.get('body')
-    
-    sender = current_message.get('sender', '')
     attachment_summary = current_message.get('attachment_summary', '')
     previous_email_summary = current_message.get('previous_messages_summary', '') # Assuming history_summary is stored in message_doc
 
     prompt = (
-        f"Analyze the following email thread. "
-        f"Here is the original email, summary of the attached file and a summary of the previous conversation thread."
-        f"Based on the content, perform the following tasks and provide the output in JSON format.\n\n"
-        f"1. **Summarize the email**: Provide a concise summary (2-3 sentences) of the latest email and its context within the conversation history."
-        f"2. **Suggest Replies**: If a reply is needed, suggest three reply options in Business Japanese."
-        f"   These replies should be **from the recipient of this email (the user of this system) to the sender of this email** (`{sender}`). "
-        f"   - One 'Concise' reply."
-        f"   - One 'Confirm' reply (for confirmation of receipt or understanding)."
-        f"   - One 'Polite' reply (using the most polite form of Japanese)."
-        f"   - **You must format the replies to be highly readable. Insert newline character (`\n`) with regards to standard Japanese mail to separate sentences or phrases for clarity.**"
-        f"   If no reply is needed (e.g., sender contains 'no-reply' or content is purely informational with no action required), the 'replies' array should be empty and the 'summary' should state '返信不要' (No reply needed)."
-        f"3. **Categorize the email**: Assign the email to one of the following categories in Japanese: "
-        f"'エラー' (Error), '修理' (Repair), '問い合わせ' (Inquiry), '報告' (Report), 'キャンペーン' (Campaign),'お知らせ' (Notice), 'プロモーション' (Promotion), 'スパム' (Spam), '有害' (Harmful), '返信不要' (No reply needed)."
-        f"\n\n"
-        f"**Output Format (JSON)**:\n"
-        f"{json.dumps(GEMINI_RESPONSE_SCHEMA, indent=2)}\n\n" # Embed the schema for clarity to the model
-        f"Sender: {sender}\n\nSubject: {subject}\n\nBody:\n{body}\n\nAttachment Summary{attachment_summary}\n\nPrevious Conversation Summary:\n{previous_email_summary}"
+        SUMMARY_AND_REPLIES.builder()
+        .add_mail(current_message)
+        .add_context(attachment_summary, previous_email_summary)
+        .build()
     )
 
     # print(prompt)
 
-    gemini_response_json = await call_gemini_api_structured(prompt, GEMINI_RESPONSE_SCHEMA)
+    gemini_response_json = await call_gemini_api_structured(prompt, SUMMARY_AND_REPLIES.response_schema)
     # print(gemini_response_json)
     summary = "Could not generate summary."
     replies = []
@@ -634,6 +465,16 @@ def generate_summary_and_replies(conv_id, message_id, user_id):
 
     
 
+@celery_app.task(name='tasks.generate_replies')
+def generate_replies(conv_id, message_id, user_id, reason='on_demand'):
+    """Celery task generating the reply suggestions of an analysed mail on demand (utils/lazy_replies.py)."""
+    try:
+        run_async(generate_replies_async(conv_id, user_id, message_id, reason))
+        return 'Done'
+    except Exception as e:
+        return f'Error: {str(e)}'
+
+
 @celery_app.task(name='tasks.run_analysis_agent_stateful')
 def run_analysis_agent_stateful(thread_id: str, email_data: dict, choices: Optional[List[str]] = None):
     """